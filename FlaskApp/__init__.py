@@ -1,13 +1,22 @@
-from flask import Flask
+import hashlib
+import logging
+from datetime import datetime, timezone
+
+from flask import Flask, jsonify, request
+
+from Reserve import availability, cache
+from Types import AvailabilityIndex
 
 
 app = Flask(__name__)
 
+LATEST_MINUTES = 48 * 60 # windows are looked for up to here, slots can end at midnight of the next day
+
 @app.route("/")
 def index():
     return (
-        "Try /hello/Chris for parameterized Flask route.\n"
-        "Try /module for module import guidance"
+        "Try /availability?date=2023-01-09&duration=120 for the rooms that are free for 2 hours that day (add &room= for a single room).\n"
+        "Try /rooms/free?from=2023-01-09T10:00&to=2023-01-09T12:00 for the rooms that are free the whole time"
     )
 
 @app.route("/hello/<name>", methods=['GET'])
@@ -18,5 +27,100 @@ def hello(name: str):
 def module():
     return f"<h1>Balls</h1>"
 
+def errorResponse(message: str, status: int = 400):
+    return jsonify({'error': message}), status
+
+def libraryFromRequest():
+    lid = request.args.get('lid', type=int, default=availability.LIBRARIES[0].lid)
+    if lid not in {library.lid for library in availability.LIBRARIES}:
+        raise ValueError(f"lid {lid} isn't one of the libraries this bot looks at")
+    return lid
+
+def loadDay(date: str, lid: int):
+    '''
+    The day's index from the api cache, only the first of many requests for a day that isn't cached goes to libcal
+    '''
+    try:
+        datetime.strptime(date, '%Y-%m-%d')
+    except ValueError:
+        raise ValueError('date has to look like YYYY-MM-DD')
+    return availability.getIndexedDay(date, lid)
+
+def cachedResponse(payload: dict, day: availability.IndexedDay, loadedAt: float):
+    '''
+    Adds the caching headers, the etag changes when the day's grid or the query does, and answers
+    with a 304 when the client already has this response
+    '''
+    response = jsonify(payload)
+    response.set_etag(hashlib.sha1(f"{day.fingerprint}|{request.full_path}".encode()).hexdigest())
+    response.last_modified = datetime.fromtimestamp(loadedAt, timezone.utc)
+    response.cache_control.public = True
+    response.cache_control.max_age = int(cache.AVAILABILITY_CACHE_TTL)
+    return response.make_conditional(request)
+
+@app.route("/availability", methods=['GET'])
+def availabilityForDate():
+    '''
+    Every window of `duration` minutes (30 by default) that's free on `date`, for every room or just `room` (eid or part of its name)
+    '''
+    duration = request.args.get('duration', type=int, default=AvailabilityIndex.SLOT_MINUTES)
+    if duration is None or duration <= 0 or duration % AvailabilityIndex.SLOT_MINUTES != 0:
+        return errorResponse(f"duration has to be a multiple of {AvailabilityIndex.SLOT_MINUTES} minutes")
+    try:
+        day, loadedAt = loadDay(request.args.get('date', ''), libraryFromRequest())
+    except ValueError as e:
+        return errorResponse(str(e))
+    except Exception as e:
+        logging.info(f"Couldn't get the availability: {e}")
+        return errorResponse("couldn't get the availability from libcal", 502)
+
+    room = request.args.get('room', '').strip()
+    eids = sorted(day.index.eids(), key=day.roomName)
+    if room != '':
+        eids = [eid for eid in eids if str(eid) == room or room.lower() in day.roomName(eid).lower()]
+
+    slotCount = duration // AvailabilityIndex.SLOT_MINUTES
+    rooms = []
+    for eid in eids:
+        slots = day.index.slots(eid)
+        windows = day.index.windows(eid, 0, LATEST_MINUTES, slotCount)
+        rooms.append({
+            'eid': eid,
+            'name': day.roomName(eid),
+            'windows': [{'start': slots[window].start, 'end': slots[window + slotCount - 1].end} for window in windows],
+        })
+    return cachedResponse({'date': day.date, 'lid': day.lid, 'duration': duration, 'rooms': rooms}, day, loadedAt)
+
+@app.route("/rooms/free", methods=['GET'])
+def freeRooms():
+    '''
+    The rooms that are free for the whole time between `from` and `to` (YYYY-MM-DDTHH:MM on the same day)
+    '''
+    try:
+        fromTime = datetime.fromisoformat(request.args.get('from', ''))
+        toTime = datetime.fromisoformat(request.args.get('to', ''))
+    except ValueError:
+        return errorResponse('from and to have to look like YYYY-MM-DDTHH:MM')
+    if fromTime.date() != toTime.date() or toTime <= fromTime:
+        return errorResponse('from has to be before to, on the same day')
+
+    # the room has to be free for every 30 minute slot that touches the time range
+    fromMinutes = fromTime.hour * 60 + fromTime.minute
+    fromMinutes -= fromMinutes % AvailabilityIndex.SLOT_MINUTES
+    toMinutes = toTime.hour * 60 + toTime.minute
+    toMinutes += -toMinutes % AvailabilityIndex.SLOT_MINUTES
+    slotCount = (toMinutes - fromMinutes) // AvailabilityIndex.SLOT_MINUTES
+    try:
+        day, loadedAt = loadDay(fromTime.strftime('%Y-%m-%d'), libraryFromRequest())
+    except ValueError as e:
+        return errorResponse(str(e))
+    except Exception as e:
+        logging.info(f"Couldn't get the availability: {e}")
+        return errorResponse("couldn't get the availability from libcal", 502)
+
+    rooms = [{'eid': eid, 'name': day.roomName(eid)} for eid in sorted(day.index.eids(), key=day.roomName)
+             if len(day.index.windows(eid, fromMinutes, toMinutes, slotCount)) > 0]
+    return cachedResponse({'date': day.date, 'lid': day.lid, 'from': request.args['from'], 'to': request.args['to'], 'rooms': rooms}, day, loadedAt)
+
 if __name__ == "__main__":
-    app.run()
\ No newline at end of file
+    app.run()
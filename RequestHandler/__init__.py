@@ -2,10 +2,15 @@ import logging
 
 import azure.functions as func
 
-from FlaskApp import app
+_wsgiMiddleware: func.WsgiMiddleware = None
 
 
 def main(req: func.HttpRequest, context: func.Context) -> func.HttpResponse:
     """Each request is redirected to the WSGI handler.
+    Flask and the app are only loaded by the first request, not when the function is.
     """
-    return func.WsgiMiddleware(app.wsgi_app).handle(req, context)
+    global _wsgiMiddleware
+    if _wsgiMiddleware is None:
+        from FlaskApp import app
+        _wsgiMiddleware = func.WsgiMiddleware(app.wsgi_app)
+    return _wsgiMiddleware.handle(req, context)
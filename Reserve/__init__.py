@@ -1,6 +1,7 @@
 import datetime
 import logging
-from Reserve import reserve
+import os
+from Reserve import metrics
 
 import azure.functions as func
 
@@ -13,7 +14,25 @@ def main(mytimer: func.TimerRequest) -> None:
         logging.info('The timer is past due!')
 
     logging.info('Python timer trigger function ran at %s', utc_timestamp)
-    reserve.main()
+    metrics.startRun('timer')
+    try:
+        # the run's modules (and requests, the database drivers...) are only loaded once the timer fires
+        if os.environ.get('MULTI_USER_MODE', 'false').lower() == 'true' and os.environ.get('JOB_QUEUE', 'false').lower() == 'true':
+            from Reserve import bookings, jobs
+            bookings.main() # first, so a reservation it cancelled or lost in a swap is queued again right away
+            jobs.main() # queue a job for every user and date, this run and any other workers share them
+        elif os.environ.get('MULTI_USER_MODE', 'false').lower() == 'true': # reserve for every user in the database
+            from Reserve import batch, bookings
+            batch.main()
+            bookings.main() # only does something with BOOKING_UPGRADES or CANCEL_STALE_BOOKINGS
+        elif os.environ.get('ASYNC_PIPELINE', 'false').lower() == 'true':
+            from Reserve import asyncreserve
+            asyncreserve.main()
+        else:
+            from Reserve import reserve
+            reserve.main()
+    finally:
+        metrics.finishRun()
     utc_timestamp = datetime.datetime.utcnow().replace(
         tzinfo=datetime.timezone.utc).isoformat()
     logging.info('Python timer trigger function done at %s' % utc_timestamp)
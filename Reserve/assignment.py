@@ -0,0 +1,239 @@
+import os
+
+from Types import AvailabilityIndex, Room, ReservationRequest
+
+# how long the exact search can take for one group of requests that compete for the same slots before it settles for the best it found
+ASSIGNMENT_SEARCH_SECONDS = float(os.environ.get('ASSIGNMENT_SEARCH_SECONDS', 2))
+
+def roomPriorityCost(request: ReservationRequest.ReservationRequest, room: Room.Room, startMinutes: int):
+  '''
+  Default cost, a lower priority number is a better room and an earlier start breaks ties
+  '''
+  return (room.priority, startMinutes)
+
+class Candidate:
+  '''
+  One window of back to back slots in a room that a request could get
+  '''
+
+  def __init__(self, room: Room.Room, index: int, cells: list[tuple[int, int]], cost):
+    self.room = room
+    self.index = index # index of the first slot of the window in the room's slots
+    self.cells = cells # (eid, start minutes) of every slot in the window
+    self.cost = cost
+
+  def __repr__(self):
+    return f"Candidate(room='{self.room.name}', index={self.index}, cost={self.cost})"
+
+class RoomAssigner:
+  '''
+  Hands out the rooms of one day to the requests that want that day
+
+  Requests are placed one at a time, shortest and then most constrained first, each trying its windows from cheapest to most expensive.
+  When every window a request wants is blocked by a single other request, that request is moved to one of its other
+  windows if it can be (an augmenting path, like bipartite matching).
+  That can't get past a window that's blocked by two requests at once, so when some request is still left out, the requests
+  that compete with it for slots are solved again exactly (an integer program, see _exact) for the most of them that fit.
+  After that, requests are moved to cheaper windows that are still free.
+  The number of requests that get a room is the most possible unless a solve ran out of ASSIGNMENT_SEARCH_SECONDS (proven is
+  False then). scipy is only imported when a request is left out
+  '''
+
+  def __init__(self, requests: list[ReservationRequest.ReservationRequest], availabilityIndex: AvailabilityIndex.AvailabilityIndex, rooms: list[Room.Room] = Room.LIB_ALL, cost = roomPriorityCost, findWindows = None):
+    self.requests = requests
+    self.availabilityIndex = availabilityIndex
+    self.rooms = rooms
+    self.cost = cost
+    self.findWindows = findWindows if findWindows is not None else self._roomWindows
+    self._windows = {} # (startTime, endTime, slots30mins) -> every (room, index, cells, start minutes) window for requests like that
+    self.candidates: list[list[Candidate]] = [self._candidatesFor(request) for request in requests]
+    self.assigned: list[Candidate] = [None] * len(requests)
+    self.occupied: dict[tuple[int, int], int] = {} # (eid, start minutes) -> index of the request using the slot
+    self.proven = True # False when an exact search was cut off
+
+  def _candidatesFor(self, request: ReservationRequest.ReservationRequest) -> list[Candidate]:
+    shape = (request.startTime, request.endTime, request.slots30mins)
+    if shape not in self._windows: # requests with the same times have the same windows, only the cost can be different
+      windows = []
+      for room, index in self.findWindows(request.startMinutes, request.endMinutes, request.slots30mins):
+        startMinutes = self.availabilityIndex.startMinutes(room.eid)
+        windows.append((room, index, [(room.eid, minutes) for minutes in startMinutes[index:index+request.slots30mins]], startMinutes[index]))
+      self._windows[shape] = windows
+    candidates = [Candidate(room, index, cells, self.cost(request, room, start)) for room, index, cells, start in self._windows[shape]]
+    for rank, candidate in enumerate(candidates):
+      candidate.rank = rank # place in the shape's window list, how _exact matches up windows of requests with the same shape
+    candidates.sort(key=lambda candidate: candidate.cost)
+    return candidates
+
+  def _roomWindows(self, fromMinutes: int, toMinutes: int, slotCount: int) -> list[tuple[Room.Room, int]]:
+    # the loop search, one room at a time
+    return [(room, index) for room in self.rooms for index in self.availabilityIndex.windows(room.eid, fromMinutes, toMinutes, slotCount)]
+
+  def _place(self, requestIndex: int, candidate: Candidate):
+    self.assigned[requestIndex] = candidate
+    for cell in candidate.cells:
+      self.occupied[cell] = requestIndex
+
+  def _remove(self, requestIndex: int):
+    for cell in self.assigned[requestIndex].cells:
+      del self.occupied[cell]
+    self.assigned[requestIndex] = None
+
+  def _blockers(self, candidate: Candidate) -> set[int]:
+    return {self.occupied[cell] for cell in candidate.cells if cell in self.occupied}
+
+  def _augment(self, requestIndex: int, visited: set[int]) -> bool:
+    # first try any window that is free right now
+    for candidate in self.candidates[requestIndex]:
+      if len(self._blockers(candidate)) == 0:
+        self._place(requestIndex, candidate)
+        return True
+    # then try pushing a single request that is in the way somewhere else
+    for candidate in self.candidates[requestIndex]:
+      blockers = self._blockers(candidate)
+      if len(blockers) != 1:
+        continue
+      blocker = blockers.pop()
+      if blocker in visited:
+        continue
+      visited.add(blocker)
+      previous = self.assigned[blocker]
+      self._remove(blocker)
+      self._place(requestIndex, candidate)
+      if self._augment(blocker, visited):
+        return True
+      self._remove(requestIndex) # couldn't move it, put things back how they were
+      self._place(blocker, previous)
+    return False
+
+  def _shape(self, requestIndex: int):
+    request = self.requests[requestIndex]
+    return (request.startTime, request.endTime, request.slots30mins)
+
+  def _components(self) -> list[list[int]]:
+    # requests are in the same component when some of their windows share a slot, components can't affect each other
+    parent = list(range(len(self.requests)))
+
+    def find(requestIndex: int):
+      while parent[requestIndex] != requestIndex:
+        parent[requestIndex] = parent[parent[requestIndex]]
+        requestIndex = parent[requestIndex]
+      return requestIndex
+
+    cellOwners: dict[tuple[int, int], int] = {}
+    for requestIndex, candidates in enumerate(self.candidates):
+      for candidate in candidates:
+        for cell in candidate.cells:
+          owner = cellOwners.setdefault(cell, requestIndex)
+          parent[find(owner)] = find(requestIndex)
+    components: dict[int, list[int]] = {}
+    for requestIndex in range(len(self.requests)):
+      if len(self.candidates[requestIndex]) > 0:
+        components.setdefault(find(requestIndex), []).append(requestIndex)
+    return list(components.values())
+
+  def _exact(self, requestIndexes: list[int], timeLimit: float = ASSIGNMENT_SEARCH_SECONDS) -> bool:
+    '''
+    Solves the requests as an integer program (scipy's milp) for the most of them that fit, and among those the cheapest
+    Requests with the same times and the same cost for every window can swap windows, so they're grouped and there's one
+    0/1 variable per window of every group, a group can't use more windows than it has requests and every slot can be in
+    at most one chosen window. A cost that depends on more than the times (a user's priority...) splits the groups up,
+    down to one per request.
+    The cost only has to sort, so it goes in as its rank among the costs, small enough that one more request always wins.
+    The answer replaces the current one unless it fits fewer requests (when the time limit cut it off)
+
+    Returns: True if the solver proved its answer is the best
+    '''
+    import numpy
+    from scipy.optimize import Bounds, LinearConstraint, milp
+    from scipy.sparse import coo_array
+
+    groups: dict[tuple, list[int]] = {} # (shape, cost of every window in rank order) -> requests
+    for requestIndex in requestIndexes:
+      costs = tuple(candidate.cost for candidate in sorted(self.candidates[requestIndex], key=lambda candidate: candidate.rank))
+      groups.setdefault((self._shape(requestIndex), costs), []).append(requestIndex)
+    variables = [] # (group, candidate of the group's first request)
+    for group, members in groups.items():
+      variables += [(group, candidate) for candidate in self.candidates[members[0]]]
+    costRanks = {cost: rank for rank, cost in enumerate(sorted({candidate.cost for _, candidate in variables}))}
+    penalty = 1 / (len(costRanks) * (len(requestIndexes) + 1))
+    objective = numpy.array([-(1 - costRanks[candidate.cost] * penalty) for _, candidate in variables])
+
+    rows, columns = [], []
+    groupRows = {group: row for row, group in enumerate(groups)}
+    cellRows: dict[tuple[int, int], int] = {}
+    for column, (group, candidate) in enumerate(variables):
+      rows.append(groupRows[group])
+      columns.append(column)
+      for cell in candidate.cells:
+        rows.append(cellRows.setdefault(cell, len(groups) + len(cellRows)))
+        columns.append(column)
+    matrix = coo_array((numpy.ones(len(rows)), (rows, columns)), shape=(len(groups) + len(cellRows), len(variables)))
+    upper = numpy.array([len(members) for members in groups.values()] + [1] * len(cellRows))
+    result = milp(objective, integrality=numpy.ones(len(variables)), bounds=Bounds(0, 1),
+                  constraints=LinearConstraint(matrix, -numpy.inf, upper), options={'time_limit': timeLimit})
+    if result.x is None:
+      return False
+
+    chosen: dict[tuple, list[int]] = {} # group -> ranks of its chosen windows
+    for column in numpy.flatnonzero(result.x > 0.5).tolist():
+      group, candidate = variables[column]
+      chosen.setdefault(group, []).append(candidate.rank)
+    if sum(len(ranks) for ranks in chosen.values()) >= sum(self.assigned[requestIndex] is not None for requestIndex in requestIndexes):
+      for requestIndex in requestIndexes:
+        if self.assigned[requestIndex] is not None:
+          self._remove(requestIndex)
+      for group, members in groups.items():
+        for requestIndex, rank in zip(members, chosen.get(group, [])):
+          self._place(requestIndex, next(candidate for candidate in self.candidates[requestIndex] if candidate.rank == rank))
+    return result.status == 0
+
+  def _improve(self):
+    improved = True
+    while improved:
+      improved = False
+      for requestIndex, current in enumerate(self.assigned):
+        if current is None:
+          continue
+        for candidate in self.candidates[requestIndex]:
+          if candidate.cost >= current.cost:
+            break
+          if self._blockers(candidate) <= {requestIndex}:
+            self._remove(requestIndex)
+            self._place(requestIndex, candidate)
+            improved = True
+            break
+
+  def solve(self) -> list[Candidate]:
+    '''
+    Returns: The window given to every request, in the same order as the requests (None for the ones that didn't get a room)
+    '''
+    # short requests use up the least room time so they go first, then the ones with the fewest windows to pick from
+    order = sorted(range(len(self.requests)), key=lambda requestIndex: (self.requests[requestIndex].slots30mins, len(self.candidates[requestIndex])))
+    failedShapes = set() # nothing changes when a request can't be placed, so an identical request can't be placed either
+    for requestIndex in order:
+      request = self.requests[requestIndex]
+      shape = (request.startTime, request.endTime, request.slots30mins)
+      if len(self.candidates[requestIndex]) == 0 or shape in failedShapes:
+        continue
+      if self._augment(requestIndex, {requestIndex}):
+        failedShapes.clear()
+      else:
+        failedShapes.add(shape)
+    for component in self._components():
+      if any(self.assigned[requestIndex] is None for requestIndex in component) and len(component) > 1:
+        self.proven = self._exact(component) and self.proven
+    self._improve()
+    return list(self.assigned)
+
+def assignRooms(requests: list[ReservationRequest.ReservationRequest], availabilityIndex: AvailabilityIndex.AvailabilityIndex, rooms: list[Room.Room] = Room.LIB_ALL, cost = roomPriorityCost, findWindows = None) -> list[Candidate]:
+  '''
+  Finds the assignment of rooms to the requests for one day that satisfies the most requests and then has the lowest cost
+  (see RoomAssigner for when the most isn't guaranteed)
+  cost is called with (request, room, start minutes of the window) and can return anything that sorts
+  findWindows(from minutes, to minutes, slots) can hand over the day's (room, slot index) windows from somewhere else,
+  like AvailabilityMatrix.windows, instead of going through the rooms one at a time
+
+  Returns: The Candidate window for every request, or None if it couldn't get a room
+  '''
+  return RoomAssigner(requests, availabilityIndex, rooms, cost, findWindows).solve()
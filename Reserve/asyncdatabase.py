@@ -0,0 +1,86 @@
+'''
+The days and availability_fingerprints queries of database.py for the asyncio pipeline, on an asyncpg pool
+'''
+import logging
+from datetime import date
+
+import asyncpg
+
+from Reserve import database
+
+async def createPool():
+  '''
+  Makes a pool with the same settings and size as database.getPool, it belongs to the event loop it was made in
+  '''
+  return await asyncpg.create_pool(min_size=database.DB_POOL_MIN, max_size=database.DB_POOL_MAX, **database.connectionSettings())
+
+async def addDays(days_from_epoch: list[int], pool) -> bool:
+  '''
+  Adds all the days in one statement, days that are already in the table are skipped
+  '''
+  if len(days_from_epoch) == 0:
+    return True
+  try:
+    await pool.execute("INSERT INTO days(days_from_epoch) SELECT unnest($1::integer[]) ON CONFLICT DO NOTHING", list(days_from_epoch))
+  except asyncpg.PostgresError as e:
+    logging.info(f"SQL insertion failed!!! {e}")
+    return False
+  return True
+
+async def findDays(days_from_epoch: list[int], pool) -> set[int]:
+  '''
+  Returns: The days that are in the table
+  '''
+  if len(days_from_epoch) == 0:
+    return set()
+  try:
+    rows = await pool.fetch("SELECT days_from_epoch FROM days WHERE days_from_epoch = ANY($1::integer[])", list(days_from_epoch))
+  except asyncpg.PostgresError as e:
+    logging.info(f"SQL selection failed!!! {e}")
+    return set()
+  return {row[0] for row in rows}
+
+_fingerprintTableReady = False
+
+async def _ensureFingerprintTable(pool):
+  global _fingerprintTableReady
+  if _fingerprintTableReady:
+    return
+  await pool.execute("CREATE TABLE IF NOT EXISTS availability_fingerprints(lid integer NOT NULL, date date NOT NULL, fingerprint varchar(64) NOT NULL, PRIMARY KEY (lid, date))")
+  _fingerprintTableReady = True
+
+async def findFingerprints(lid: int, dates: list[str], pool) -> dict[str, str]:
+  '''
+  Returns: A dictionary of date (YYYY-MM-DD) -> fingerprint for the dates the last run saved one for
+  '''
+  if len(dates) == 0:
+    return {}
+  try:
+    await _ensureFingerprintTable(pool)
+    rows = await pool.fetch("SELECT to_char(date, 'YYYY-MM-DD'), fingerprint FROM availability_fingerprints WHERE lid = $1 AND date = ANY($2::date[])",
+                            lid, [date.fromisoformat(dateString) for dateString in dates])
+  except asyncpg.PostgresError as e:
+    logging.info(f"SQL selection failed!!! {e}")
+    return {}
+  return {row[0]: row[1] for row in rows}
+
+async def saveFingerprints(lid: int, fingerprints: dict[str, str], pool) -> bool:
+  '''
+  Saves every date's fingerprint in one transaction, replacing the old ones, and forgets the ones for days that are over
+  '''
+  if len(fingerprints) == 0:
+    return True
+  try:
+    await _ensureFingerprintTable(pool)
+    async with pool.acquire() as conn:
+      async with conn.transaction():
+        await conn.execute(
+          "INSERT INTO availability_fingerprints(lid, date, fingerprint) SELECT $1, unnest($2::date[]), unnest($3::varchar[]) "
+          "ON CONFLICT (lid, date) DO UPDATE SET fingerprint = EXCLUDED.fingerprint",
+          lid, [date.fromisoformat(dateString) for dateString in fingerprints], list(fingerprints.values())
+        )
+        await conn.execute("DELETE FROM availability_fingerprints WHERE date < CURRENT_DATE")
+  except asyncpg.PostgresError as e:
+    logging.info(f"SQL insertion failed!!! {e}")
+    return False
+  return True
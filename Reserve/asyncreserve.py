@@ -0,0 +1,265 @@
+'''
+reserve.main's pipeline on asyncio: httpx for libcal and the login pages, asyncpg for the days table
+
+Every availability page is downloaded at the same time (at most MAX_CONCURRENT_FETCHES per library) and every user's
+login and checkouts run as their own task. A user's own checkouts still go one after the other with CHECKOUT_SPACING
+between them, and at most CHECKOUT_MAX_CONCURRENCY checkouts run at the same time. All of it shares one connection pool
+and goes through client.sendAsync, so the rate limit and circuit breakers are the same as the threaded run.
+Whatever is still running after ASYNC_RUN_TIMEOUT seconds is cancelled and counted as failed, the next run picks it up.
+A flow whose next spacing wait would end after the timeout or take its waiting past CHECKOUT_MAX_WAIT in total stops there
+instead, its other reservations are left for the next run. When a user can check out next is kept in the session store like the CheckoutScheduler does.
+
+The timer calls main(), which runs mainAsync() on a fresh event loop. The batch run uses checkoutPlans.
+CART_BATCHING isn't used here, every reservation gets its own cart.
+'''
+import asyncio
+import logging
+import os
+from datetime import datetime
+from time import monotonic, time
+
+from Reserve import asyncdatabase, availability, cache, client, history, metrics, reserve, scheduler, sessions
+from Types import AvailabilityMatrix, RoomAvailability, Room
+
+# how long the whole checkout stage can take before it's cancelled, keep it under the function timeout
+ASYNC_RUN_TIMEOUT = float(os.environ.get('ASYNC_RUN_TIMEOUT', 240))
+
+class CheckoutTimeout(Exception):
+  '''
+  Set on the reservations that didn't get checked out before ASYNC_RUN_TIMEOUT
+  '''
+
+async def fetchAvailability(asyncClient, dateString: str, LID: int) -> list[RoomAvailability.RoomAvailability]:
+  # parsed while it downloads, like RoomAvailability.getAvailabilityArray
+  url = f"{RoomAvailability.LIBCAL_URL}/r/accessible/availability?lid={LID}&date={dateString}"
+  parser = RoomAvailability.AvailabilityParser(LID)
+  with metrics.span('fetch'):
+    metrics.count('httpRequests')
+    res = await client.sendAsync(asyncClient, 'GET', url, stream=True)
+    try:
+      res.raise_for_status() # an error page has no checkboxes, don't let it pass for a day with nothing free
+      async for chunk in res.aiter_text(16384):
+        parser.feed(chunk)
+      parser.close()
+    finally:
+      await res.aclose()
+  history.record(LID, dateString, parser.found)
+  return parser.found
+
+async def getLibraryAvailabilityMap(asyncClient, keys: list[tuple[int, str]], runCache: dict, sharedCache: cache.AvailabilityCache = cache.SHARED_AVAILABILITY_CACHE):
+  '''
+  availability.getLibraryAvailabilityMap with every missing (lid, date) downloaded at the same time, at most
+  MAX_CONCURRENT_FETCHES at once per library
+
+  Returns: A dictionary of (lid, date string (YYYY-MM-DD)) -> list of RoomAvailability for that day
+  '''
+  availabilityMap = {}
+  missingKeys: list[tuple[int, str]] = []
+  for key in dict.fromkeys(keys):
+    cached = runCache.get(key)
+    if cached is None and sharedCache is not None:
+      cached = sharedCache.get(key)
+    if cached is not None:
+      runCache[key] = cached
+      availabilityMap[key] = cached
+    else:
+      missingKeys.append(key)
+  logging.info(f"Availability cache: {len(availabilityMap)} hits, {len(missingKeys)} misses")
+  metrics.count('availabilityMisses', len(missingKeys))
+
+  limits = {lid: asyncio.Semaphore(availability.MAX_CONCURRENT_FETCHES) for lid, _ in missingKeys}
+
+  async def fetch(key: tuple[int, str]):
+    async with limits[key[0]]:
+      return await fetchAvailability(asyncClient, key[1], key[0])
+
+  for key, array in zip(missingKeys, await asyncio.gather(*[fetch(key) for key in missingKeys])):
+    runCache[key] = array
+    if sharedCache is not None:
+      sharedCache.put(key, array)
+    availabilityMap[key] = array
+  return availabilityMap
+
+async def getAuth(asyncClient, redirectHtml: str, username: str = None, password: str = None):
+  '''
+  reserve.getAuth on the user's AsyncClient, the login cookies end up in its jar
+  '''
+  url, params = reserve.authRedirectRequest(redirectHtml)
+  res = await client.sendAsync(asyncClient, 'GET', url, params=params)
+  res.raise_for_status()
+  url, data = reserve.authLoginRequest(res.text, username, password)
+  res = await client.sendAsync(asyncClient, 'POST', url, data=data)
+  res.raise_for_status()
+  url, data = reserve.authLinkRequest(res.text)
+  res = await client.sendAsync(asyncClient, 'POST', url, data=data)
+  res.raise_for_status()
+
+async def checkoutReservation(asyncClient, session, reservationSlots: list[RoomAvailability.RoomAvailability], username: str = None, password: str = None, formBase: dict = None):
+  '''
+  reserve.checkoutReservation on the user's AsyncClient, session is the requests session whose cookie jar the client uses
+
+  Returns: The response from the checkout request
+  '''
+  with metrics.span('createcart'):
+    createCartRes = await client.sendAsync(asyncClient, 'POST', f'{reserve.CONCORDIA_LIBCAL_URL}/ajax/space/createcart', data=reserve.createFormForRequest(reservationSlots, formBase))
+  with metrics.span('authcheck'):
+    authCheckRes = await client.sendAsync(asyncClient, 'GET', reserve.cartRedirectUrl(createCartRes))
+  authCheckRes.raise_for_status()
+  metrics.count('httpRequests', 2)
+
+  authRequired = bool(reserve.LIBCAL_AUTH_REGEX_CHECK.findall(authCheckRes.text))
+  if authRequired:
+    with metrics.span('auth'):
+      await getAuth(asyncClient, authCheckRes.text, username, password)
+    metrics.count('httpRequests', sessions.AUTH_ROUND_TRIPS)
+  sessions.recordAuthCheck(session, authRequired)
+
+  with metrics.span('checkout'):
+    confirmationRes = await client.sendAsync(asyncClient, 'POST', f"{reserve.CONCORDIA_LIBCAL_URL}/ajax/equipment/checkout", data=reserve.checkoutForm())
+  reserve.checkConfirmation(confirmationRes)
+  return confirmationRes
+
+async def checkoutUser(transport, username: str, password: str, reservations: list[list[RoomAvailability.RoomAvailability]], results: list, userSlots: asyncio.Semaphore, formBase: dict, deadline: float = None):
+  '''
+  One user's flow: their stored cookies, then every reservation in turn with CHECKOUT_SPACING between the ones that booked something
+  results gets the confirmation response or the exception of every reservation as soon as it's done, so a cancelled flow keeps what it finished
+  The flow stops before a spacing wait that would end after deadline (the event loop's time) or take its waiting past
+  CHECKOUT_MAX_WAIT in total, the rest get scheduler.CheckoutDeferred
+  '''
+  session = sessions.loadSession(username)
+  asyncClient = client.createAsyncClient(transport, session.cookies, reserve.HEADERS)
+  nextAt = sessions.loadNextCheckout(username) # set by the last checkout, in this run or an earlier one
+  waited = 0
+  try:
+    for index, reservationSlots in enumerate(reservations):
+      wait = nextAt - time()
+      if wait > 0:
+        if waited + wait > scheduler.CHECKOUT_MAX_WAIT or (deadline is not None and asyncio.get_running_loop().time() + wait >= deadline):
+          logging.info(f"Leaving {len(reservations) - index} reservations of {username} for the next run, their turn is {wait:.0f}s away")
+          metrics.count('checkoutsDeferred', len(reservations) - index)
+          results[index:] = [scheduler.CheckoutDeferred('left for the next run')] * (len(reservations) - index)
+          break
+        waited += wait
+        await asyncio.sleep(wait) # let the confirmation email go out before the next one, without holding a slot
+      try:
+        async with userSlots:
+          results[index] = await checkoutReservation(asyncClient, session, reservationSlots, username, password, formBase)
+      except Exception as e:
+        logging.info(f"Checkout failed: {e!r}")
+        results[index] = e
+      if scheduler.CHECKOUT_SPACING > 0 and not isinstance(results[index], Exception) and not reserve.isAlreadyReserved(results[index]):
+        nextAt = time() + scheduler.CHECKOUT_SPACING
+        sessions.saveNextCheckout(username, nextAt)
+  finally:
+    sessions.saveSession(username, session)
+
+async def checkoutUsers(flows: list[tuple[str, str, list[list[RoomAvailability.RoomAvailability]]]], timeout: float = ASYNC_RUN_TIMEOUT) -> list[list]:
+  '''
+  Runs every (username, password, reservations) flow as its own task over one connection pool,
+  cancelling whatever isn't done after timeout seconds
+
+  Returns: For every flow, the confirmation response or exception of each of its reservations
+  '''
+  results = [[CheckoutTimeout('cancelled after ASYNC_RUN_TIMEOUT')] * len(reservations) for _, _, reservations in flows]
+  if len(flows) == 0:
+    return results
+  transport = client.createAsyncTransport(scheduler.CHECKOUT_MAX_CONCURRENCY)
+  userSlots = asyncio.Semaphore(max(1, scheduler.CHECKOUT_MAX_CONCURRENCY))
+  formBase = reserve.createFormBase()
+  deadline = asyncio.get_running_loop().time() + timeout
+  tasks = [asyncio.create_task(checkoutUser(transport, username, password, reservations, flowResults, userSlots, formBase, deadline))
+           for (username, password, reservations), flowResults in zip(flows, results)]
+  try:
+    _, pending = await asyncio.wait(tasks, timeout=timeout)
+    if len(pending) > 0:
+      logging.info(f"{len(pending)} of {len(tasks)} users weren't done after {timeout}s, cancelling them")
+      metrics.count('checkoutsCancelled', sum(isinstance(result, CheckoutTimeout) for flowResults in results for result in flowResults))
+      for task in pending:
+        task.cancel()
+      await asyncio.gather(*pending, return_exceptions=True)
+  finally:
+    await transport.aclose()
+  sessions.logMetrics()
+  return results
+
+async def mainAsync():
+  '''
+  The same run as reserve.main: days already in the database are left out, every day is downloaded at once,
+  the rooms are matched and every reservation is checked out, and the days that went through are saved
+  '''
+  plannedDates = reserve.plannedReservationDates()
+  pool = await asyncdatabase.createPool()
+  try:
+    with metrics.span('db filter'):
+      reservedDays = await asyncdatabase.findDays([reserve.daysSinceEpoch(date) for _, date in plannedDates], pool)
+    plannedDates = [(day, date) for day, date in plannedDates if reserve.daysSinceEpoch(date) not in reservedDays]
+    if len(plannedDates) == 0:
+      logging.info('Theres nothing to reserve! Quiting...')
+      return
+
+    transport = client.createAsyncTransport(availability.MAX_CONCURRENT_FETCHES)
+    try:
+      availabilityMap = await getLibraryAvailabilityMap(client.createAsyncClient(transport), [(reserve.LID, reserve.createDateStringsForRequest(date)) for _, date in plannedDates], runCache={}, sharedCache=None)
+    finally:
+      await transport.aclose()
+    availabilityMap = {date: array for (_, date), array in availabilityMap.items()}
+
+    fingerprints = {}
+    if reserve.INCREMENTAL_MODE:
+      fingerprints = {start: availability.gridFingerprint(availabilityArray, [day for day, date in plannedDates if reserve.createDateStringsForRequest(date) == start]) for start, availabilityArray in availabilityMap.items()}
+      with metrics.span('db filter'):
+        previousFingerprints = await asyncdatabase.findFingerprints(reserve.LID, list(fingerprints), pool)
+      unchangedDates = {start for start, fingerprint in fingerprints.items() if previousFingerprints.get(start) == fingerprint}
+      logging.info(f"{len(unchangedDates)} of {len(fingerprints)} days haven't changed since the last run, skipping them")
+      metrics.count('unchangedDays', len(unchangedDates))
+      plannedDates = [(day, date) for day, date in plannedDates if reserve.createDateStringsForRequest(date) not in unchangedDates]
+      availabilityMap = {start: availabilityArray for start, availabilityArray in availabilityMap.items() if start not in unchangedDates}
+
+    indexMap = reserve.indexAvailabilityMap(availabilityMap)
+    reservations: list[list[RoomAvailability.RoomAvailability]] = []
+    with metrics.span('match'):
+      matrix = AvailabilityMatrix.AvailabilityMatrix(indexMap, Room.LIB_FLOOR_3) if len(plannedDates) >= reserve.VECTORIZED_SEARCH_MIN else None
+      for day, date in plannedDates:
+        start = reserve.createDateStringsForRequest(date)
+        found = reserve.findRoom(indexMap[start], day, Room.LIB_FLOOR_3, matrix, start)
+        if found is None:
+          logging.info(f"No possible slots found for {datetime.ctime(date)}")
+          continue
+        room, slots = found
+        logging.info(f"## We have a room!! {room.name} is available between {day.startTime} and {day.endTime} on {datetime.ctime(date)}")
+        reservations.append(slots)
+
+    results = (await checkoutUsers([(reserve.CONCORDIA_USERNAME, reserve.CONCORDIA_PASSWORD, reservations)]))[0] if len(reservations) > 0 else []
+    booked = [reservationSlots for reservationSlots, result in zip(reservations, results) if not isinstance(result, Exception)]
+    failedDates = {reserve.createDateStringsForRequest(reserve.dateFromReservation(reservationSlots)) for reservationSlots, result in zip(reservations, results) if isinstance(result, Exception)}
+    with metrics.span('db write'):
+      await asyncdatabase.addDays([reserve.daysSinceEpoch(reserve.dateFromReservation(reservationSlots)) for reservationSlots in booked], pool)
+      await asyncdatabase.saveFingerprints(reserve.LID, {start: fingerprint for start, fingerprint in fingerprints.items() if start not in failedDates}, pool)
+  finally:
+    await pool.close()
+
+def main():
+  # what the timer calls, it isn't async
+  asyncio.run(mainAsync())
+
+def checkoutPlans(plans: list) -> list:
+  '''
+  batch.checkoutPlans on asyncio, a task for every user with all of their plans
+
+  Returns: The plans that went through
+  '''
+  plansByUser: dict[int, list] = {}
+  for plan in plans:
+    plansByUser.setdefault(plan.user.id, []).append(plan)
+  flows = [(userPlans[0].user.username, userPlans[0].user.password, [plan.slots for plan in userPlans]) for userPlans in plansByUser.values()]
+  started = monotonic()
+  results = asyncio.run(checkoutUsers(flows))
+  completed = []
+  for userPlans, flowResults in zip(plansByUser.values(), results):
+    for plan, result in zip(userPlans, flowResults):
+      if not isinstance(result, Exception):
+        plan.bookingId = reserve.bookingIdFromConfirmation(result)
+        completed.append(plan)
+      plan.deferred = isinstance(result, scheduler.CheckoutDeferred)
+  logging.info(f"Checked out {len(completed)} of {len(plans)} plans for {len(flows)} users in {monotonic() - started:.1f}s")
+  return completed
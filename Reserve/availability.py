@@ -0,0 +1,161 @@
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from Reserve import cache, client, history, metrics
+from Types import AvailabilityIndex, Library, Room, RoomAvailability
+
+# how many availability pages we download at the same time for each library, libcal gets grumpy if this is too high
+MAX_CONCURRENT_FETCHES = int(os.environ.get('AVAILABILITY_MAX_CONCURRENCY', 4))
+# every library and space group to look for rooms in, as lid:gid pairs separated by commas
+LIBRARIES = Library.parseLibraries(os.environ.get('LIBCAL_LIBRARIES', f"{Room.LID}:{Room.GID}"))
+
+def createPooledSession(poolSize = MAX_CONCURRENT_FETCHES):
+  '''
+  Makes a session that keeps its connections alive so every fetch in a run reuses the same sockets, see client.createSession
+  '''
+  return client.createSession(poolSize)
+
+def gridFingerprint(availabilityArray: list[RoomAvailability.RoomAvailability], reservationRequests: list = ()):
+  '''
+  A short hash of a day's grid made from every slot's data-crc checksum, plus the requests that want the day
+  so changing the reservation times also counts as a change
+  '''
+  digest = hashlib.sha1()
+  for checksum in sorted(str(slot.checksum) for slot in availabilityArray):
+    digest.update(checksum.encode())
+    digest.update(b'|')
+  for request in reservationRequests:
+    digest.update(repr(request).encode())
+  return digest.hexdigest()
+
+def fetchAvailability(dateString: str, LID: int, session: requests.Session):
+  # the page is parsed while it downloads, so the fetch stage covers both
+  with metrics.span('fetch'):
+    metrics.count('httpRequests')
+    availabilityArray = RoomAvailability.getAvailabilityArray(dateString, LID, session)
+  history.record(LID, dateString, availabilityArray)
+  return availabilityArray
+
+def getLibraryAvailabilityMap(keys: list[tuple[int, str]], maxConcurrency = MAX_CONCURRENT_FETCHES, session: requests.Session = None,
+                              runCache: dict = None, sharedCache: cache.AvailabilityCache = cache.SHARED_AVAILABILITY_CACHE):
+  '''
+  Downloads the availability grid for every distinct (lid, date) in keys, at most maxConcurrency at a time per library
+  All the libraries go through the same pool, so adding one doesn't add a whole extra round of downloads
+  Grids already in runCache (this run) or sharedCache (recent runs) are reused instead of downloaded again,
+  both caches are keyed by (lid, date) and every freshly downloaded grid gets added to both
+
+  Returns: A dictionary of (lid, date string (YYYY-MM-DD)) -> list of RoomAvailability for that day
+  '''
+  if runCache is None:
+    runCache = {}
+  uniqueKeys = list(dict.fromkeys(keys)) # keeps the order but drops days we already asked for
+  runHits = len(keys) - len(uniqueKeys)
+  sharedHits = 0
+
+  availabilityMap = {}
+  missingKeys: list[tuple[int, str]] = []
+  for key in uniqueKeys:
+    if key in runCache:
+      runHits += 1
+      availabilityMap[key] = runCache[key]
+      continue
+    cached = sharedCache.get(key) if sharedCache is not None else None
+    if cached is not None:
+      sharedHits += 1
+      runCache[key] = cached
+      availabilityMap[key] = cached
+      continue
+    missingKeys.append(key)
+
+  logging.info(f"Availability cache: {runHits} run hits, {sharedHits} shared hits, {len(missingKeys)} misses")
+  metrics.count('availabilityRunHits', runHits)
+  metrics.count('availabilitySharedHits', sharedHits)
+  metrics.count('availabilityMisses', len(missingKeys))
+  if len(missingKeys) == 0:
+    return availabilityMap
+
+  workers = max(1, min(maxConcurrency * len({lid for lid, _ in missingKeys}), len(missingKeys)))
+  if session is None:
+    session = createPooledSession(workers)
+
+  logging.info(f"Fetching availability for {len(missingKeys)} days in {len({lid for lid, _ in missingKeys})} libraries with {workers} workers")
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    arrays = executor.map(lambda key: fetchAvailability(key[1], key[0], session), missingKeys)
+    for key, array in zip(missingKeys, arrays):
+      runCache[key] = array
+      if sharedCache is not None:
+        sharedCache.put(key, array)
+      availabilityMap[key] = array
+
+  return availabilityMap
+
+def getAvailabilityMap(dateStrings: list[str], LID = Room.LID, maxConcurrency = MAX_CONCURRENT_FETCHES, session: requests.Session = None,
+                       runCache: dict = None, sharedCache: cache.AvailabilityCache = cache.SHARED_AVAILABILITY_CACHE):
+  '''
+  getLibraryAvailabilityMap for a single library
+
+  Returns: A dictionary of date string (YYYY-MM-DD) -> list of RoomAvailability for that day
+  '''
+  availabilityMap = getLibraryAvailabilityMap([(LID, date) for date in dateStrings], maxConcurrency, session, runCache, sharedCache)
+  return {date: array for (_, date), array in availabilityMap.items()}
+
+def mergeLibraries(availabilityMap: dict[tuple[int, str], list[RoomAvailability.RoomAvailability]]):
+  '''
+  Puts every library's slots for a day together, room eids are unique across libcal so they can share one index
+
+  Returns: A dictionary of date string (YYYY-MM-DD) -> list of RoomAvailability for that day in every library
+  '''
+  merged: dict[str, list[RoomAvailability.RoomAvailability]] = {}
+  for (_, date), array in availabilityMap.items():
+    merged.setdefault(date, []).extend(array)
+  return merged
+
+class IndexedDay:
+  '''
+  A day's availability ready to be queried, with the names of its rooms and the fingerprint of its grid
+  '''
+  __slots__ = ('date', 'lid', 'index', 'roomNames', 'fingerprint')
+
+  def __init__(self, date: str, lid: int, index: AvailabilityIndex.AvailabilityIndex, roomNames: dict[int, str], fingerprint: str):
+    self.date = date
+    self.lid = lid
+    self.index = index
+    self.roomNames = roomNames
+    self.fingerprint = fingerprint
+
+  def roomName(self, eid: int) -> str:
+    return self.roomNames.get(eid, str(eid))
+
+# the indexed days the api answers from, every date is downloaded and indexed at most once per AVAILABILITY_CACHE_TTL
+INDEXED_DAYS = cache.AvailabilityCache()
+_indexSession: requests.Session = None
+_indexSessionLock = threading.Lock()
+
+def getIndexedDay(dateString: str, LID = Room.LID) -> tuple[IndexedDay, float]:
+  '''
+  Gets the day's IndexedDay from INDEXED_DAYS, downloading the page when it isn't there
+  Requests for the same day that come in while it's downloading wait for that download instead of making their own,
+  the fresh grid also goes in the shared cache so reserve.test() in the same worker can use it
+
+  Returns: (the IndexedDay, wall clock time it was downloaded)
+  '''
+  global _indexSession
+  with _indexSessionLock:
+    if _indexSession is None:
+      _indexSession = createPooledSession()
+
+  def load():
+    roomNames: dict[int, str] = {}
+    with metrics.span('fetch'):
+      metrics.count('httpRequests')
+      availabilityArray = RoomAvailability.getAvailabilityArray(dateString, LID, _indexSession, roomNames)
+    cache.SHARED_AVAILABILITY_CACHE.put((LID, dateString), availabilityArray)
+    history.record(LID, dateString, availabilityArray)
+    return IndexedDay(dateString, LID, AvailabilityIndex.AvailabilityIndex(availabilityArray), roomNames, gridFingerprint(availabilityArray))
+
+  return INDEXED_DAYS.getOrLoad((LID, dateString), load)
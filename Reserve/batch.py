@@ -0,0 +1,210 @@
+import logging
+from datetime import datetime
+
+from sqlalchemy.orm import Session
+
+import db
+from Reserve import assignment, availability, catalogue, history, metrics, reserve, scheduler, sessions
+from Types import AvailabilityIndex, AvailabilityMatrix, Room, RoomAvailability, ReservationRequest
+
+class BatchUser:
+  '''
+  Everything the batch run needs to know about a user, loaded once from the database
+  '''
+
+  def __init__(self, id: int, username: str, password: str, reservationRequests: list[ReservationRequest.ReservationRequest], booked: dict[int, list[tuple[str, str]]] = None):
+    self.id = id
+    self.username = username
+    self.password = password
+    self.reservationRequests = reservationRequests
+    self.booked = booked if booked is not None else {} # days since epoch -> [(startTime, endTime)] that are already reserved
+
+  def isBooked(self, request: ReservationRequest.ReservationRequest, date: datetime):
+    '''
+    Checks if the user already has a reservation on the date that falls inside the request's times
+    '''
+    fromMinutes = request.startMinutes
+    toMinutes = request.endMinutes
+    for startTime, endTime in self.booked.get(reserve.daysSinceEpoch(date), []):
+      if AvailabilityIndex.timeStringToMinutes(startTime) >= fromMinutes and AvailabilityIndex.timeStringToMinutes(endTime) <= toMinutes:
+        return True
+    return False
+
+  def __repr__(self):
+    return f"BatchUser(id={self.id}, username='{self.username}', requests={len(self.reservationRequests)})"
+
+class PlannedReservation:
+  '''
+  A room and the slots in it that the planner gave to one of a user's requests
+  '''
+
+  def __init__(self, user: BatchUser, request: ReservationRequest.ReservationRequest, date: datetime, room: Room.Room, slots: list[RoomAvailability.RoomAvailability]):
+    self.user = user
+    self.request = request
+    self.date = date
+    self.room = room
+    self.slots = slots
+    self.bookingId = None # filled in by checkoutPlans, None when libcal said it was already reserved
+    self.deferred = False # set by checkoutPlans when the checkout was left for the next run (scheduler.CheckoutDeferred)
+
+  def __repr__(self):
+    return f"PlannedReservation(user={self.user.id}, room='{self.room.name}', date='{reserve.createDateStringsForRequest(self.date)}', start='{self.slots[0].start}', end='{self.slots[-1].end}')"
+
+def usersFromDatabase(session: Session, userIds: list[int] = None) -> list[BatchUser]:
+  '''
+  Loads every user (or the ones in userIds) and their reservation requests in one query, then their reservations for the next two weeks in another
+  '''
+  users = db.loadUsersWithRequests(session, userIds)
+  today = reserve.daysSinceEpoch(datetime.now())
+  booked: dict[int, dict[int, list[tuple[str, str]]]] = {}
+  for reservation in db.findReservations(session, list(range(today, today + 15)), userIds):
+    booked.setdefault(reservation.users_id, {}).setdefault(reservation.day_since_epoch, []).append((reservation.startTime, reservation.endTime))
+
+  return [BatchUser(
+    id = user.id,
+    username = user.concordia_email,
+    password = user.concordia_password,
+    reservationRequests = [ReservationRequest.ReservationRequest(request.dow, request.iso_weekday, request.startTime, request.endTime, request.slots30mins, request.id) for request in user.reservationRequests],
+    booked = booked.get(user.id)
+    ) for user in users]
+
+def plannedUserDates(users: list[BatchUser]):
+  '''
+  Pairs every user's requests with the dates in the next two weeks they land on, leaving out the ones that are already booked
+
+  Returns: An array of (BatchUser, ReservationRequest, datetime) tuples
+  '''
+  userDates = []
+  for user in users:
+    for request, date in reserve.plannedReservationDates(user.reservationRequests):
+      if user.isBooked(request, date):
+        continue
+      userDates.append((user, request, date))
+  return userDates
+
+def planReservations(userDates, indexMap: dict[str, AvailabilityIndex.AvailabilityIndex], rooms: list[Room.Room] = Room.LIB_ALL, cost = assignment.roomPriorityCost,
+                     availabilityHistory: history.AvailabilityHistory = None) -> list[PlannedReservation]:
+  '''
+  Hands out rooms to every (user, request, date) from the same availability snapshot
+  All the requests for a day are solved together by assignment.assignRooms, so two users never try to book the same slot
+  and as many requests as possible get a room before room priority is looked at
+  With reserve.VECTORIZED_SEARCH_MIN or more of them the windows of every day and room are found at once in an AvailabilityMatrix
+  With an availabilityHistory, rooms with the same priority are tried in the order they were most often free that many days out
+  '''
+  userDatesByDay: dict[str, list] = {}
+  for userDate in userDates:
+    userDatesByDay.setdefault(reserve.createDateStringsForRequest(userDate[2]), []).append(userDate)
+  matrix = AvailabilityMatrix.AvailabilityMatrix({dateStr: indexMap[dateStr] for dateStr in userDatesByDay}, rooms) if len(userDates) >= reserve.VECTORIZED_SEARCH_MIN else None
+
+  plans: list[PlannedReservation] = []
+  for dateStr, dayUserDates in userDatesByDay.items():
+    availabilityIndex = indexMap[dateStr]
+    findWindows = (lambda fromMinutes, toMinutes, slotCount, dateStr=dateStr: matrix.windows(dateStr, fromMinutes, toMinutes, slotCount)) if matrix is not None else None
+    dayCost = availabilityHistory.successCost(dayUserDates[0][2].toordinal() - datetime.now().toordinal(), cost) if availabilityHistory is not None else cost
+    candidates = assignment.assignRooms([request for _, request, _ in dayUserDates], availabilityIndex, rooms, dayCost, findWindows)
+    for (user, request, date), candidate in zip(dayUserDates, candidates):
+      if candidate is None:
+        logging.info(f"No possible slots found for user {user.id} on {datetime.ctime(date)}")
+        continue
+      slots = availabilityIndex.slots(candidate.room.eid)[candidate.index:candidate.index+request.slots30mins]
+      plans.append(PlannedReservation(user, request, date, candidate.room, slots))
+  return plans
+
+def checkoutPlans(plans: list[PlannedReservation]) -> list[PlannedReservation]:
+  '''
+  Books every planned reservation, each user gets their own session so they're logged in as themselves
+  Different users check out at the same time, a single user's checkouts are spaced out by the CheckoutScheduler, which
+  leaves the ones that aren't due yet for the next run
+
+  Returns: The plans that are now reserved (including the ones libcal says were already reserved)
+  '''
+  if reserve.ASYNC_PIPELINE:
+    from Reserve import asyncreserve
+    return asyncreserve.checkoutPlans(plans)
+  usersById: dict[int, BatchUser] = {plan.user.id: plan.user for plan in plans}
+  userSessions = {userId: sessions.loadSession(user.username) for userId, user in usersById.items()}
+
+  def reservePlan(plan: PlannedReservation):
+    logging.info(f"Reserving {plan}")
+    confirmationRes = reserve.checkoutReservation(userSessions[plan.user.id], plan.slots, plan.user.username, plan.user.password)
+    if reserve.isAlreadyReserved(confirmationRes):
+      logging.info(f"User {plan.user.id} already has {plan.room.name} on {datetime.ctime(plan.date)}")
+    return confirmationRes
+
+  if reserve.CART_BATCHING: # one job per user that puts all their plans in as few carts as possible
+    plansByUser: dict[int, list[PlannedReservation]] = {}
+    for plan in plans:
+      plansByUser.setdefault(plan.user.id, []).append(plan)
+
+    def reserveUserPlans(userPlans: list[PlannedReservation]):
+      user = userPlans[0].user
+      logging.info(f"Reserving {len(userPlans)} plans for user {user.id}")
+      return reserve.checkoutReservations(userSessions[user.id], [plan.slots for plan in userPlans], user.username, user.password)
+
+    with scheduler.CheckoutScheduler() as checkouts:
+      userFutures = [(userPlans, checkouts.submit(usersById[userId].username, lambda userPlans=userPlans: reserveUserPlans(userPlans))) for userId, userPlans in plansByUser.items()]
+    futures = []
+    for userPlans, userFuture in userFutures:
+      if userFuture.exception() is not None:
+        futures += [(plan, userFuture) for plan in userPlans]
+      else:
+        futures += list(zip(userPlans, userFuture.result()))
+  else:
+    with scheduler.CheckoutScheduler(needsSpacing=lambda confirmationRes: not reserve.isAlreadyReserved(confirmationRes)) as checkouts:
+      futures = [(plan, checkouts.submit(plan.user.username, lambda plan=plan: reservePlan(plan))) for plan in plans]
+
+  for userId, user in usersById.items():
+    sessions.saveSession(user.username, userSessions[userId])
+  sessions.logMetrics()
+  completed = [plan for plan, future in futures if future.exception() is None]
+  for plan, future in futures:
+    if future.exception() is None:
+      plan.bookingId = reserve.bookingIdFromConfirmation(future.result())
+    plan.deferred = isinstance(future.exception(), scheduler.CheckoutDeferred)
+  return completed
+
+def reservationFromPlan(plan: PlannedReservation) -> db.Reservation:
+  return db.Reservation(
+    day_since_epoch = reserve.daysSinceEpoch(reserve.dateFromReservation(plan.slots)),
+    actual_date = reserve.dateFromReservation(plan.slots),
+    startTime = plan.slots[0].start.split(' ')[1],
+    endTime = plan.slots[-1].end.split(' ')[1],
+    users_id = plan.user.id,
+    booking_id = plan.bookingId,
+    eid = plan.room.eid
+    )
+
+def recordReservations(session: Session, plans: list[PlannedReservation]):
+  '''
+  Saves the reserved plans in the reservation table in one commit
+  '''
+  session.add_all([reservationFromPlan(plan) for plan in plans])
+  session.commit()
+
+def main():
+  '''
+  Reserves rooms for every user in the database, every date's availability is only downloaded once for all of them
+  The rooms come from every library in availability.LIBRARIES, whose days are all downloaded together
+  '''
+  engine = db.createEngine()
+  with Session(engine) as dbSession:
+    with metrics.span('db load'):
+      users = usersFromDatabase(dbSession)
+    userDates = plannedUserDates(users)
+    logging.info(f"Planning {len(userDates)} reservations for {len(users)} users")
+    if len(userDates) == 0:
+      logging.info('Theres nothing to reserve! Quiting...')
+      return
+
+    with metrics.span('db load'):
+      rooms = catalogue.loadRooms(dbSession, availability.LIBRARIES)
+    dateStrings = list(dict.fromkeys(reserve.createDateStringsForRequest(date) for _, _, date in userDates))
+    availabilityMap = availability.getLibraryAvailabilityMap([(library.lid, date) for date in dateStrings for library in availability.LIBRARIES], runCache={}, sharedCache=None) # fresh grids, see reserve.main
+    indexMap = reserve.indexAvailabilityMap(availability.mergeLibraries(availabilityMap))
+    with metrics.span('match'):
+      plans = planReservations(userDates, indexMap, rooms, availabilityHistory=history.HISTORY)
+    logging.info(f"Found rooms for {len(plans)} of {len(userDates)} reservations")
+
+    completed = checkoutPlans(plans)
+    with metrics.span('db write'):
+      recordReservations(dbSession, completed)
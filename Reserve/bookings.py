@@ -0,0 +1,290 @@
+'''
+Looks after the bookings we already made, using the libcal booking id (cs_...) saved with every Reservation
+
+Upgrades: a higher priority room that freed up since a reservation was made is swapped in for the one we have.
+The new room goes in a cart (logging in if needed) before anything is given up, then the old booking is cancelled and
+the cart checked out right away, so the only time neither room is ours is one checkout request. That gap is timed
+for every swap. If the checkout doesn't go through, the old room is booked again from a fresh grid.
+Stale bookings: reservations that no request of the user covers anymore (the request was removed or moved) are
+cancelled so the room goes back to everyone else.
+
+A booking that was checked out in the same cart as others (CART_BATCHING) shares their id, cancelling it would cancel
+them all, so those are only cancelled when all of them are stale and never swapped.
+
+Run outside of azure with: python -m Reserve.bookings [--upgrade] [--cancel-stale]
+'''
+import argparse
+import logging
+import os
+import sys
+from collections import Counter
+from datetime import datetime
+from time import perf_counter
+
+from sqlalchemy import delete, update
+from sqlalchemy.orm import Session
+
+import db
+from Reserve import availability, batch, catalogue, metrics, reserve, scheduler, sessions
+from Types import AvailabilityIndex, Room, RoomAvailability
+
+# set to true to swap reservations into higher priority rooms that freed up / cancel the bookings no request wants anymore after the multi user run
+BOOKING_UPGRADES = os.environ.get('BOOKING_UPGRADES', 'false').lower() == 'true'
+CANCEL_STALE_BOOKINGS = os.environ.get('CANCEL_STALE_BOOKINGS', 'false').lower() == 'true'
+
+def reservationMinutes(reservation: db.Reservation) -> tuple[int, int]:
+  # a reservation that ends at midnight has an end time of 00:00:00
+  startMinutes = AvailabilityIndex.timeStringToMinutes(reservation.startTime)
+  endMinutes = AvailabilityIndex.timeStringToMinutes(reservation.endTime)
+  return startMinutes, endMinutes if endMinutes > startMinutes else endMinutes + 24 * 60
+
+def windowSlots(availabilityIndex: AvailabilityIndex.AvailabilityIndex, eid: int, startMinutes: int, endMinutes: int):
+  '''
+  The room's slots covering exactly startMinutes to endMinutes, or None when they aren't all free
+  '''
+  slotCount = (endMinutes - startMinutes) // AvailabilityIndex.SLOT_MINUTES
+  windows = availabilityIndex.windows(eid, startMinutes, endMinutes, slotCount)
+  if len(windows) == 0:
+    return None
+  return availabilityIndex.slots(eid)[windows[0]:windows[0]+slotCount]
+
+class Upgrade:
+  '''
+  A reservation and the better room it can be swapped into, with plain values so it can be used from the checkout threads
+  '''
+
+  def __init__(self, reservation: db.Reservation, oldRoom: Room.Room, room: Room.Room, slots: list[RoomAvailability.RoomAvailability]):
+    self.reservationId = reservation.id
+    self.usersId = reservation.users_id
+    self.bookingId = reservation.booking_id
+    self.dateString = reserve.createDateStringsForRequest(reservation.actual_date)
+    self.startMinutes, self.endMinutes = reservationMinutes(reservation)
+    self.oldRoom = oldRoom
+    self.room = room
+    self.slots = slots
+
+  def __repr__(self):
+    return f"Upgrade(reservation={self.reservationId}, date='{self.dateString}', from='{self.oldRoom.name}', to='{self.room.name}')"
+
+class Swap:
+  '''
+  How a swap went: the new booking id, or the id the old room was booked again under when the new one couldn't be checked out
+  gapSeconds is the time between libcal confirming the cancel and confirming the booking that replaced it
+  '''
+
+  def __init__(self, upgrade: Upgrade, bookingId: str = None, restoredBookingId: str = None, gapSeconds: float = None):
+    self.upgrade = upgrade
+    self.bookingId = bookingId
+    self.restoredBookingId = restoredBookingId
+    self.gapSeconds = gapSeconds
+
+  def __repr__(self):
+    return f"Swap({self.upgrade}, bookingId='{self.bookingId}', restoredBookingId='{self.restoredBookingId}', gapSeconds={self.gapSeconds})"
+
+def findUpgrades(reservations: list[db.Reservation], indexMap: dict[str, AvailabilityIndex.AvailabilityIndex], rooms: list[Room.Room]) -> list[Upgrade]:
+  '''
+  Finds a free room with a better priority than the booked one, for the same times, for every reservation that can be swapped
+  Rooms are handed out earliest reservation first and a freed slot only goes to one of them
+  '''
+  roomsByEid = {room.eid: room for room in rooms}
+  bookingCounts = Counter(reservation.booking_id for reservation in reservations)
+  taken: set[tuple[int, str]] = set() # (eid, slot start) already given to an upgrade
+  upgrades: list[Upgrade] = []
+  for reservation in sorted(reservations, key=lambda reservation: (reservation.day_since_epoch, reservation.startTime)):
+    oldRoom = roomsByEid.get(reservation.eid)
+    if oldRoom is None or reservation.booking_id is None or bookingCounts[reservation.booking_id] > 1:
+      continue
+    availabilityIndex = indexMap.get(reserve.createDateStringsForRequest(reservation.actual_date))
+    if availabilityIndex is None:
+      continue
+    startMinutes, endMinutes = reservationMinutes(reservation)
+    for room in rooms:
+      if room.priority >= oldRoom.priority:
+        continue
+      slots = windowSlots(availabilityIndex, room.eid, startMinutes, endMinutes)
+      if slots is None or any((room.eid, slot.start) in taken for slot in slots):
+        continue
+      taken.update((room.eid, slot.start) for slot in slots)
+      upgrades.append(Upgrade(reservation, oldRoom, room, slots))
+      break
+  return upgrades
+
+def rebook(session, upgrade: Upgrade, username: str = None, password: str = None):
+  '''
+  Books the old room again after a swap didn't go through, the slots we gave up have to be read off a fresh grid
+
+  Returns: The new booking id, or None if somebody else got the room first
+  '''
+  availabilityArray = RoomAvailability.getAvailabilityArray(upgrade.dateString, upgrade.oldRoom.lid, session)
+  slots = windowSlots(AvailabilityIndex.AvailabilityIndex(availabilityArray), upgrade.oldRoom.eid, upgrade.startMinutes, upgrade.endMinutes)
+  if slots is None:
+    return None
+  confirmationRes = reserve.checkoutReservation(session, slots, username, password)
+  return reserve.bookingIdFromConfirmation(confirmationRes)
+
+def swapBooking(session, upgrade: Upgrade, username: str = None, password: str = None) -> Swap:
+  '''
+  Cancels the upgrade's booking and books the better room in its place, see the top of the file
+  Raises when the cancel fails, nothing was given up then
+  '''
+  with metrics.span('swap'):
+    reserve.createCart(session, upgrade.slots, username, password) # logged in with the new room in the cart before the old one goes
+    reserve.cancelBooking(session, upgrade.bookingId, username, password)
+    cancelledAt = perf_counter()
+    try:
+      confirmationRes = reserve.checkoutCart(session)
+      bookingId = reserve.bookingIdFromConfirmation(confirmationRes)
+      if reserve.isAlreadyReserved(confirmationRes):
+        raise RuntimeError(f"{upgrade.room.name} was taken before we could check out")
+    except Exception as e:
+      logging.info(f"Swapping {upgrade} failed after the cancel, booking {upgrade.oldRoom.name} again: {e}")
+      metrics.count('swapsFailed')
+      try:
+        restoredBookingId = rebook(session, upgrade, username, password)
+      except Exception as rebookError:
+        logging.info(f"Couldn't book {upgrade.oldRoom.name} again: {rebookError}")
+        restoredBookingId = None
+      gapSeconds = perf_counter() - cancelledAt
+      metrics.addSpan('swap gap', gapSeconds)
+      logging.info(f"{upgrade.oldRoom.name} was held by nobody for {gapSeconds:.3f}s" if restoredBookingId is not None else f"Lost {upgrade.oldRoom.name} on {upgrade.dateString}")
+      return Swap(upgrade, restoredBookingId=restoredBookingId, gapSeconds=gapSeconds)
+  gapSeconds = perf_counter() - cancelledAt
+  metrics.addSpan('swap gap', gapSeconds)
+  metrics.count('swaps')
+  logging.info(f"Swapped {upgrade}, the room was held by nobody for {gapSeconds:.3f}s")
+  return Swap(upgrade, bookingId=bookingId, gapSeconds=gapSeconds)
+
+def staleReservations(users: list[batch.BatchUser], reservations: list[db.Reservation]) -> list[db.Reservation]:
+  '''
+  The reservations with a booking id that none of their user's requests cover anymore
+  Bookings that share an id are only stale when all of them are
+  '''
+  usersById = {user.id: user for user in users}
+
+  def isStale(reservation: db.Reservation):
+    user = usersById.get(reservation.users_id)
+    if user is None:
+      return True
+    startMinutes, endMinutes = reservationMinutes(reservation)
+    return not any(request.iso_weekday == reservation.actual_date.isoweekday() and request.startMinutes <= startMinutes and endMinutes <= request.endMinutes
+                   for request in user.reservationRequests)
+
+  byBookingId: dict[str, list[db.Reservation]] = {}
+  for reservation in reservations:
+    if reservation.booking_id is not None:
+      byBookingId.setdefault(reservation.booking_id, []).append(reservation)
+  return [reservation for shared in byBookingId.values() if all(isStale(reservation) for reservation in shared) for reservation in shared]
+
+def userCredentials(dbSession: Session, userIds) -> dict[int, tuple[str, str]]:
+  # user id -> (concordia email, password)
+  return {user.id: (user.concordia_email, user.concordia_password) for user in dbSession.query(db.User).filter(db.User.id.in_(list(userIds))).all()}
+
+def cancelReservations(dbSession: Session, reservations: list[db.Reservation]) -> int:
+  '''
+  Cancels the bookings of the reservations, every user at the same time and each user's one after the other, and removes the
+  ones that were cancelled from the reservation table in one commit
+
+  Returns: How many bookings were cancelled
+  '''
+  bookingIds: dict[str, int] = {reservation.booking_id: reservation.users_id for reservation in reservations if reservation.booking_id is not None}
+  if len(bookingIds) == 0:
+    return 0
+  credentials = userCredentials(dbSession, set(bookingIds.values()))
+  userSessions = {userId: sessions.loadSession(username) for userId, (username, _) in credentials.items()}
+
+  def cancel(bookingId: str, userId: int):
+    username, password = credentials[userId]
+    logging.info(f"Cancelling stale booking {bookingId} of user {userId}")
+    return reserve.cancelBooking(userSessions[userId], bookingId, username, password)
+
+  with scheduler.CheckoutScheduler(needsSpacing=lambda cancelRes: False, persist=False) as cancels: # no email to wait for
+    futures = [(bookingId, cancels.submit(userId, lambda bookingId=bookingId, userId=userId: cancel(bookingId, userId))) for bookingId, userId in bookingIds.items() if userId in credentials]
+  for userId, (username, _) in credentials.items():
+    sessions.saveSession(username, userSessions[userId])
+
+  cancelled = [bookingId for bookingId, future in futures if future.exception() is None]
+  if len(cancelled) > 0:
+    dbSession.execute(delete(db.Reservation).where(db.Reservation.booking_id.in_(cancelled)))
+  dbSession.commit()
+  logging.info(f"Cancelled {len(cancelled)} of {len(bookingIds)} stale bookings")
+  return len(cancelled)
+
+def swapAll(upgrades: list[Upgrade], credentials: dict[int, tuple[str, str]]) -> list[Swap]:
+  '''
+  Runs every swap, different users at the same time and a user's own swaps spaced out like their checkouts
+
+  Returns: How every swap went, a swap whose cancel failed or that was left for the next run isn't in it
+  '''
+  userSessions = {userId: sessions.loadSession(credentials[userId][0]) for userId in {upgrade.usersId for upgrade in upgrades}}
+
+  def swap(upgrade: Upgrade):
+    username, password = credentials[upgrade.usersId]
+    return swapBooking(userSessions[upgrade.usersId], upgrade, username, password)
+
+  with scheduler.CheckoutScheduler() as swaps:
+    futures = [swaps.submit(credentials[upgrade.usersId][0], lambda upgrade=upgrade: swap(upgrade)) for upgrade in upgrades]
+  for userId, userSession in userSessions.items():
+    sessions.saveSession(credentials[userId][0], userSession)
+  return [future.result() for future in futures if future.exception() is None]
+
+def upgradeReservations(dbSession: Session, reservations: list[db.Reservation]) -> list[Swap]:
+  '''
+  Downloads a fresh grid for every day with a reservation, swaps the ones that can get a better room and saves the new
+  booking ids and rooms. Reservations whose room was lost in a swap are removed, so the next run books them again
+
+  Returns: How every swap went
+  '''
+  if len(reservations) == 0:
+    return []
+  rooms = catalogue.loadRooms(dbSession, availability.LIBRARIES)
+  dateStrings = list(dict.fromkeys(reserve.createDateStringsForRequest(reservation.actual_date) for reservation in reservations))
+  availabilityMap = availability.getLibraryAvailabilityMap([(library.lid, date) for date in dateStrings for library in availability.LIBRARIES], runCache={}, sharedCache=None)
+  indexMap = reserve.indexAvailabilityMap(availability.mergeLibraries(availabilityMap))
+  upgrades = findUpgrades(reservations, indexMap, rooms)
+  logging.info(f"Found better rooms for {len(upgrades)} of {len(reservations)} reservations")
+  if len(upgrades) == 0:
+    return []
+
+  swaps = swapAll(upgrades, userCredentials(dbSession, {upgrade.usersId for upgrade in upgrades}))
+  for swap in swaps:
+    if swap.bookingId is not None:
+      values = {'booking_id': swap.bookingId, 'eid': swap.upgrade.room.eid}
+    elif swap.restoredBookingId is not None:
+      values = {'booking_id': swap.restoredBookingId}
+    else:
+      dbSession.execute(delete(db.Reservation).where(db.Reservation.id == swap.upgrade.reservationId))
+      continue
+    dbSession.execute(update(db.Reservation).where(db.Reservation.id == swap.upgrade.reservationId).values(**values))
+  dbSession.commit()
+  gaps = sorted(swap.gapSeconds for swap in swaps)
+  if len(gaps) > 0:
+    logging.info(f"Swapped {sum(swap.bookingId is not None for swap in swaps)} of {len(upgrades)} reservations, rooms were held by nobody for {gaps[len(gaps) // 2]:.3f}s (median) {gaps[-1]:.3f}s (longest)")
+  return swaps
+
+def main(upgrade: bool = BOOKING_UPGRADES, cancelStale: bool = CANCEL_STALE_BOOKINGS):
+  '''
+  Cancels the stale bookings and then swaps the rest into better rooms, whichever are turned on
+  '''
+  if not upgrade and not cancelStale:
+    return
+  engine = db.createEngine()
+  with Session(engine, expire_on_commit=False) as dbSession: # the reservations are still used after the cancels are committed
+    with metrics.span('db load'):
+      users = batch.usersFromDatabase(dbSession)
+      today = reserve.daysSinceEpoch(datetime.now())
+      reservations = [reservation for reservation in db.findReservations(dbSession, list(range(today, today + 15))) if reservation.booking_id is not None]
+    if cancelStale:
+      stale = staleReservations(users, reservations)
+      staleIds = {reservation.id for reservation in stale}
+      reservations = [reservation for reservation in reservations if reservation.id not in staleIds]
+      cancelReservations(dbSession, stale)
+    if upgrade:
+      upgradeReservations(dbSession, reservations)
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.INFO)
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--upgrade', action='store_true', help='swap reservations into better rooms that freed up')
+  parser.add_argument('--cancel-stale', dest='cancelStale', action='store_true', help="cancel the bookings that no request covers anymore")
+  args = parser.parse_args(sys.argv[1:])
+  main(args.upgrade, args.cancelStale)
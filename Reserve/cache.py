@@ -0,0 +1,108 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from time import monotonic, time
+
+# how long a downloaded availability grid can be reused by later runs in the same worker process
+# only reserve.test() and the api read it, the runs that book rooms always download fresh grids
+AVAILABILITY_CACHE_TTL = float(os.environ.get('AVAILABILITY_CACHE_TTL', 300))
+AVAILABILITY_CACHE_SIZE = int(os.environ.get('AVAILABILITY_CACHE_SIZE', 64))
+
+class AvailabilityCache:
+  '''
+  Small thread safe cache with a time to live on every entry that throws out the least recently used entry when it gets full
+  getOrLoad makes sure only one caller loads a missing key, everyone else asking for it at the same time waits for that load
+  '''
+
+  def __init__(self, ttl = AVAILABILITY_CACHE_TTL, maxEntries = AVAILABILITY_CACHE_SIZE):
+    self.ttl = ttl
+    self.maxEntries = maxEntries
+    self.hits = 0
+    self.misses = 0
+    self.coalesced = 0
+    self._entries = OrderedDict() # key -> (time it was stored, value, wall clock time it was stored)
+    self._loading: dict[object, Future] = {} # key -> the load that's running for it
+    self._lock = threading.Lock()
+
+  def _getEntry(self, key):
+    # has to be called with the lock held
+    entry = self._entries.get(key)
+    if entry is not None and monotonic() - entry[0] <= self.ttl:
+      self._entries.move_to_end(key)
+      self.hits += 1
+      return entry
+    if entry is not None: # expired, no point keeping it around
+      del self._entries[key]
+    self.misses += 1
+    return None
+
+  def _putEntry(self, key, value):
+    # has to be called with the lock held
+    entry = (monotonic(), value, time())
+    self._entries[key] = entry
+    self._entries.move_to_end(key)
+    while len(self._entries) > self.maxEntries:
+      self._entries.popitem(last=False)
+    return entry
+
+  def get(self, key):
+    '''
+    Returns the cached value for key or None if it is missing or too old
+    '''
+    with self._lock:
+      entry = self._getEntry(key)
+      return entry[1] if entry is not None else None
+
+  def put(self, key, value):
+    with self._lock:
+      self._putEntry(key, value)
+
+  def getOrLoad(self, key, load):
+    '''
+    Returns the cached value for key, calling load() to make it when it's missing or too old
+    When a load for the key is already running the caller waits for it instead of starting another one
+
+    Returns: (value, wall clock time the value was loaded)
+    '''
+    with self._lock:
+      entry = self._getEntry(key)
+      if entry is not None:
+        return entry[1], entry[2]
+      loading = self._loading.get(key)
+      isLoader = loading is None
+      if isLoader:
+        loading = self._loading[key] = Future()
+      else:
+        self.coalesced += 1
+    if not isLoader:
+      return loading.result()
+
+    try:
+      value = load()
+      with self._lock:
+        entry = self._putEntry(key, value)
+      loading.set_result((entry[1], entry[2]))
+      return entry[1], entry[2]
+    except BaseException as e:
+      loading.set_exception(e) # everyone waiting gets the same error, the next caller tries again
+      raise
+    finally:
+      with self._lock:
+        del self._loading[key]
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self.hits = 0
+      self.misses = 0
+      self.coalesced = 0
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __repr__(self):
+    return f"AvailabilityCache(entries={len(self._entries)}, hits={self.hits}, misses={self.misses}, coalesced={self.coalesced}, ttl={self.ttl})"
+
+# lives as long as the function worker does, so back to back timer runs and test() can share grids
+SHARED_AVAILABILITY_CACHE = AvailabilityCache()
@@ -0,0 +1,92 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import requests
+from sqlalchemy.orm import Session
+
+import db
+from Reserve import availability, metrics
+from Types import Library, Room, RoomAvailability
+
+# how long (seconds) a library's room list in the rooms table is trusted before it's read off libcal again
+ROOM_CATALOGUE_TTL = float(os.environ.get('ROOM_CATALOGUE_TTL', 24 * 60 * 60))
+
+KNOWN_ROOMS = {room.eid: room for room in Room.LIB_ALL}
+NEW_ROOM_PRIORITY = max(room.priority for room in Room.LIB_ALL) + 1 # rooms we don't know anything about go last
+
+def discoverRooms(library: Library.Library, dateString: str, session: requests.Session = None) -> list[Room.Room]:
+  '''
+  Reads the rooms off the library's availability page for the date (YYYY-MM-DD), every room panel's title is its name
+  Rooms we already know keep their tech and priority, new ones get NEW_ROOM_PRIORITY
+  A room with nothing free that day doesn't have any checkboxes, so it only shows up once it has a free slot
+  '''
+  roomNames: dict[int, str] = {}
+  if session is None:
+    session = availability.createPooledSession(1)
+  with metrics.span('catalogue'):
+    RoomAvailability.getAvailabilityArray(dateString, library.lid, session, roomNames)
+  metrics.count('httpRequests')
+  rooms: list[Room.Room] = []
+  for eid, name in roomNames.items():
+    if eid in Room.EXCLUDED_EIDS:
+      continue
+    known = KNOWN_ROOMS.get(eid)
+    rooms.append(Room.Room(name, eid, known.tech if known is not None else False, known.priority if known is not None else NEW_ROOM_PRIORITY, library.lid, library.gid))
+  return rooms
+
+def saveRooms(dbSession: Session, rooms: list[Room.Room], stored: dict[int, db.Room], now: datetime):
+  '''
+  Adds the new rooms to the rooms table and refreshes the ones that are already there, priority and tech are left
+  alone on stored rooms so they can be changed by hand. Rooms that didn't show up are kept.
+  '''
+  for room in rooms:
+    row = stored.get(room.eid)
+    if row is None:
+      row = db.Room(name=room.name, tech=room.tech, priority=room.priority, seats=True, eid=room.eid)
+      dbSession.add(row)
+      stored[room.eid] = row
+    row.name = room.name
+    row.lid = room.lid
+    row.gid = room.gid
+    row.updated = now
+  dbSession.commit()
+
+def loadRooms(dbSession: Session, libraries: list[Library.Library] = availability.LIBRARIES, dateString: str = None, session: requests.Session = None) -> list[Room.Room]:
+  '''
+  Gets the rooms of every library from the rooms table, the libraries whose rooms weren't refreshed in the last
+  ROOM_CATALOGUE_TTL seconds are read off libcal first (all at the same time)
+  Falls back to Room.LIB_ALL for the default library when nothing could be found for it
+
+  Returns: The rooms from highest to lowest priority
+  '''
+  db.ensureRoomColumns(dbSession)
+  now = datetime.now()
+  dateString = dateString if dateString is not None else now.strftime('%Y-%m-%d')
+  stored = {row.eid: row for row in db.findRooms(dbSession, [library.lid for library in libraries])}
+  lastUpdated: dict[int, datetime] = {}
+  for row in stored.values():
+    if row.updated is not None and (row.lid not in lastUpdated or row.updated > lastUpdated[row.lid]):
+      lastUpdated[row.lid] = row.updated
+  staleLibraries = [library for library in libraries if library.lid not in lastUpdated or now - lastUpdated[library.lid] > timedelta(seconds=ROOM_CATALOGUE_TTL)]
+
+  if len(staleLibraries) > 0:
+    logging.info(f"Refreshing the room catalogue for {len(staleLibraries)} of {len(libraries)} libraries")
+    if session is None:
+      session = availability.createPooledSession(len(staleLibraries))
+    with ThreadPoolExecutor(max_workers=max(1, min(availability.MAX_CONCURRENT_FETCHES, len(staleLibraries)))) as executor:
+      futures = [(library, executor.submit(discoverRooms, library, dateString, session)) for library in staleLibraries]
+    for library, future in futures:
+      if future.exception() is not None:
+        logging.info(f"Couldn't read the rooms of library {library.lid}: {future.exception()}")
+        continue
+      saveRooms(dbSession, future.result(), stored, now)
+    metrics.count('catalogueRefreshes', len(staleLibraries))
+
+  lids = {library.lid for library in libraries}
+  rooms = [Room.Room(row.name, row.eid, row.tech, row.priority, row.lid, row.gid) for row in stored.values() if row.lid in lids and row.eid not in Room.EXCLUDED_EIDS]
+  if not any(room.lid == Room.LID for room in rooms) and Room.LID in lids:
+    rooms += Room.LIB_ALL
+  rooms.sort(key=lambda room: (room.priority, room.eid))
+  return rooms
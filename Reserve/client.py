@@ -0,0 +1,296 @@
+'''
+The http client every libcal and concordia login request goes through
+
+Every request gets connect/read timeouts and waits for a token from its host's bucket so the threads of a run can't
+hammer the server together. The bucket slows down when the server answers 429/503 and speeds back up as requests go through.
+GETs are tried again with jittered backoff when the connection fails or the server is busy, posts never are since
+libcal might have made the cart or booking already. After CIRCUIT_FAILURES failures in a row the host's circuit opens and
+requests to it fail right away for CIRCUIT_RESET_SECONDS, then one request is let through to see if it's back.
+'''
+import asyncio
+import logging
+import os
+import random
+import threading
+from time import monotonic, sleep
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from Reserve import metrics
+
+# seconds to wait for the connection and then for every read of the response
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 5))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 30))
+# requests per second to every host, with bursts of up to HTTP_RATE_BURST, 0 turns the limit off
+HTTP_RATE_LIMIT = float(os.environ.get('HTTP_RATE_LIMIT', 10))
+HTTP_RATE_BURST = float(os.environ.get('HTTP_RATE_BURST', 20))
+# how many more times a failed GET is tried and the backoff before the first retry (doubles every time, up to HTTP_BACKOFF_MAX)
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', 3))
+HTTP_BACKOFF = float(os.environ.get('HTTP_BACKOFF', 0.5))
+HTTP_BACKOFF_MAX = 10
+# failures in a row before a host's circuit opens and how long it stays open (seconds)
+CIRCUIT_FAILURES = int(os.environ.get('CIRCUIT_FAILURES', 5))
+CIRCUIT_RESET_SECONDS = float(os.environ.get('CIRCUIT_RESET_SECONDS', 30))
+
+RETRY_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+RETRY_STATUSES = {429, 502, 503, 504}
+# libcal answers with a 500 when a slot was already booked, that's not the server falling over so it doesn't count
+FAILURE_STATUSES = {429, 502, 503, 504}
+SLOW_DOWN_STATUSES = {429, 503}
+# errors that mean the host (or the way to it) is in trouble, they count as a failure and GETs are tried again
+TRANSPORT_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError, requests.exceptions.ContentDecodingError)
+
+class CircuitOpenError(requests.ConnectionError):
+  '''
+  Raised instead of making a request to a host whose circuit is open
+  '''
+
+class TokenBucket:
+  '''
+  Hands out `rate` tokens a second, up to `burst` at once. The rate halves when the server pushes back
+  and creeps back up to where it started with every request that goes through
+  '''
+
+  def __init__(self, rate: float, burst: float):
+    self.maxRate = rate
+    self.rate = rate
+    self.burst = max(1.0, burst)
+    self.tokens = self.burst
+    self.updated = monotonic()
+    self._lock = threading.Lock()
+
+  def _take(self) -> float:
+    # takes a token if there's one, otherwise says how long until there is
+    with self._lock:
+      now = monotonic()
+      self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+      self.updated = now
+      if self.tokens >= 1:
+        self.tokens -= 1
+        return 0
+      return (1 - self.tokens) / self.rate
+
+  def acquire(self):
+    if self.maxRate <= 0:
+      return
+    wait = self._take()
+    if wait > 0:
+      metrics.count('httpRateLimited')
+    while wait > 0:
+      sleep(wait)
+      wait = self._take()
+
+  async def acquireAsync(self):
+    # the same as acquire for the asyncio pipeline, waiting doesn't hold up the event loop
+    if self.maxRate <= 0:
+      return
+    wait = self._take()
+    if wait > 0:
+      metrics.count('httpRateLimited')
+    while wait > 0:
+      await asyncio.sleep(wait)
+      wait = self._take()
+
+  def slowDown(self):
+    with self._lock:
+      self.rate = max(self.maxRate / 16, self.rate / 2)
+      self.tokens = min(self.tokens, 0)
+
+  def speedUp(self):
+    with self._lock:
+      self.rate = min(self.maxRate, self.rate + self.maxRate / 20)
+
+class CircuitBreaker:
+  '''
+  Closed while requests go through, open (every request fails right away) for resetSeconds after `failures` failures in a row,
+  then half open: a single request is let through and closes it again if it works
+  '''
+
+  def __init__(self, name: str, failures: int, resetSeconds: float):
+    self.name = name
+    self.failureLimit = failures
+    self.resetSeconds = resetSeconds
+    self.failures = 0
+    self.openedAt: float = None
+    self.trying = False # a half open request is on its way
+    self._lock = threading.Lock()
+
+  def allow(self):
+    with self._lock:
+      if self.openedAt is None:
+        return
+      if monotonic() - self.openedAt >= self.resetSeconds and not self.trying:
+        self.trying = True
+        return
+    metrics.count('circuitRejected')
+    raise CircuitOpenError(f"{self.name} failed {self.failures} times in a row, not sending anything for a bit")
+
+  def recordSuccess(self):
+    with self._lock:
+      if self.openedAt is not None:
+        logging.info(f"{self.name} is answering again, closing the circuit")
+      self.failures = 0
+      self.openedAt = None
+      self.trying = False
+
+  def release(self):
+    # the request that was let through ended without saying anything about the host (a bad url, a cancelled task...),
+    # so the next one gets to try
+    with self._lock:
+      self.trying = False
+
+  def recordFailure(self):
+    with self._lock:
+      self.failures += 1
+      if self.trying or (self.openedAt is None and self.failures >= self.failureLimit):
+        logging.info(f"{self.name} failed {self.failures} times in a row, opening the circuit for {self.resetSeconds}s")
+        metrics.count('circuitOpened')
+        self.openedAt = monotonic()
+      self.trying = False
+
+class HostState:
+
+  def __init__(self, host: str):
+    self.bucket = TokenBucket(HTTP_RATE_LIMIT, HTTP_RATE_BURST)
+    self.breaker = CircuitBreaker(host, CIRCUIT_FAILURES, CIRCUIT_RESET_SECONDS)
+
+_hosts: dict[str, HostState] = {}
+_hostsLock = threading.Lock()
+
+def hostState(url: str) -> HostState:
+  # shared by every session, so all the users of a run share the same limits
+  host = urlsplit(url).netloc
+  with _hostsLock:
+    if host not in _hosts:
+      _hosts[host] = HostState(host)
+    return _hosts[host]
+
+def resetHosts():
+  with _hostsLock:
+    _hosts.clear()
+
+def backoff(attempt: int, res = None):
+  '''
+  Full jitter: a random wait up to HTTP_BACKOFF * 2^attempt, or what the server asked for in Retry-After
+  '''
+  retryAfter = res.headers.get('Retry-After', '') if res is not None else ''
+  if retryAfter.isdigit():
+    return min(HTTP_BACKOFF_MAX, float(retryAfter))
+  return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF * 2 ** attempt))
+
+class LibCalSession(requests.Session):
+  '''
+  A requests session whose requests (and every redirect they follow) go through the host's bucket and circuit breaker
+  '''
+
+  def send(self, request: requests.PreparedRequest, **kwargs):
+    if kwargs.get('timeout') is None:
+      kwargs['timeout'] = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+    state = hostState(request.url)
+    retries = HTTP_RETRIES if request.method in RETRY_METHODS else 0
+    attempt = 0
+    while True:
+      state.breaker.allow()
+      state.bucket.acquire()
+      try:
+        res = super().send(request, **kwargs)
+      except TRANSPORT_ERRORS as e:
+        state.breaker.recordFailure()
+        if attempt >= retries:
+          raise
+        logging.info(f"{request.method} {request.url} failed ({e}), trying again")
+        wait = backoff(attempt)
+      except BaseException:
+        state.breaker.release() # every way out after allow() has to let go of a half open try
+        raise
+      else:
+        if res.status_code in SLOW_DOWN_STATUSES:
+          state.bucket.slowDown()
+        if res.status_code not in FAILURE_STATUSES:
+          state.breaker.recordSuccess()
+          state.bucket.speedUp()
+          return res
+        state.breaker.recordFailure()
+        if attempt >= retries:
+          return res
+        logging.info(f"{request.method} {request.url} answered {res.status_code}, trying again")
+        wait = backoff(attempt, res)
+        res.close()
+      attempt += 1
+      metrics.count('httpRetries')
+      sleep(wait)
+
+def createSession(poolSize = 1) -> LibCalSession:
+  '''
+  Makes a session that keeps its connections alive (up to poolSize at a time) so every request reuses the same sockets
+  '''
+  session = LibCalSession()
+  adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(poolSize, 1))
+  session.mount('https://', adapter)
+  session.mount('http://', adapter)
+  return session
+
+async def sendAsync(asyncClient, method: str, url: str, stream: bool = False, **kwargs):
+  '''
+  What LibCalSession.send does, for an httpx.AsyncClient: waits for the host's bucket, goes through its circuit breaker
+  and tries GETs again with jittered backoff. Redirects are followed by httpx, so only the first request of a redirect chain is limited.
+  With stream=True the caller has to close the response (await res.aclose())
+  '''
+  import httpx
+  state = hostState(url)
+  retries = HTTP_RETRIES if method.upper() in RETRY_METHODS else 0
+  attempt = 0
+  while True:
+    state.breaker.allow()
+    await state.bucket.acquireAsync()
+    try:
+      res = await asyncClient.send(asyncClient.build_request(method, url, **kwargs), stream=stream)
+    except (httpx.TransportError, httpx.DecodingError) as e:
+      state.breaker.recordFailure()
+      if attempt >= retries:
+        raise
+      logging.info(f"{method} {url} failed ({e!r}), trying again")
+      wait = backoff(attempt)
+    except BaseException: # like a task cancelled by ASYNC_RUN_TIMEOUT
+      state.breaker.release()
+      raise
+    else:
+      if res.status_code in SLOW_DOWN_STATUSES:
+        state.bucket.slowDown()
+      if res.status_code not in FAILURE_STATUSES:
+        state.breaker.recordSuccess()
+        state.bucket.speedUp()
+        return res
+      state.breaker.recordFailure()
+      if attempt >= retries:
+        return res
+      logging.info(f"{method} {url} answered {res.status_code}, trying again")
+      wait = backoff(attempt, res)
+      await res.aclose()
+    attempt += 1
+    metrics.count('httpRetries')
+    await asyncio.sleep(wait)
+
+def createAsyncTransport(poolSize: int):
+  '''
+  One httpx connection pool that every user's AsyncClient can share, see createAsyncClient
+  '''
+  import httpx
+  return httpx.AsyncHTTPTransport(limits=httpx.Limits(max_connections=max(poolSize, 1), max_keepalive_connections=max(poolSize, 1)))
+
+def createAsyncClient(transport, cookies = None, headers: dict = None):
+  '''
+  An httpx.AsyncClient over the shared transport with the same timeouts as createSession
+  cookies can be a requests session's cookie jar, httpx then reads and adds to that same jar
+  Don't close it, that would close the shared transport too, close the transport once every client is done
+  '''
+  import httpx
+  return httpx.AsyncClient(
+    transport=transport,
+    cookies=cookies,
+    headers=headers,
+    follow_redirects=True,
+    timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+  )
@@ -1,82 +1,173 @@
 import psycopg2
+import psycopg2.pool
 import os
+import threading
 
-DB_HOSTNAME = os.environ['DB_HOSTNAME']
-DB_DATABASE = os.environ['DB_DATABASE']
-DB_USER = os.environ['DB_USER']
-DB_PASSWORD = os.environ['DB_PASSWORD']
+def connectionSettings():
+  # read when the pool is made instead of at import, so importing this doesn't need the database settings
+  return {
+    'host': os.environ['DB_HOSTNAME'],
+    'database': os.environ['DB_DATABASE'],
+    'user': os.environ['DB_USER'],
+    'password': os.environ['DB_PASSWORD'],
+  }
+
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 4))
+
+_pool = None
+_poolLock = threading.Lock()
+
+def getPool():
+  '''
+  Makes the connection pool the first time it's needed, later runs in the same worker reuse its connections
+  '''
+  global _pool
+  with _poolLock:
+    if _pool is None or _pool.closed:
+      _pool = psycopg2.pool.ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, **connectionSettings())
+    return _pool
 
 def createDBConnection():
-  conn = psycopg2.connect(
-    host=DB_HOSTNAME,
-    database=DB_DATABASE,
-    user=DB_USER,
-    password=DB_PASSWORD
-  )
-  return conn
-  
+  return getPool().getconn()
+
 def destroyDBConnection(conn):
-  conn.close()
-  
+  # give the connection back to the pool instead of closing it, a broken one gets thrown out
+  getPool().putconn(conn, close=bool(conn.closed))
+
+def closePool():
+  global _pool
+  with _poolLock:
+    if _pool is not None:
+      _pool.closeall()
+      _pool = None
+
 def addDay(days_from_epoch: int, conn):
-  cursor = conn.cursor()
+  return addDays([days_from_epoch], conn)
+
+def addDays(days_from_epoch: list[int], conn):
+  '''
+  Adds all the days in one transaction, days that are already in the table are skipped
+  (ON CONFLICT needs days_from_epoch to be the primary key or have a unique constraint)
+  '''
+  if len(days_from_epoch) == 0:
+    return True
   try:
-    cursor.execute(f"INSERT INTO days(days_from_epoch) VALUES({days_from_epoch})")
+    with conn.cursor() as cursor:
+      cursor.execute("INSERT INTO days(days_from_epoch) SELECT unnest(%s::integer[]) ON CONFLICT DO NOTHING", (list(days_from_epoch),))
     conn.commit()
-  except:
+  except psycopg2.Error:
     print("SQL insertion failed!!!")
-    cursor.close()
+    conn.rollback()
     return False
-    
-  cursor.close()
   return True
 
 def findDay(days_from_epoch: int, conn) -> int:
-  cursor = conn.cursor()
-  sql = f"SELECT days_from_epoch FROM days WHERE days_from_epoch = {days_from_epoch}"
+  return days_from_epoch if days_from_epoch in findDays([days_from_epoch], conn) else 0
+
+def findDays(days_from_epoch: list[int], conn) -> set[int]:
+  '''
+  Looks up all the days in one query
+
+  Returns: The days that are in the table
+  '''
+  if len(days_from_epoch) == 0:
+    return set()
   try:
-    cursor.execute(sql)
-  except:
+    with conn.cursor() as cursor:
+      cursor.execute("SELECT days_from_epoch FROM days WHERE days_from_epoch = ANY(%s)", (list(days_from_epoch),))
+      res = cursor.fetchall()
+    conn.commit() # don't leave the connection sitting in a transaction when it goes back to the pool
+  except psycopg2.Error:
     print("SQL selection failed!!!")
-    cursor.close()
-    return 0
-  
-  res = cursor.fetchone()
-  cursor.close()
-  return 0 if res == None else res[0]
+    conn.rollback()
+    return set()
+  return {row[0] for row in res}
 
 def deleteDay(days_from_epoch: int, conn) -> int:
-  cursor = conn.cursor()
   try:
-    cursor.execute(f"DELETE FROM days WHERE days_from_epoch = {days_from_epoch} RETURNING days_from_epoch")
+    with conn.cursor() as cursor:
+      cursor.execute("DELETE FROM days WHERE days_from_epoch = %s RETURNING days_from_epoch", (days_from_epoch,))
+      res = cursor.fetchone()
     conn.commit()
-  except:
+  except psycopg2.Error:
     print("SQL deletion failed!!!")
-    cursor.close()
+    conn.rollback()
     return 0
-  
-  res = cursor.fetchone()
+
   return 0 if res == None else res[0]
 
+_fingerprintTableReady = False
+
+def _ensureFingerprintTable(conn):
+  # only has to happen once per worker
+  global _fingerprintTableReady
+  if _fingerprintTableReady:
+    return
+  with conn.cursor() as cursor:
+    cursor.execute("CREATE TABLE IF NOT EXISTS availability_fingerprints(lid integer NOT NULL, date date NOT NULL, fingerprint varchar(64) NOT NULL, PRIMARY KEY (lid, date))")
+  conn.commit()
+  _fingerprintTableReady = True
+
+def findFingerprints(lid: int, dates: list[str], conn) -> dict[str, str]:
+  '''
+  Gets the fingerprints the last run saved for the dates (YYYY-MM-DD)
+
+  Returns: A dictionary of date -> fingerprint for the dates that have one
+  '''
+  if len(dates) == 0:
+    return {}
+  try:
+    _ensureFingerprintTable(conn)
+    with conn.cursor() as cursor:
+      cursor.execute("SELECT to_char(date, 'YYYY-MM-DD'), fingerprint FROM availability_fingerprints WHERE lid = %s AND date = ANY(%s::date[])", (lid, list(dates)))
+      res = cursor.fetchall()
+    conn.commit()
+  except psycopg2.Error:
+    print("SQL selection failed!!!")
+    conn.rollback()
+    return {}
+  return {date: fingerprint for date, fingerprint in res}
+
+def saveFingerprints(lid: int, fingerprints: dict[str, str], conn):
+  '''
+  Saves every date's fingerprint in one transaction, replacing the old ones, and forgets the ones for days that are over
+  '''
+  if len(fingerprints) == 0:
+    return True
+  try:
+    _ensureFingerprintTable(conn)
+    with conn.cursor() as cursor:
+      cursor.execute(
+        "INSERT INTO availability_fingerprints(lid, date, fingerprint) SELECT %s, unnest(%s::date[]), unnest(%s::varchar[]) "
+        "ON CONFLICT (lid, date) DO UPDATE SET fingerprint = EXCLUDED.fingerprint",
+        (lid, list(fingerprints.keys()), list(fingerprints.values()))
+      )
+      cursor.execute("DELETE FROM availability_fingerprints WHERE date < CURRENT_DATE")
+    conn.commit()
+  except psycopg2.Error:
+    print("SQL insertion failed!!!")
+    conn.rollback()
+    return False
+  return True
+
 def main():
-  print(f"{DB_HOSTNAME},{DB_DATABASE},{DB_USER},{DB_PASSWORD}")
-  
+  settings = connectionSettings()
+  print(f"{settings['host']},{settings['database']},{settings['user']}")
+
   conn = createDBConnection()
-  
-  print(addDay(3, conn))
-  print(addDay(4, conn))
-  print(addDay(5, conn))
-  print(addDay(22, conn))
-  
-  print(findDay(3, conn))
-  print(findDay(2, conn))
-  
+
+  print(addDays([3, 4, 5, 22], conn))
+
+  print(findDays([2, 3], conn))
+
   print(deleteDay(3,conn))
   print(deleteDay(2,conn))
-  
+
   print(findDay(3, conn))
   print(findDay(2, conn))
-  
+
   destroyDBConnection(conn)
+  closePool()
 if __name__ == "__main__":
-  main()
\ No newline at end of file
+  main()
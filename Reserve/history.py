@@ -0,0 +1,234 @@
+'''
+An append only history of every availability grid we download, to learn when rooms free up
+
+Every fetch adds one snapshot to the library's file in AVAILABILITY_HISTORY_DIR: when it was fetched, the date of the grid
+and a bit for every 30 minute slot of every room that was free (slots that run past midnight go in the second half).
+A room with nothing free doesn't show up on the page so it has no bits, that counts as taken. One snapshot is
+~16 bytes per room, so nothing about it needs the database. A grid that didn't change since the last snapshot of the
+same day is only written again after AVAILABILITY_HISTORY_INTERVAL seconds.
+
+The files are read with mmap and kept in memory per library and days out, later reads only pick up what was appended since,
+see freeProbability and churn.
+Record layout (little endian): header (b'AH', version, fetched at, date ordinal, rooms, bytes per room), the eids as uint32, the bits.
+'''
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from datetime import date
+from time import monotonic, time
+
+from Reserve import assignment, metrics
+from Types import AvailabilityIndex, AvailabilityMatrix, RoomAvailability
+
+# set to false to stop writing snapshots, point the folder somewhere persistent (like /home on azure) to keep them across restarts
+AVAILABILITY_HISTORY = os.environ.get('AVAILABILITY_HISTORY', 'true').lower() == 'true'
+AVAILABILITY_HISTORY_DIR = os.environ.get('AVAILABILITY_HISTORY_DIR', os.path.join(tempfile.gettempdir(), 'libcal-history'))
+AVAILABILITY_HISTORY_INTERVAL = float(os.environ.get('AVAILABILITY_HISTORY_INTERVAL', 300))
+# snapshots older than this many days aren't looked at anymore
+AVAILABILITY_HISTORY_DAYS = int(os.environ.get('AVAILABILITY_HISTORY_DAYS', 120))
+
+MAGIC = b'AH'
+VERSION = 1
+HEADER = struct.Struct('<2sBxdiHH')
+CELL_BYTES = (AvailabilityMatrix.SLOT_COUNT + 7) // 8
+
+class Snapshot:
+  __slots__ = ('fetchedAt', 'dateOrdinal', 'rooms')
+
+  def __init__(self, fetchedAt: float, dateOrdinal: int, rooms: dict[int, int]):
+    self.fetchedAt = fetchedAt
+    self.dateOrdinal = dateOrdinal
+    self.rooms = rooms # eid -> bits of the free slots, bit n is the slot that starts n*30 minutes after midnight
+
+  def daysOut(self):
+    return self.dateOrdinal - date.fromtimestamp(self.fetchedAt).toordinal()
+
+  def __repr__(self):
+    return f"Snapshot(date='{date.fromordinal(self.dateOrdinal)}', fetchedAt={self.fetchedAt:.0f}, rooms={len(self.rooms)})"
+
+def windowMask(startMinutes: int, slotCount: int = 1) -> int:
+  cell = startMinutes // AvailabilityIndex.SLOT_MINUTES
+  return ((1 << slotCount) - 1) << cell
+
+def gridBits(dateOrdinal: int, availabilityArray: list[RoomAvailability.RoomAvailability]) -> dict[int, int]:
+  '''
+  Turns a day's slots into the free bits of every room
+  '''
+  rooms: dict[int, int] = {}
+  for slot in availabilityArray:
+    cell = (slot.startMinutes + (slot.dateOrdinal - dateOrdinal) * 24 * 60) // AvailabilityIndex.SLOT_MINUTES
+    if 0 <= cell < AvailabilityMatrix.SLOT_COUNT:
+      rooms[slot.eid] = rooms.get(slot.eid, 0) | (1 << cell)
+  return rooms
+
+def packSnapshot(snapshot: Snapshot) -> bytes:
+  eids = sorted(snapshot.rooms)
+  return b''.join([
+    HEADER.pack(MAGIC, VERSION, snapshot.fetchedAt, snapshot.dateOrdinal, len(eids), CELL_BYTES),
+    struct.pack(f'<{len(eids)}I', *eids),
+    b''.join(snapshot.rooms[eid].to_bytes(CELL_BYTES, 'little') for eid in eids),
+  ])
+
+def unpackSnapshots(data, offset: int = 0) -> tuple[list[Snapshot], int]:
+  '''
+  Reads every whole snapshot in data from offset on, a record cut off by a crash (or still being written) at the end is left out
+
+  Returns: The snapshots and the offset right after the last one, where the next read can pick up
+  '''
+  snapshots: list[Snapshot] = []
+  while offset + HEADER.size <= len(data):
+    magic, version, fetchedAt, dateOrdinal, roomCount, cellBytes = HEADER.unpack_from(data, offset)
+    end = offset + HEADER.size + roomCount * (4 + cellBytes)
+    if magic != MAGIC or version != VERSION or end > len(data):
+      if end <= len(data):
+        logging.info(f"Availability history is damaged at byte {offset}, ignoring the rest")
+      break
+    eids = struct.unpack_from(f'<{roomCount}I', data, offset + HEADER.size)
+    bitsStart = offset + HEADER.size + roomCount * 4
+    rooms = {eid: int.from_bytes(data[bitsStart + index * cellBytes:bitsStart + (index + 1) * cellBytes], 'little') for index, eid in enumerate(eids)}
+    snapshots.append(Snapshot(fetchedAt, dateOrdinal, rooms))
+    offset = end
+  return snapshots, offset
+
+class AvailabilityHistory:
+  '''
+  The snapshot files of every library, safe to use from the fetch threads
+  '''
+
+  def __init__(self, directory: str = AVAILABILITY_HISTORY_DIR, maxAgeDays: int = AVAILABILITY_HISTORY_DAYS):
+    self.directory = directory
+    self.maxAgeDays = maxAgeDays
+    self._lock = threading.Lock()
+    self._lastWritten: dict[tuple[int, int], tuple[dict[int, int], float]] = {} # (lid, date ordinal) -> (bits, monotonic)
+    self._loadLock = threading.Lock() # one reader at a time, so nothing gets read twice
+    self._loaded: dict[int, tuple[int, dict[int, list[Snapshot]]]] = {} # lid -> (bytes read, days out -> snapshots in time order)
+
+  def path(self, lid: int):
+    return os.path.join(self.directory, f"{lid}.bin")
+
+  def record(self, lid: int, dateString: str, availabilityArray: list[RoomAvailability.RoomAvailability], fetchedAt: float = None) -> bool:
+    '''
+    Appends the grid of the date (YYYY-MM-DD) to the library's file, unless it's the same as the last one we wrote for that day
+
+    Returns: True if a snapshot was written
+    '''
+    dateOrdinal = date.fromisoformat(dateString).toordinal()
+    rooms = gridBits(dateOrdinal, availabilityArray)
+    with self._lock:
+      last = self._lastWritten.get((lid, dateOrdinal))
+      if last is not None and last[0] == rooms and monotonic() - last[1] < AVAILABILITY_HISTORY_INTERVAL:
+        return False
+      self._lastWritten[(lid, dateOrdinal)] = (rooms, monotonic())
+    data = packSnapshot(Snapshot(fetchedAt if fetchedAt is not None else time(), dateOrdinal, rooms))
+    try:
+      os.makedirs(self.directory, exist_ok=True)
+      # one write to a file opened for appending, so snapshots from different threads and workers don't get mixed up
+      fd = os.open(self.path(lid), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+      try:
+        os.write(fd, data)
+      finally:
+        os.close(fd)
+    except OSError as e:
+      logging.info(f"Couldn't save the availability history: {e}")
+      return False
+    metrics.count('historySnapshots')
+    return True
+
+  def snapshots(self, lid: int, offset: int = 0) -> tuple[list[Snapshot], int]:
+    '''
+    Every snapshot of the library from byte offset on, in the order they were written
+
+    Returns: The snapshots and the offset to read the next ones from
+    '''
+    try:
+      with open(self.path(lid), 'rb') as file:
+        if os.fstat(file.fileno()).st_size <= offset:
+          return [], offset
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+          return unpackSnapshots(data, offset)
+    except OSError:
+      return [], offset
+
+  def _daysOut(self, lid: int, daysOut: int) -> list[Snapshot]:
+    # the file is read once and split up by days out, after that only what was appended since is read
+    try:
+      size = os.path.getsize(self.path(lid))
+    except OSError:
+      size = 0
+    with self._loadLock:
+      offset, byDaysOut = self._loaded.get(lid, (0, {}))
+      if size < offset: # the file was replaced, start over
+        offset, byDaysOut = 0, {}
+      if size > offset:
+        oldest = time() - self.maxAgeDays * 24 * 60 * 60
+        snapshots, offset = self.snapshots(lid, offset)
+        for snapshot in snapshots:
+          if snapshot.fetchedAt >= oldest:
+            byDaysOut.setdefault(snapshot.daysOut(), []).append(snapshot)
+      self._loaded[lid] = (offset, byDaysOut)
+      return byDaysOut.get(daysOut, [])
+
+  def freeProbability(self, lid: int, eid: int, startMinutes: int, daysOut: int, slotCount: int = 1) -> float:
+    '''
+    How often the room had all slotCount slots from startMinutes (minutes after midnight) free when its day was daysOut days away
+
+    Returns: The share of snapshots it was free in, None when there aren't any snapshots that far out
+    '''
+    snapshots = self._daysOut(lid, daysOut)
+    if len(snapshots) == 0:
+      return None
+    mask = windowMask(startMinutes, slotCount)
+    return sum(1 for snapshot in snapshots if snapshot.rooms.get(eid, 0) & mask == mask) / len(snapshots)
+
+  def churn(self, lid: int, eid: int, startMinutes: int, daysOut: int) -> float:
+    '''
+    How often the slot went from taken to free or back between two snapshots of the same day, daysOut days out
+    A slot that keeps changing is worth watching, one that never does isn't
+
+    Returns: Changes per pair of snapshots, None when no day has two snapshots that far out
+    '''
+    mask = windowMask(startMinutes)
+    previous: dict[int, bool] = {}
+    pairs = 0
+    changes = 0
+    for snapshot in self._daysOut(lid, daysOut):
+      free = snapshot.rooms.get(eid, 0) & mask != 0
+      if snapshot.dateOrdinal in previous:
+        pairs += 1
+        changes += free != previous[snapshot.dateOrdinal]
+      previous[snapshot.dateOrdinal] = free
+    return changes / pairs if pairs > 0 else None
+
+  def successCost(self, daysOut: int, cost = assignment.roomPriorityCost, rooms: list = None, requests: list = None):
+    '''
+    A cost for assignment.assignRooms that tries the windows that were free most often daysOut days out first,
+    after room priority. cost has to return a tuple, the probability goes right after its first value
+    With rooms and requests, the probability of every window the requests can have in those rooms is worked out now,
+    so using the cost later (like right after a release) doesn't go through the history
+    '''
+    probabilities = {}
+    for request in requests or []:
+      for room in rooms or []:
+        for startMinutes in range(request.startMinutes, request.endMinutes - request.slots30mins * AvailabilityIndex.SLOT_MINUTES + 1, AvailabilityIndex.SLOT_MINUTES):
+          key = (room.lid, room.eid, startMinutes, request.slots30mins)
+          if key not in probabilities:
+            probabilities[key] = self.freeProbability(room.lid, room.eid, startMinutes, daysOut, request.slots30mins) or 0.0
+
+    def historyCost(request, room, startMinutes: int):
+      base = cost(request, room, startMinutes)
+      key = (room.lid, room.eid, startMinutes, request.slots30mins)
+      if key not in probabilities:
+        probabilities[key] = self.freeProbability(room.lid, room.eid, startMinutes, daysOut, request.slots30mins) or 0.0
+      return (base[0], -probabilities[key]) + tuple(base[1:])
+
+    return historyCost
+
+HISTORY = AvailabilityHistory()
+
+def record(lid: int, dateString: str, availabilityArray: list[RoomAvailability.RoomAvailability]):
+  # what the fetches call, does nothing when AVAILABILITY_HISTORY is off
+  if AVAILABILITY_HISTORY:
+    HISTORY.record(lid, dateString, availabilityArray)
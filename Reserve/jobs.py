@@ -0,0 +1,287 @@
+'''
+A queue of reservation jobs in postgres so the multi user run can be spread over any number of workers
+
+The timer puts one job for every (user, request, date) that still needs a room in the reservation_jobs table and
+workers lease them in small batches (SELECT ... FOR UPDATE SKIP LOCKED, so two workers never get the same job).
+Leasing takes a transaction level advisory lock on every user it hands a job out for and checks again, with a fresh
+snapshot, that nobody else holds a lease for them, so two workers can't lease the same user's jobs for different days.
+A worker that dies just lets its lease run out and the job is handed out again. A job is only marked done by the
+worker that holds its lease, in the same transaction that saves the Reservation, so a reservation is never saved twice.
+A user only has one job leased at a time and their next one waits CHECKOUT_SPACING_SECONDS after a checkout, like the
+CheckoutScheduler does with the time it saves in the session store.
+
+Run workers outside of azure with: python -m Reserve.jobs [--processes 4] [--forever]
+'''
+import argparse
+import logging
+import multiprocessing
+import os
+import socket
+import sys
+import uuid
+from datetime import datetime, timedelta
+from time import monotonic, sleep
+
+from sqlalchemy import and_, delete, exists, func, or_, text, tuple_, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session, aliased
+
+import db
+from Reserve import availability, batch, catalogue, history, metrics, reserve, scheduler
+
+# how long a worker has to finish a job before it's given to someone else (seconds)
+JOB_LEASE_SECONDS = float(os.environ.get('JOB_LEASE_SECONDS', 600))
+# how many jobs a worker takes at once, they're planned together like a small batch run
+JOB_BATCH_SIZE = int(os.environ.get('JOB_BATCH_SIZE', 20))
+# a job that didn't get a room is tried again after JOB_RETRY_SECONDS, up to JOB_MAX_ATTEMPTS times
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 5))
+JOB_RETRY_SECONDS = float(os.environ.get('JOB_RETRY_SECONDS', 900))
+# how long the timer works on the queue itself after filling it, keep it under the function timeout
+JOB_DRAIN_SECONDS = float(os.environ.get('JOB_DRAIN_SECONDS', 240))
+JOB_POLL_SECONDS = 5 # how long a --forever worker waits when there's nothing to do
+JOB_LOCK_NAMESPACE = 20020 # first key of the per user advisory locks, so they don't clash with other advisory locks
+
+_jobTableReady = False
+
+def ensureJobTable(engine):
+  # only has to happen once per worker
+  global _jobTableReady
+  if not _jobTableReady:
+    db.Base.metadata.create_all(engine, tables=[db.ReservationJob.__table__])
+    _jobTableReady = True
+
+def workerName():
+  return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+def dateFromDay(daySinceEpoch: int) -> datetime:
+  return datetime(1970, 1, 1) + timedelta(days=daySinceEpoch)
+
+def enqueueJobs(dbSession: Session, users: list[batch.BatchUser] = None) -> int:
+  '''
+  Adds a job for every user's request on every date in the next two weeks that isn't booked yet. A job that's already
+  in the queue is left alone, unless it failed or it's done but its reservation is gone (lost in a swap, cancelled...),
+  those start over as pending with no attempts, like the multi user run tries every date again every run.
+  Jobs for days that are over are removed.
+
+  Returns: How many jobs were added or started over
+  '''
+  users = users if users is not None else batch.usersFromDatabase(dbSession)
+  rows = [{'users_id': user.id, 'request_id': request.id, 'day_since_epoch': reserve.daysSinceEpoch(date)}
+          for user, request, date in batch.plannedUserDates(users) if request.id is not None]
+  dbSession.execute(delete(db.ReservationJob).where(db.ReservationJob.day_since_epoch < reserve.daysSinceEpoch(datetime.now())))
+  added = 0
+  if len(rows) > 0:
+    Job = db.ReservationJob
+    # the rows are only dates plannedUserDates found unbooked, a done job is checked again against the reservation table
+    # in case a worker booked it since the users were loaded
+    booked = exists().where(
+      db.Reservation.users_id == Job.users_id,
+      db.Reservation.day_since_epoch == Job.day_since_epoch,
+      db.ReservationRequest.id == Job.request_id,
+      db.Reservation.startTime >= db.ReservationRequest.startTime,
+      db.Reservation.endTime <= db.ReservationRequest.endTime)
+    retried = dbSession.execute(update(Job)
+      .where(tuple_(Job.users_id, Job.request_id, Job.day_since_epoch).in_([(row['users_id'], row['request_id'], row['day_since_epoch']) for row in rows]),
+             or_(Job.status == 'failed', and_(Job.status == 'done', ~booked)))
+      .values(status='pending', attempts=0, available_at=func.now(), last_error=None, updated=func.now())).rowcount
+    result = dbSession.execute(insert(Job).values(rows).on_conflict_do_nothing(index_elements=['users_id', 'request_id', 'day_since_epoch']))
+    added = result.rowcount + retried
+  dbSession.commit()
+  logging.info(f"Queued {added} new or retried reservation jobs ({len(rows) - added} were already queued)")
+  metrics.count('jobsEnqueued', added)
+  return added
+
+def leaseJobs(dbSession: Session, owner: str, limit: int = JOB_BATCH_SIZE) -> list[db.ReservationJob]:
+  '''
+  Takes up to limit jobs that are ready (pending, or leased by a worker whose lease ran out), at most one per user
+  and none for users that already have a job leased somewhere else
+
+  Returns: The leased jobs
+  '''
+  Job = db.ReservationJob
+  other = aliased(Job)
+  userBusy = exists().where(and_(other.users_id == Job.users_id, other.id != Job.id, other.status == 'leased', other.lease_expires > func.now()))
+  ready = or_(Job.status == 'pending', and_(Job.status == 'leased', Job.lease_expires <= func.now()))
+  candidates = (dbSession.query(Job)
+    .filter(ready, Job.available_at <= func.now(), ~userBusy)
+    .order_by(Job.day_since_epoch, Job.id)
+    .limit(limit * 4) # some get dropped below for being the same user's
+    .with_for_update(skip_locked=True)
+    .all())
+
+  # the NOT EXISTS above only sees leases that were committed before the query started, a worker leasing the same
+  # user right now isn't in it. Whoever gets a user's lock first wins and the others skip that user, and once we hold
+  # it any lease committed by somebody else is visible to the next statement
+  userIds = list(dict.fromkeys(job.users_id for job in candidates))
+  locked = set(dbSession.execute(text("SELECT users_id FROM unnest(CAST(:userIds AS integer[])) AS users_id WHERE pg_try_advisory_xact_lock(:namespace, users_id)"),
+                                 {'userIds': userIds, 'namespace': JOB_LOCK_NAMESPACE}).scalars()) if len(userIds) > 0 else set()
+  busy = {usersId for usersId, in dbSession.query(Job.users_id).filter(Job.users_id.in_(locked), Job.status == 'leased', Job.lease_expires > func.now()).distinct()} if len(locked) > 0 else set()
+
+  leased: list[db.ReservationJob] = []
+  users = set()
+  for job in candidates:
+    if job.users_id in users or job.users_id not in locked or job.users_id in busy or len(leased) == limit:
+      continue
+    users.add(job.users_id)
+    job.status = 'leased'
+    job.lease_owner = owner
+    job.lease_expires = func.now() + timedelta(seconds=JOB_LEASE_SECONDS)
+    job.attempts = job.attempts + 1
+    job.updated = func.now()
+    leased.append(job)
+  dbSession.commit()
+  for job in leased: # get the values the database filled in
+    dbSession.refresh(job)
+  metrics.count('jobsLeased', len(leased))
+  return leased
+
+def _ownedJob(job: db.ReservationJob, owner: str):
+  # only the worker holding the lease can finish the job
+  Job = db.ReservationJob
+  return and_(Job.id == job.id, Job.status == 'leased', Job.lease_owner == owner)
+
+def completeJob(dbSession: Session, job: db.ReservationJob, owner: str, plan: batch.PlannedReservation = None) -> bool:
+  '''
+  Marks the job done and saves the plan's reservation in the same transaction, does nothing if the lease was lost
+  The user's other jobs wait CHECKOUT_SPACING after a checkout so the confirmation email has time to go out
+
+  Returns: True if this worker completed the job
+  '''
+  Job = db.ReservationJob
+  result = dbSession.execute(update(Job).where(_ownedJob(job, owner)).values(status='done', lease_owner=None, lease_expires=None, last_error=None, updated=func.now()))
+  if result.rowcount != 1:
+    dbSession.rollback()
+    logging.info(f"Lost the lease on {job}, somebody else is finishing it")
+    return False
+  if plan is not None:
+    dbSession.add(batch.reservationFromPlan(plan))
+    spacedUntil = func.now() + timedelta(seconds=scheduler.CHECKOUT_SPACING)
+    dbSession.execute(update(Job).where(Job.users_id == job.users_id, Job.status == 'pending').values(available_at=func.greatest(Job.available_at, spacedUntil)))
+  dbSession.commit()
+  metrics.count('jobsDone')
+  return True
+
+def releaseJob(dbSession: Session, job: db.ReservationJob, owner: str, error: str, deferred: bool = False):
+  '''
+  Gives the job back to the queue to be tried again after JOB_RETRY_SECONDS, or marks it failed once it ran out of attempts
+  A deferred job (the checkout scheduler left it for later) gets its attempt back and is tried again after CHECKOUT_SPACING
+  '''
+  Job = db.ReservationJob
+  if deferred:
+    dbSession.execute(update(Job).where(_ownedJob(job, owner)).values(
+      status='pending',
+      attempts=Job.attempts - 1,
+      lease_owner=None,
+      lease_expires=None,
+      available_at=func.now() + timedelta(seconds=scheduler.CHECKOUT_SPACING),
+      updated=func.now()
+      ))
+    dbSession.commit()
+    metrics.count('jobsDeferred')
+    return
+  status = 'failed' if job.attempts >= JOB_MAX_ATTEMPTS else 'pending'
+  dbSession.execute(update(Job).where(_ownedJob(job, owner)).values(
+    status=status,
+    lease_owner=None,
+    lease_expires=None,
+    available_at=func.now() + timedelta(seconds=JOB_RETRY_SECONDS),
+    last_error=error[:256],
+    updated=func.now()
+    ))
+  dbSession.commit()
+  metrics.count('jobsFailed' if status == 'failed' else 'jobsRetried')
+
+def processJobs(dbSession: Session, owner: str, jobs: list[db.ReservationJob]) -> int:
+  '''
+  Plans and checks out the leased jobs like a small batch run, with a freshly downloaded grid since other workers
+  are booking rooms at the same time
+
+  Returns: How many jobs got a reservation
+  '''
+  users = {user.id: user for user in batch.usersFromDatabase(dbSession, list({job.users_id for job in jobs}))}
+  userDates = []
+  jobsByKey: dict[tuple[int, int, int], db.ReservationJob] = {}
+  for job in jobs:
+    user = users.get(job.users_id)
+    request = next((request for request in user.reservationRequests if request.id == job.request_id), None) if user is not None else None
+    date = dateFromDay(job.day_since_epoch)
+    if request is None or user.isBooked(request, date): # nothing left to do, the request was removed or it's already reserved
+      completeJob(dbSession, job, owner)
+      continue
+    userDates.append((user, request, date))
+    jobsByKey[(user.id, request.id, job.day_since_epoch)] = job
+  if len(userDates) == 0:
+    return 0
+
+  rooms = catalogue.loadRooms(dbSession, availability.LIBRARIES)
+  dateStrings = list(dict.fromkeys(reserve.createDateStringsForRequest(date) for _, _, date in userDates))
+  availabilityMap = availability.getLibraryAvailabilityMap([(library.lid, date) for date in dateStrings for library in availability.LIBRARIES], runCache={}, sharedCache=None)
+  indexMap = reserve.indexAvailabilityMap(availability.mergeLibraries(availabilityMap))
+  with metrics.span('match'):
+    plans = batch.planReservations(userDates, indexMap, rooms, availabilityHistory=history.HISTORY)
+
+  def jobFor(plan: batch.PlannedReservation):
+    return jobsByKey.pop((plan.user.id, plan.request.id, reserve.daysSinceEpoch(plan.date)))
+
+  completed = {id(plan) for plan in batch.checkoutPlans(plans)}
+  reserved = 0
+  for plan in plans:
+    job = jobFor(plan)
+    if id(plan) in completed:
+      reserved += completeJob(dbSession, job, owner, plan)
+    else:
+      releaseJob(dbSession, job, owner, 'the checkout failed', deferred=plan.deferred)
+  for job in jobsByKey.values(): # no plan, so no room was free
+    releaseJob(dbSession, job, owner, 'no room was free')
+  return reserved
+
+def drain(deadline: float = None, forever: bool = False, owner: str = None) -> int:
+  '''
+  Works on jobs until the queue is empty (or forever), stopping before a new batch once monotonic() passes deadline
+
+  Returns: How many reservations were made
+  '''
+  engine = db.createEngine()
+  ensureJobTable(engine)
+  owner = owner if owner is not None else workerName()
+  reserved = 0
+  with Session(engine) as dbSession:
+    while deadline is None or monotonic() < deadline:
+      jobs = leaseJobs(dbSession, owner)
+      if len(jobs) == 0:
+        if not forever:
+          break
+        sleep(JOB_POLL_SECONDS)
+        continue
+      logging.info(f"{owner} leased {len(jobs)} jobs")
+      reserved += processJobs(dbSession, owner, jobs)
+  logging.info(f"{owner} made {reserved} reservations")
+  return reserved
+
+def main():
+  '''
+  What the timer does in queue mode: fills the queue and then works on it until JOB_DRAIN_SECONDS are up,
+  anything left is picked up by the other workers or the next run
+  '''
+  deadline = monotonic() + JOB_DRAIN_SECONDS
+  engine = db.createEngine()
+  ensureJobTable(engine)
+  with Session(engine) as dbSession:
+    with metrics.span('db load'):
+      enqueueJobs(dbSession)
+  drain(deadline)
+
+def _workerProcess(forever: bool):
+  logging.basicConfig(level=logging.INFO, format=f"%(asctime)s [{os.getpid()}] %(message)s")
+  drain(forever=forever)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+  parser.add_argument('--forever', action='store_true', help='keep waiting for new jobs instead of stopping once the queue is empty')
+  args = parser.parse_args(sys.argv[1:])
+  workers = [multiprocessing.Process(target=_workerProcess, args=(args.forever,)) for _ in range(max(1, args.processes))]
+  for worker in workers:
+    worker.start()
+  for worker in workers:
+    worker.join()
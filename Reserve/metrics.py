@@ -0,0 +1,107 @@
+import contextlib
+import json
+import logging
+import os
+import threading
+from time import perf_counter
+
+# turns on the per stage timings and counters, when it's off span() and count() don't do anything
+METRICS_ENABLED = os.environ.get('RESERVE_METRICS', 'false').lower() == 'true'
+
+_NO_SPAN = contextlib.nullcontext()
+
+class RunMetrics:
+  '''
+  Timings and counters for one run of the bot, safe to use from the checkout and fetch threads
+  '''
+
+  def __init__(self, name: str):
+    self.name = name
+    self.spans: dict[str, list[float]] = {} # stage -> [times it ran, total seconds, longest seconds]
+    self.counters: dict[str, float] = {}
+    self._lock = threading.Lock()
+    self._start = perf_counter()
+
+  @contextlib.contextmanager
+  def span(self, stage: str):
+    start = perf_counter()
+    try:
+      yield
+    finally:
+      self.addSpan(stage, perf_counter() - start)
+
+  def addSpan(self, stage: str, seconds: float):
+    with self._lock:
+      span = self.spans.setdefault(stage, [0, 0.0, 0.0])
+      span[0] += 1
+      span[1] += seconds
+      span[2] = max(span[2], seconds)
+
+  def count(self, counter: str, amount = 1):
+    with self._lock:
+      self.counters[counter] = self.counters.get(counter, 0) + amount
+
+  def summary(self) -> dict:
+    with self._lock:
+      return {
+        'run': self.name,
+        'seconds': round(perf_counter() - self._start, 3),
+        'stages': {stage: {'count': count, 'seconds': round(total, 3), 'max': round(longest, 3)} for stage, (count, total, longest) in self.spans.items()},
+        'counters': dict(self.counters),
+      }
+
+  def emit(self):
+    '''
+    Logs the whole summary as one json line, and every value on its own with custom_dimensions
+    so application insights (or anything else reading the logs) can chart them as metrics
+    '''
+    summary = self.summary()
+    logging.info(f"Run metrics: {json.dumps(summary)}")
+    for stage, values in summary['stages'].items():
+      logging.info(f"metric reserve.{stage}", extra={'custom_dimensions': {'run': self.name, 'name': f"reserve.{stage}", 'value': values['seconds'], 'count': values['count'], 'max': values['max']}})
+    for counter, value in summary['counters'].items():
+      logging.info(f"metric reserve.{counter}", extra={'custom_dimensions': {'run': self.name, 'name': f"reserve.{counter}", 'value': value}})
+    return summary
+
+_current: RunMetrics = None
+
+def startRun(name: str, enabled: bool = None) -> RunMetrics:
+  '''
+  Starts collecting for a run, returns None when metrics are off
+  '''
+  global _current
+  if not (METRICS_ENABLED if enabled is None else enabled):
+    _current = None
+    return None
+  _current = RunMetrics(name)
+  return _current
+
+def finishRun() -> dict:
+  '''
+  Emits the current run's summary and stops collecting
+
+  Returns: The summary, or None when metrics are off
+  '''
+  global _current
+  run, _current = _current, None
+  return run.emit() if run is not None else None
+
+def span(stage: str):
+  '''
+  Times the code in a with block as the stage
+  '''
+  run = _current
+  return _NO_SPAN if run is None else run.span(stage)
+
+def addSpan(stage: str, seconds: float):
+  '''
+  Adds a time that was measured some other way to the stage
+  '''
+  run = _current
+  if run is not None:
+    run.addSpan(stage, seconds)
+
+def count(counter: str, amount = 1):
+  run = _current
+  if run is not None:
+    run.count(counter, amount)
@@ -1,35 +1,52 @@
 import logging
 import os
 import re
-from datetime import datetime, time, timedelta
-from time import sleep
+from concurrent.futures import Future
+from datetime import datetime, timedelta
 
 import requests
-from bs4 import BeautifulSoup
 
-from Reserve import database
+from Reserve import availability, database, metrics, scheduler, sessions
 # import database
 
-from Types import Room, RoomAvailability, ReservationRequest
+from Types import AvailabilityIndex, AvailabilityMatrix, Room, RoomAvailability, ReservationRequest
 
-CONCORDIA_USERNAME = os.environ['CONCORDIA_USERNAME']
-CONCORDIA_PASSWORD = os.environ['CONCORDIA_PASSWORD']
+# only needed for the single user run, the batch run uses the credentials stored with every user
+CONCORDIA_USERNAME = os.environ.get('CONCORDIA_USERNAME')
+CONCORDIA_PASSWORD = os.environ.get('CONCORDIA_PASSWORD')
 
 LIBCAL_AUTH_REGEX_CHECK = re.compile(r'<h2>Redirecting \.\.\.</h2>')
 LIBCAL_FAILED_RESERVATION_REGEX = re.compile(r'Sorry')
+LIBCAL_BOOKING_ID_REGEX = re.compile(r'\bcs_[A-Za-z0-9]+')
 
 RESERVATION_TIMES = ReservationRequest.KOOSHA_RESERVATION_TIMES
 
-LID = 2161 # library id
+# skip the days whose availability grid hasn't changed since the last run
+INCREMENTAL_MODE = os.environ.get('INCREMENTAL_MODE', 'false').lower() == 'true'
+# run the reservation pipeline on asyncio (httpx and asyncpg), every user's login and checkouts are their own task
+ASYNC_PIPELINE = os.environ.get('ASYNC_PIPELINE', 'false').lower() == 'true'
+# put all of a user's reservations in as few carts as possible instead of checking out each one on its own
+CART_BATCHING = os.environ.get('CART_BATCHING', 'false').lower() == 'true'
+# the most reservations libcal takes in one cart, bigger batches are split up before they're sent
+CART_MAX_RESERVATIONS = int(os.environ.get('CART_MAX_RESERVATIONS', 4))
+CART_ROUND_TRIPS = 3 # createcart, authcheck and checkout, what every cart costs on top of logging in
+# with at least this many (request, date) searches in a run, every day and room is searched at once with a numpy AvailabilityMatrix
+# instead of looping over the rooms of every day. benchmarks/matrix_bench has the matrix (building it included) catching up at
+# ~70 searches for the solver's windows and ~100 for the first room, a single user's horizon (14 at most) stays on the loop.
+# The first matrix of a process also pays for importing numpy (~40ms)
+VECTORIZED_SEARCH_MIN = int(os.environ.get('VECTORIZED_SEARCH_MIN', 100))
+
+LID = availability.LIBRARIES[0].lid # library id, the single user run only looks in the first library
+GID = availability.LIBRARIES[0].gid # space group id
+
+CONCORDIA_LIBCAL_URL = RoomAvailability.LIBCAL_URL
+CONCORDIA_AUTH_URL = os.environ.get('CONCORDIA_AUTH_URL', 'https://fas.concordia.ca')
 
 HEADERS = {
   'User-Agent': 'Mozilla/5.0',
-  'Referer': 'https://concordiauniversity.libcal.com/reserve/webster',
+  'Referer': f'{CONCORDIA_LIBCAL_URL}/reserve/webster',
 }
 
-CONCORDIA_LIBCAL_URL = 'https://concordiauniversity.libcal.com'
-CONCORDIA_AUTH_URL = 'https://fas.concordia.ca'
-
 def reservationDaysInTwoWeeksFromNow(day = RESERVATION_TIMES[0]):
   '''
   Gets the dates that are within 14 days from now and are on the day that is passed in from RESERVATION_TIMES
@@ -66,59 +83,99 @@ def createDateStringsForRequest(date: datetime):
 
 
  
-def getRoomAvailabilityArray(availabilityArray: list[RoomAvailability.RoomAvailability], room = Room.LIB_ALL[0]):
+def plannedReservationDates(reservationTimes = RESERVATION_TIMES):
+  '''
+  Pairs every reservation request with the dates it lands on in the next two weeks
+
+  Returns: An array of (ReservationRequest, datetime) tuples in the order they should be checked
+  '''
+  return [(day, date) for day in reservationTimes for date in reservationDaysInTwoWeeksFromNow(day)]
+
+def indexAvailabilityMap(availabilityMap: dict[str, list[RoomAvailability.RoomAvailability]]):
   '''
-  Filters out the array to only contain the specified room information
+  Builds the per room index for every day in the availability map
+
+  Returns: A dictionary of date string (YYYY-MM-DD) -> AvailabilityIndex
+  '''
+  with metrics.span('index'):
+    return {date: AvailabilityIndex.AvailabilityIndex(availabilityArray) for date, availabilityArray in availabilityMap.items()}
+
+def getRoomAvailabilityArray(availabilityIndex: AvailabilityIndex.AvailabilityIndex, room = Room.LIB_ALL[0]):
+  '''
+  Gets the specified room's slots for the day, sorted by start time
+  '''
+  return availabilityIndex.slots(room.eid)
+
+def getRoomWindows(roomArray: list[RoomAvailability.RoomAvailability], reservationTime = RESERVATION_TIMES[0], roomStartMinutes = None):
+  '''
+  Finds every set of back to back slots in the room that covers the number of slots the reservation time wants
+  without going outside of its start and end time
+  roomStartMinutes can be the already parsed start times of roomArray (like the ones in AvailabilityIndex) so they don't get parsed again
+
+  Returns: An array with the slots of every window that works, earliest first
   '''
-  # array is of type RoomAvailability and itterates on availabilityArray
-  return list(filter(lambda array: int(array.eid) == room.eid, availabilityArray))
+  if roomStartMinutes is None:
+    roomStartMinutes = [AvailabilityIndex.slotStartMinutes(slot) for slot in roomArray]
+  fromMinutes = reservationTime.startMinutes
+  toMinutes = reservationTime.endMinutes
+  slotCount = reservationTime.slots30mins
+  return [roomArray[index:index+slotCount] for index in AvailabilityIndex.findAvailableWindows(roomStartMinutes, fromMinutes, toMinutes, slotCount)]
 
-def isRoomAvailableInTime(roomArray: list[RoomAvailability.RoomAvailability], reservationTime = RESERVATION_TIMES[0], room = Room.LIB_ALL[0]):
+def isRoomAvailableInTime(roomArray: list[RoomAvailability.RoomAvailability], reservationTime = RESERVATION_TIMES[0], room = Room.LIB_ALL[0], roomStartMinutes = None):
   '''
   Checks if the room is available between the times specified in the reservation time
   If it is available, returns an array of the room slot dictionaries that was given by room aray but only the ones that are between the times
   Else, it returns False
   '''
-  # turn time strings into time objects
-  # the *map thing is pretty weird, it can process times much faster than datetime can on its own. idk why lol
-  startTime = time(*map(int, reservationTime.startTime.split(':')))
-  endTime = time(*map(int, reservationTime.endTime.split(':')))
-  slotsInTime: list[RoomAvailability.RoomAvailability] = []
-  consecutiveSlots = reservationTime.slots30mins
-  
-  for slot in roomArray:
-    # room times are formatted like 'YYYY-MM-DD hh:mm:ss', take second half and do the same thing as above
-    roomStartTime = time(*map(int, slot.start.split(' ')[1].split(':')))
-    
-    if consecutiveSlots == 0: # we have a room that is available for every time slot that we wanted
-      break
-    
-    if roomStartTime >= startTime and roomStartTime <= endTime: # append all the slots within the time to an array to make creating the reservations easier
-      consecutiveSlots -= 1
-      slotsInTime.append(slot)
-      logging.debug(f"\t\t{startTime} > {roomStartTime} > {endTime}")
-    else: # reset the counter if we miss a slot, so we definitely dont send a partial reservation
-      consecutiveSlots = reservationTime.slots30mins
-  if consecutiveSlots == 0: 
-    return slotsInTime
-  else:
+  windows = getRoomWindows(roomArray, reservationTime, roomStartMinutes)
+  if len(windows) == 0:
     return False
+  logging.debug(f"\t\t{room.name} has {len(windows)} windows between {reservationTime.startTime} and {reservationTime.endTime}")
+  return windows[0]
 
-def createFormForRequest(slots: list):
+def findRoom(availabilityIndex: AvailabilityIndex.AvailabilityIndex, reservationTime = RESERVATION_TIMES[0], rooms = Room.LIB_FLOOR_3, matrix: AvailabilityMatrix.AvailabilityMatrix = None, dateString: str = None):
   '''
-  Converts the reservation 
+  Finds the first room (in the order of rooms) that's free for the whole reservation time
+  Pass in a matrix built over the same rooms and the date string to look it up there instead of going through the rooms one by one
+
+  Returns: (room, the room's slots for the reservation), or None if no room is free
   '''
-  # create the stuff that doesn't change in the form and then add the extra stuff
-  form = {
+  if matrix is not None:
+    found = matrix.firstWindow(dateString, reservationTime.startMinutes, reservationTime.endMinutes, reservationTime.slots30mins)
+    if found is None:
+      return None
+    room, index = found
+    return room, availabilityIndex.slots(room.eid)[index:index+reservationTime.slots30mins]
+  for room in rooms:
+    logging.info(f"\tRoom: {room.name}")
+    roomTimes = getRoomAvailabilityArray(availabilityIndex, room)
+    slots = isRoomAvailableInTime(roomTimes, reservationTime, room, availabilityIndex.startMinutes(room.eid))
+    if slots != False:
+      return room, slots
+  return None
+
+def createFormBase():
+  '''
+  The part of the createcart form that doesn't change between reservations
+  '''
+  return {
     "libAuth": "true",
     "blowAwayCart": "true",
     "method": 14,
-    "returnUrl": f"/r/accessible?lid={LID}&gid=5032&zone=0&space=0&capacity=2&accessible=0&powered=0",
+    "returnUrl": f"/r/accessible?lid={LID}&gid={GID}&zone=0&space=0&capacity=2&accessible=0&powered=0",
   }
+
+def createFormForRequest(slots: list, formBase: dict = None):
+  '''
+  Converts the reservation 
+  formBase can be a form made ahead of time with createFormBase
+  '''
+  # create the stuff that doesn't change in the form and then add the extra stuff
+  form = dict(formBase) if formBase is not None else createFormBase()
   # transform the information in the slots to the gross data layout that libcal wants
   for index, slot in enumerate(slots):
-      for key in slot.__dict__:
-        form[f'bookings[{index}][{key}]'] = slot.__dict__[key]
+    for key, value in slot.formFields():
+      form[f'bookings[{index}][{key}]'] = value
   
   return form
 
@@ -126,103 +183,325 @@ def daysSinceEpoch(date: datetime):
   return (date - datetime(1970, 1, 1)).days
 
 def dateFromReservation(reservation: list[RoomAvailability.RoomAvailability]):
-  return datetime(*map(int, reservation[0].start.split(' ')[0].split('-')))
+  return datetime.fromordinal(reservation[0].dateOrdinal)
 
-def getAuth(session: requests.Session, redirectRes: str):
-  
-  soup = BeautifulSoup(redirectRes, features="html.parser")
-  params = {input['name']: input['value'] for input in soup.find_all('input')}
-  libcalCookieAdderUrl = soup.form['action']
-  libcalCookieAdderRes = session.get(libcalCookieAdderUrl, params=params, headers=HEADERS, allow_redirects=True)
-  
-  soup = BeautifulSoup(libcalCookieAdderRes.text, features="html.parser")
+def authRedirectRequest(redirectHtml: str):
+  '''
+  The first login step, libcal's redirect page has a form that sends us to the concordia login
+
+  Returns: (url, query params)
+  '''
+  from bs4 import BeautifulSoup # only needed when we have to log in, so it's not loaded on every cold start
+  soup = BeautifulSoup(redirectHtml, features="html.parser")
+  return soup.form['action'], {input['name']: input['value'] for input in soup.find_all('input')}
+
+def authLoginRequest(loginHtml: str, username: str = None, password: str = None):
+  '''
+  The concordia login form filled in with the credentials, CONCORDIA_USERNAME and CONCORDIA_PASSWORD when none are passed in
+
+  Returns: (url, form data)
+  '''
+  from bs4 import BeautifulSoup
+  soup = BeautifulSoup(loginHtml, features="html.parser")
   data = {
-    'UserName': CONCORDIA_USERNAME,
-    'Password': CONCORDIA_PASSWORD,
+    'UserName': username if username is not None else CONCORDIA_USERNAME,
+    'Password': password if password is not None else CONCORDIA_PASSWORD,
     'AuthMethod': 'FormsAuthentication'
     }
-  microsoftAuthUrl = f"{CONCORDIA_AUTH_URL}{soup.form['action']}"
+  return f"{CONCORDIA_AUTH_URL}{soup.form['action']}", data
+
+def authLinkRequest(loggedInHtml: str):
+  '''
+  The form that hands the login back to libcal
+
+  Returns: (url, form data)
+  '''
+  from bs4 import BeautifulSoup
+  soup = BeautifulSoup(loggedInHtml, features="html.parser")
+  data = {input['name']: input['value'] for input in soup.find_all('input', {'type': 'hidden'})} # theres a visible submit button that messes with the data so filter it out
+  return soup.form['action'], data
+
+def getAuth(session: requests.Session, redirectRes: str, username: str = None, password: str = None):
+  '''
+  Goes through the libcal -> concordia login -> libcal redirects so the session's cookies are logged in as username
+  Uses CONCORDIA_USERNAME and CONCORDIA_PASSWORD when no credentials are passed in
+  '''
+  libcalCookieAdderUrl, params = authRedirectRequest(redirectRes)
+  libcalCookieAdderRes = session.get(libcalCookieAdderUrl, params=params, headers=HEADERS, allow_redirects=True)
+  libcalCookieAdderRes.raise_for_status()
+  
+  microsoftAuthUrl, data = authLoginRequest(libcalCookieAdderRes.text, username, password)
   microsoftAuthRes = session.post(microsoftAuthUrl, data=data, headers=HEADERS, allow_redirects=True)
+  microsoftAuthRes.raise_for_status()
   
-  soup = BeautifulSoup(microsoftAuthRes.text, features="html.parser")
-  concordiaAuthLinkUrl = soup.form['action']
-  data = {input['name']: input['value'] for input in soup.find_all('input', {'type': 'hidden'})} # theres a visible submit button that messes with the data so filter it out
+  concordiaAuthLinkUrl, data = authLinkRequest(microsoftAuthRes.text)
   res = session.post(concordiaAuthLinkUrl, data=data, headers=HEADERS, allow_redirects=True)
+  res.raise_for_status()
   logging.info(res.text)
   # we are done authenticating now
+
+def cartRedirectUrl(createCartRes):
+  '''
+  Where createcart sends us next, the auth check page
+
+  Returns: The full url
+  '''
+  try: # an error page instead of the json would crash here without saying why
+    return f"{CONCORDIA_LIBCAL_URL}{createCartRes.json()['redirect']}"
+  except (ValueError, KeyError, TypeError):
+    raise RuntimeError(f"Libcal didn't make the cart ({createCartRes.status_code}): {createCartRes.text[:200]}")
+
+def createCart(session: requests.Session, reservationSlots: list[RoomAvailability.RoomAvailability], username: str = None, password: str = None, formBase: dict = None):
+  '''
+  Puts the slots in a cart, logging in with getAuth if libcal asks for it
+  The cart is thrown away by the next createcart (blowAwayCart), so this can also be used to log in ahead of time
+
+  Returns: True if it had to log in
+  '''
+  createCart = f'{CONCORDIA_LIBCAL_URL}/ajax/space/createcart'
+  data = createFormForRequest(reservationSlots, formBase)
+  with metrics.span('createcart'):
+    createCartRes = session.post(createCart, data=data, headers=HEADERS, allow_redirects=True)
+  
+  authCheckUrl = cartRedirectUrl(createCartRes)
+  with metrics.span('authcheck'):
+    authCheckRes = session.get(authCheckUrl, headers=HEADERS, allow_redirects=True)
+  authCheckRes.raise_for_status()
+  metrics.count('httpRequests', 2)
+  
+  authRequired = bool(LIBCAL_AUTH_REGEX_CHECK.findall(authCheckRes.text))
+  if authRequired: # we got redirected to the auth check
+    with metrics.span('auth'):
+      getAuth(session=session, redirectRes=authCheckRes.text, username=username, password=password)
+    metrics.count('httpRequests', sessions.AUTH_ROUND_TRIPS)
+  sessions.recordAuthCheck(session, authRequired)
+  return authRequired
+
+def checkoutForm():
+  return {
+    'forcedEmail': '',
+    'returnUrl': f"/r/accessible?lid={LID}&gid={GID}&zone=0&space=0&capacity=2&accessible=0&powered=0",
+    'logoutUrl': "logout",
+    'session': 0
+  }
+
+def checkConfirmation(confirmationRes):
+  '''
+  Counts the checkout, and raises when libcal neither booked the cart nor said it was already taken
+  '''
+  metrics.count('httpRequests')
+  alreadyReserved = isAlreadyReserved(confirmationRes)
+  if confirmationRes.status_code != 200 and not alreadyReserved: # nothing was booked, don't let it get saved as a reservation
+    raise RuntimeError(f"Libcal didn't check out the cart ({confirmationRes.status_code}): {confirmationRes.text[:200]}")
+  metrics.count('alreadyReserved' if alreadyReserved else 'checkouts')
+
+def bookingIdFromConfirmation(confirmationRes):
+  '''
+  The id libcal gave the booking (cs_...), the same one that's in the cancel link of the confirmation email
+
+  Returns: The id, or None when nothing was booked
+  '''
+  if confirmationRes is None or confirmationRes.status_code != 200:
+    return None
+  try:
+    bookingId = confirmationRes.json().get('bookId')
+  except (ValueError, AttributeError):
+    bookingId = None
+  if bookingId:
+    return str(bookingId)
+  match = LIBCAL_BOOKING_ID_REGEX.search(confirmationRes.text) # older pages only have it in the html
+  return match.group(0) if match else None
+
+def checkoutCart(session: requests.Session):
+  '''
+  Checks out whatever createCart put in the session's cart
+
+  Returns: The response from the checkout request
+  '''
+  confirmReservationUrl = f"{CONCORDIA_LIBCAL_URL}/ajax/equipment/checkout"
+  with metrics.span('checkout'):
+    confirmationRes = session.post(confirmReservationUrl, data=checkoutForm(), headers=HEADERS, allow_redirects=True)
+  checkConfirmation(confirmationRes)
+  
+  logging.debug(confirmationRes)
+  return confirmationRes
+
+def checkoutReservation(session: requests.Session, reservationSlots: list[RoomAvailability.RoomAvailability], username: str = None, password: str = None, formBase: dict = None):
+  '''
+  Puts the slots in a cart and checks it out, logging in with getAuth if libcal asks for it
+
+  Returns: The response from the checkout request
+  '''
+  createCart(session, reservationSlots, username, password, formBase)
+  return checkoutCart(session)
+
+def cancelUrl(bookingId: str):
+  # the link libcal puts in the confirmation email
+  return f"{CONCORDIA_LIBCAL_URL}/equipment/cancel?id={bookingId}"
+
+def cancelBooking(session: requests.Session, bookingId: str, username: str = None, password: str = None):
+  '''
+  Cancels a booking the way the email's cancel link does: opens the cancel page (logging in with getAuth if libcal asks for it)
+  and sends the cancel request it would send
+
+  Returns: The response from the cancel request
+  '''
+  with metrics.span('cancelpage'):
+    cancelPageRes = session.get(cancelUrl(bookingId), headers=HEADERS, allow_redirects=True)
+  cancelPageRes.raise_for_status()
+  metrics.count('httpRequests')
+  if LIBCAL_AUTH_REGEX_CHECK.findall(cancelPageRes.text):
+    with metrics.span('auth'):
+      getAuth(session=session, redirectRes=cancelPageRes.text, username=username, password=password)
+    metrics.count('httpRequests', sessions.AUTH_ROUND_TRIPS)
+
+  with metrics.span('cancel'):
+    cancelRes = session.post(f"{CONCORDIA_LIBCAL_URL}/ajax/equipment/cancel", data={'id': bookingId}, headers=HEADERS, allow_redirects=True)
+  metrics.count('httpRequests')
+  if cancelRes.status_code != 200:
+    raise RuntimeError(f"Libcal didn't cancel {bookingId} ({cancelRes.status_code}): {cancelRes.text[:200]}")
+  metrics.count('cancellations')
+  return cancelRes
+
+def failedReservationsFromError(errorText: str, reservations: list[list[RoomAvailability.RoomAvailability]]) -> list[int]:
+  '''
+  Looks for the reservations whose slots (room and start time) are named in libcal's sorry message
+
+  Returns: The indexes of those reservations, empty when the message doesn't say which one it was
+  '''
+  return [index for index, reservationSlots in enumerate(reservations) if any(slot.start in errorText and str(slot.eid) in errorText for slot in reservationSlots)]
+
+def checkoutReservations(session: requests.Session, reservations: list[list[RoomAvailability.RoomAvailability]], username: str = None, password: str = None, formBase: dict = None, maxPerCart: int = CART_MAX_RESERVATIONS) -> list[Future]:
+  '''
+  Books all of the reservations with as few carts as possible, at most maxPerCart of them in each.
+  When libcal refuses a cart the reservations its sorry message names are checked out on their own and the
+  rest are tried again together, when it doesn't say which one was taken the cart is split in half until it goes through.
+  A cart that blows up some other way only fails its own reservations.
+
+  Returns: A future for every reservation, in the same order, with the checkout response that booked it
+  (a sorry response if it was already taken) or the exception that stopped it
+  '''
+  results = [Future() for _ in reservations]
+  pending = [list(range(index, min(index + maxPerCart, len(reservations)))) for index in range(0, len(reservations), max(1, maxPerCart))]
+  carts = 0
+  while len(pending) > 0:
+    cart = pending.pop(0)
+    carts += 1
+    try:
+      confirmationRes = checkoutReservation(session, [slot for index in cart for slot in reservations[index]], username, password, formBase)
+    except Exception as e:
+      # only this cart's reservations failed (a 503 on the checkout, a createcart error, ...), the other carts still get their turn
+      logging.info(f"Cart of {len(cart)} reservations failed: {e!r}")
+      for index in cart:
+        results[index].set_exception(e)
+      continue
+    if len(cart) == 1 or confirmationRes.status_code == 200:
+      for index in cart:
+        results[index].set_result(confirmationRes)
+      continue
+    # something in the cart couldn't be booked, figure out what and try the rest again
+    named = [cart[index] for index in failedReservationsFromError(confirmationRes.text, [reservations[index] for index in cart])]
+    if 0 < len(named) < len(cart):
+      pending = [[index] for index in named] + [[index for index in cart if index not in named]] + pending
+    else:
+      half = len(cart) // 2
+      pending = [cart[:half], cart[half:]] + pending
+
+  saved = CART_ROUND_TRIPS * (len(reservations) - carts)
+  metrics.count('carts', carts)
+  metrics.count('cartRoundTripsSaved', saved)
+  logging.info(f"Checked out {len(reservations)} reservations in {carts} carts, saved {saved} round trips")
+  return results
+
+def isAlreadyReserved(confirmationRes):
+  '''
+  Libcal answers with a 500 and a sorry message when the slots were already booked
+  '''
+  return confirmationRes.status_code == 500 and bool(LIBCAL_FAILED_RESERVATION_REGEX.findall(confirmationRes.text))
   
 def main(): 
   reservations: list[list[RoomAvailability.RoomAvailability]] = []
-  for day in RESERVATION_TIMES:
-    logging.info(f"Looking to reserve a room for the following {day.dow}s")
-    reservationDates = reservationDaysInTwoWeeksFromNow(day)
-    
-    for date in reservationDates:
-      logging.info(datetime.ctime(date))
-      start = createDateStringsForRequest(date)
-      createCartRes = RoomAvailability.getAvailabilityArray(start)
-      reservationMade = False
-      if reservationMade:
-        break
-      for room in Room.LIB_FLOOR_3:
-        logging.info(f"\tRoom: {room.name}")
-        roomTimes = getRoomAvailabilityArray(createCartRes, room)
-        slots = isRoomAvailableInTime(roomTimes, day, room)
-        if slots != False:
-          logging.info(f"## We have a room!! {room.name} is available between {day.startTime} and {day.endTime} on {datetime.ctime(date)}")
-          reservations.append(slots)
-          reservationMade = True
-          break
-      if not reservationMade:
-        logging.info(f"No possible slots found for {datetime.ctime(date)}")
-
+  plannedDates = plannedReservationDates()
   conn = database.createDBConnection()
-    
-  # filter out the reservations that are in the database
-  reservations = list(filter(lambda reservation: database.findDay(daysSinceEpoch(dateFromReservation(reservation)), conn) == 0, reservations)) 
+  try: # the connection goes back to the pool even when a download or checkout blows up
 
-  if len(reservations) == 0:
-    logging.info('Theres nothing to reserve! Quiting...')
-    return
+    # days that are already in the database are done, so leave them out before downloading anything
+    with metrics.span('db filter'):
+      reservedDays = database.findDays([daysSinceEpoch(date) for _, date in plannedDates], conn)
+    plannedDates = [(day, date) for day, date in plannedDates if daysSinceEpoch(date) not in reservedDays]
+    if len(plannedDates) == 0:
+      logging.info('Theres nothing to reserve! Quiting...')
+      return
 
-  # make session for all the reservation requests  
-  session = requests.Session()
+    runCache = {} # (lid, date) -> availability, shared by every request in this run
+    # grab every day we care about up front so the downloads can happen at the same time
+    # never from the grids earlier runs (or the api) left in the shared cache, booking a slot that's gone since gets a sorry back that looks like we already have it
+    availabilityMap = availability.getAvailabilityMap([createDateStringsForRequest(date) for _, date in plannedDates], LID, runCache=runCache, sharedCache=None)
+
+    fingerprints = {}
+    if INCREMENTAL_MODE: # only look at the days whose grid changed since the last run
+      fingerprints = {start: availability.gridFingerprint(availabilityArray, [day for day, date in plannedDates if createDateStringsForRequest(date) == start]) for start, availabilityArray in availabilityMap.items()}
+      with metrics.span('db filter'):
+        previousFingerprints = database.findFingerprints(LID, list(fingerprints), conn)
+      unchangedDates = {start for start, fingerprint in fingerprints.items() if previousFingerprints.get(start) == fingerprint}
+      logging.info(f"{len(unchangedDates)} of {len(fingerprints)} days haven't changed since the last run, skipping them")
+      metrics.count('unchangedDays', len(unchangedDates))
+      plannedDates = [(day, date) for day, date in plannedDates if createDateStringsForRequest(date) not in unchangedDates]
+      availabilityMap = {start: availabilityArray for start, availabilityArray in availabilityMap.items() if start not in unchangedDates}
+
+    indexMap = indexAvailabilityMap(availabilityMap)
   
-  for reservationSlots in reservations:
-    
-    logging.info(datetime.ctime(dateFromReservation(reservationSlots)))
-        
-    createCart = f'{CONCORDIA_LIBCAL_URL}/ajax/space/createcart'
-    data = createFormForRequest(reservationSlots)
-    createCartRes = session.post(createCart, data=data, headers=HEADERS, allow_redirects=True)
-    
-    authCheckUrl = f"{CONCORDIA_LIBCAL_URL}{createCartRes.json()['redirect']}"
-    authCheckRes = session.get(authCheckUrl, headers=HEADERS, allow_redirects=True)
-    
-    if bool(LIBCAL_AUTH_REGEX_CHECK.findall(authCheckRes.text)): # we got redirected to the auth check
-      getAuth(session=session, redirectRes=authCheckRes.text)
-    
-    confirmReservationUrl = f"{CONCORDIA_LIBCAL_URL}/ajax/equipment/checkout"
-    data = {
-      'forcedEmail': '',
-      'returnUrl': f"/r/accessible?lid={LID}&gid=5032&zone=0&space=0&capacity=2&accessible=0&powered=0",
-      'logoutUrl': "logout",
-      'session': 0
-    }
-    confirmationRes = session.post(confirmReservationUrl, data=data, headers=HEADERS, allow_redirects=True)
-    
-    logging.debug(confirmationRes)
-    
-    if confirmationRes.status_code == 500 and bool(LIBCAL_FAILED_RESERVATION_REGEX.findall(confirmationRes.text)):
-      logging.info(confirmationRes.text)
-      logging.info("Oops, it seems like we reserved this date already... Adding to database")
-    elif reservationSlots != reservations[-1]: # this is not the last reservation, we should sleep to give the email service time to send before making the next reservation
-      sleep(240)
-            
-    database.addDay(daysSinceEpoch(dateFromReservation(reservationSlots)), conn)
+    with metrics.span('match'):
+      matrix = AvailabilityMatrix.AvailabilityMatrix(indexMap, Room.LIB_FLOOR_3) if len(plannedDates) >= VECTORIZED_SEARCH_MIN else None
+      for day, date in plannedDates:
+        logging.info(f"Looking to reserve a room on {day.dow} {datetime.ctime(date)}")
+        start = createDateStringsForRequest(date)
+        found = findRoom(indexMap[start], day, Room.LIB_FLOOR_3, matrix, start)
+        if found is None:
+          logging.info(f"No possible slots found for {datetime.ctime(date)}")
+          continue
+        room, slots = found
+        logging.info(f"## We have a room!! {room.name} is available between {day.startTime} and {day.endTime} on {datetime.ctime(date)}")
+        reservations.append(slots)
+
+    futures = []
+    session = None
+    if len(reservations) == 0:
+      logging.info('Theres nothing to reserve!')
+    else:
+      # make session for all the reservation requests, reusing the cookies from the last run if they're still good
+      session = sessions.loadSession(CONCORDIA_USERNAME)
     
-  
-  database.destroyDBConnection(conn)
+      def reserveSlots(reservationSlots: list[RoomAvailability.RoomAvailability]):
+        logging.info(datetime.ctime(dateFromReservation(reservationSlots)))
+        confirmationRes = checkoutReservation(session, reservationSlots)
+      
+        if isAlreadyReserved(confirmationRes):
+          logging.info(confirmationRes.text)
+          logging.info("Oops, it seems like we reserved this date already... Adding to database")
+        return confirmationRes
+
+      if CART_BATCHING: # everything goes in as few carts as libcal takes, each reservation still gets its own future
+        futures = list(zip(reservations, checkoutReservations(session, reservations)))
+        for reservationSlots, future in futures:
+          if future.exception() is None and isAlreadyReserved(future.result()):
+            logging.info(f"Oops, it seems like we reserved {datetime.ctime(dateFromReservation(reservationSlots))} already... Adding to database")
+      else:
+        # the scheduler gives the email service time to send between reservations, unless libcal didn't book anything
+        with scheduler.CheckoutScheduler(needsSpacing=lambda confirmationRes: not isAlreadyReserved(confirmationRes)) as checkouts:
+          futures = [(reservationSlots, checkouts.submit(CONCORDIA_USERNAME, lambda reservationSlots=reservationSlots: reserveSlots(reservationSlots))) for reservationSlots in reservations]
+
+    # every day that went through gets saved in one transaction
+    with metrics.span('db write'):
+      database.addDays([daysSinceEpoch(dateFromReservation(reservationSlots)) for reservationSlots, future in futures if future.exception() is None], conn)
+      # a day whose checkout blew up has to be looked at again next run even if its grid stays the same
+      failedDates = {createDateStringsForRequest(dateFromReservation(reservationSlots)) for reservationSlots, future in futures if future.exception() is not None}
+      database.saveFingerprints(LID, {start: fingerprint for start, fingerprint in fingerprints.items() if start not in failedDates}, conn)
+    if session is not None:
+      sessions.saveSession(CONCORDIA_USERNAME, session)
+      sessions.logMetrics()
+  finally:
+    database.destroyDBConnection(conn)
   
   
 def test():
@@ -230,28 +509,27 @@ def test():
   Do a local run of things, Does not access the database or make any reservations. Outputs all info to stdout.
   '''
   reservations: list[list[RoomAvailability.RoomAvailability]] = []
-  for day in RESERVATION_TIMES:
-    print(f"Looking to reserve a room for the following {day.dow}s")
-    reservationDates = reservationDaysInTwoWeeksFromNow(day)
-    print(reservationDates)
-    for date in reservationDates:
-      print(datetime.ctime(date))
-      start = createDateStringsForRequest(date)
-      createCartRes = RoomAvailability.getAvailabilityArray(start)
-      reservationMade = False
-      if reservationMade:
+  plannedDates = plannedReservationDates()
+  print([date for _, date in plannedDates])
+  availabilityMap = availability.getAvailabilityMap([createDateStringsForRequest(date) for _, date in plannedDates], LID, runCache={})
+  indexMap = indexAvailabilityMap(availabilityMap)
+  
+  for day, date in plannedDates:
+    print(f"Looking to reserve a room on {day.dow} {datetime.ctime(date)}")
+    start = createDateStringsForRequest(date)
+    availabilityIndex = indexMap[start]
+    reservationMade = False
+    for room in Room.LIB_ALL:
+      print(f"\tRoom: {room.name}")
+      roomTimes = getRoomAvailabilityArray(availabilityIndex, room)
+      slots = isRoomAvailableInTime(roomTimes, day, room, availabilityIndex.startMinutes(room.eid))
+      if slots != False:
+        print(f"## We have a room!! {room.name} is available between {day.startTime} and {day.endTime} on {datetime.ctime(date)}")
+        reservations.append(slots)
+        reservationMade = True
         break
-      for room in Room.LIB_ALL:
-        print(f"\tRoom: {room.name}")
-        roomTimes = getRoomAvailabilityArray(createCartRes, room)
-        slots = isRoomAvailableInTime(roomTimes, day, room)
-        if slots != False:
-          print(f"## We have a room!! {room.name} is available between {day.startTime} and {day.endTime} on {datetime.ctime(date)}")
-          reservations.append(slots)
-          reservationMade = True
-          break
-      if not reservationMade:
-        print(f"No possible slots found for {datetime.ctime(date)}")
+    if not reservationMade:
+      print(f"No possible slots found for {datetime.ctime(date)}")
   for reservation in reservations:
     print(f"{reservation}\n")
     print(createFormForRequest(reservation))
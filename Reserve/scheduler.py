@@ -0,0 +1,155 @@
+import heapq
+import itertools
+import logging
+import os
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from time import monotonic, time
+
+from Reserve import metrics, sessions
+
+# time between two checkouts on the same account so libcal's confirmation email goes out before the next one
+CHECKOUT_SPACING = float(os.environ.get('CHECKOUT_SPACING_SECONDS', 240))
+# how many accounts can be checking out at the same time
+CHECKOUT_MAX_CONCURRENCY = int(os.environ.get('CHECKOUT_MAX_CONCURRENCY', 8))
+# how long an account can wait for its turns in a run in total, the checkouts that would wait longer are left for the next run.
+# one spacing by default, so an account gets two checkouts a run and the run still fits in the 5 minute function timeout
+CHECKOUT_MAX_WAIT = float(os.environ.get('CHECKOUT_MAX_WAIT_SECONDS', CHECKOUT_SPACING))
+
+class CheckoutDeferred(Exception):
+  '''
+  Set on the checkouts that were left for the next run because their account isn't allowed to check out again yet
+  '''
+
+def alwaysSpace(result):
+  return True
+
+class CheckoutScheduler:
+  '''
+  Runs checkouts for different accounts at the same time while each account's own checkouts run one after the other,
+  with `spacing` seconds between them.
+  needsSpacing(result) is called with what a checkout returned, when it says False (like when nothing was booked so no email
+  was sent) the account's next checkout starts right away.
+  Nobody sleeps while waiting for an account's turn: a single dispatcher thread keeps a heap of when each account is
+  allowed to go next and only hands jobs to the worker pool once they're ready.
+  With persist, when an account can go next is also saved in the session store (sessions.saveNextCheckout), so the spacing
+  holds across runs. Once an account has waited maxWait seconds in total for its turns, its checkouts that would have to
+  wait more fail with CheckoutDeferred instead of holding up the run, the next run picks them up.
+  '''
+
+  def __init__(self, spacing = CHECKOUT_SPACING, maxConcurrency = CHECKOUT_MAX_CONCURRENCY, needsSpacing = alwaysSpace, maxWait = CHECKOUT_MAX_WAIT, persist = True):
+    self.spacing = spacing
+    self.needsSpacing = needsSpacing
+    self.maxWait = maxWait
+    self._waited: dict[object, float] = {} # account -> seconds it has waited for its turns so far
+    self.persist = persist
+    self._executor = ThreadPoolExecutor(max_workers=max(1, maxConcurrency), thread_name_prefix='checkout')
+    self._condition = threading.Condition()
+    self._queues: dict[object, deque] = {} # account -> deque of (job, future, time submitted) waiting for their turn
+    self._busy: set = set() # accounts that have a checkout running or waiting in the heap
+    self._heap: list = [] # (time the account can go, tiebreaker, account)
+    self._counter = itertools.count()
+    self._futures: list[Future] = []
+    self._closed = False
+    self._dispatcher = threading.Thread(target=self._dispatch, name='checkout-dispatcher', daemon=True)
+    self._dispatcher.start()
+
+  def submit(self, account, job) -> Future:
+    '''
+    Queues job (a function with no arguments) to run on the account's turn
+
+    Returns: A future with whatever job returns
+    '''
+    future = Future()
+    delay = max(0, sessions.loadNextCheckout(account) - time()) if self.persist else 0
+    with self._condition:
+      if self._closed:
+        raise RuntimeError('The checkout scheduler is already shut down')
+      self._queues.setdefault(account, deque()).append((job, future, monotonic()))
+      self._futures.append(future)
+      if account not in self._busy:
+        self._busy.add(account)
+        self._schedule(account, delay)
+        self._condition.notify()
+    return future
+
+  def _schedule(self, account, delay: float):
+    # called with the lock held, the account's queue isn't empty
+    waited = self._waited.get(account, 0) + delay
+    if waited <= self.maxWait:
+      self._waited[account] = waited
+      heapq.heappush(self._heap, (monotonic() + delay, next(self._counter), account))
+      return
+    queue = self._queues.pop(account)
+    self._busy.discard(account)
+    logging.info(f"Leaving {len(queue)} checkouts of {account} for the next run, its turn is {delay:.0f}s away")
+    metrics.count('checkoutsDeferred', len(queue))
+    for _, future, _ in queue:
+      if future.set_running_or_notify_cancel():
+        future.set_exception(CheckoutDeferred('left for the next run'))
+
+  def _dispatch(self):
+    while True:
+      with self._condition:
+        while True:
+          if self._closed and len(self._heap) == 0 and len(self._busy) == 0:
+            return
+          if len(self._heap) > 0 and self._heap[0][0] <= monotonic():
+            break
+          timeout = None if len(self._heap) == 0 else self._heap[0][0] - monotonic()
+          self._condition.wait(timeout)
+        _, _, account = heapq.heappop(self._heap)
+        job, future, submittedAt = self._queues[account].popleft()
+      metrics.addSpan('checkout wait', monotonic() - submittedAt) # what the old sleep(240) calls used to cost
+      if future.set_running_or_notify_cancel():
+        self._executor.submit(self._run, account, job, future)
+      else:
+        self._finished(account, 0)
+
+  def _run(self, account, job, future: Future):
+    delay = 0
+    try:
+      try:
+        result = job()
+      except BaseException as e:
+        logging.info(f"Checkout for {account} failed: {e}")
+        future.set_exception(e)
+        return
+      future.set_result(result)
+      try: # the future is already done, whatever goes wrong from here on only costs the spacing
+        delay = self.spacing if self.needsSpacing(result) else 0
+        if self.persist and delay > 0:
+          sessions.saveNextCheckout(account, time() + delay)
+      except Exception as e:
+        logging.info(f"Couldn't work out the spacing after {account}'s checkout: {e}")
+        delay = self.spacing
+    finally:
+      self._finished(account, delay)
+
+  def _finished(self, account, delay: float):
+    with self._condition:
+      if len(self._queues[account]) > 0:
+        self._schedule(account, delay)
+      else:
+        self._busy.discard(account)
+        del self._queues[account]
+      self._condition.notify()
+
+  def join(self):
+    '''
+    Waits until every checkout that was submitted is done or deferred and stops the scheduler
+    '''
+    with self._condition:
+      self._closed = True
+      self._condition.notify()
+      futures = list(self._futures)
+    wait(futures)
+    self._dispatcher.join()
+    self._executor.shutdown(wait=True)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.join()
@@ -0,0 +1,143 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from time import time
+
+import requests
+
+from Reserve import client, metrics
+
+# where the logged in cookies are kept between runs, point it at a persistent folder (like /home on azure) to keep them across restarts
+SESSION_STORE_DIR = os.environ.get('SESSION_STORE_DIR', os.path.join(tempfile.gettempdir(), 'libcal-sessions'))
+# cookies that only last for the browser session don't have an expiry, so don't trust them for longer than this (seconds)
+SESSION_MAX_AGE = float(os.environ.get('SESSION_MAX_AGE', 8 * 60 * 60))
+# don't bother with cookies that are about to expire, they might not last until checkout
+SESSION_EXPIRY_MARGIN = 60
+
+AUTH_ROUND_TRIPS = 3 # requests getAuth makes to log in
+
+_metricsLock = threading.Lock()
+METRICS = {
+  'sessionsRestored': 0,
+  'sessionsStale': 0,
+  'authRuns': 0,
+  'authRoundTrips': 0,
+  'authRoundTripsAvoided': 0,
+}
+
+def _sessionPath(username: str):
+  # don't put the email address in the file name
+  return os.path.join(SESSION_STORE_DIR, f"{hashlib.sha256(username.encode()).hexdigest()}.json")
+
+def _nextCheckoutPath(account):
+  return os.path.join(SESSION_STORE_DIR, f"{hashlib.sha256(str(account).encode()).hexdigest()}.next")
+
+def _replaceFile(path: str, text: str):
+  os.makedirs(SESSION_STORE_DIR, mode=0o700, exist_ok=True)
+  # write to a temp file and swap it in so a crash never leaves half a file behind
+  fd, tempPath = tempfile.mkstemp(dir=SESSION_STORE_DIR)
+  with os.fdopen(fd, 'w') as file:
+    file.write(text)
+  os.replace(tempPath, path)
+
+def _countMetric(name: str, amount = 1):
+  with _metricsLock:
+    METRICS[name] += amount
+  metrics.count(name, amount)
+
+def isStoredSessionValid(stored: dict, now: float = None):
+  '''
+  Checks the saved cookies without making any requests: there has to be at least one, none of them can be expired,
+  and cookies without an expiry are only trusted for SESSION_MAX_AGE after they were saved
+  '''
+  now = time() if now is None else now
+  cookies = stored.get('cookies', [])
+  if len(cookies) == 0:
+    return False
+  if now - stored.get('savedAt', 0) > SESSION_MAX_AGE and any(cookie.get('expires') is None for cookie in cookies):
+    return False
+  return all(cookie.get('expires') is None or cookie['expires'] > now + SESSION_EXPIRY_MARGIN for cookie in cookies)
+
+def loadSession(username: str) -> requests.Session:
+  '''
+  Makes a session for the user, with their libcal and login cookies from the last run if they're still good
+  session.restored tells if the cookies came from the store
+  '''
+  session = client.createSession()
+  session.restored = False
+  if username is None:
+    return session
+
+  try:
+    with open(_sessionPath(username)) as file:
+      stored = json.load(file)
+  except (OSError, ValueError):
+    return session
+
+  if not isStoredSessionValid(stored):
+    _countMetric('sessionsStale')
+    return session
+
+  for cookie in stored['cookies']:
+    session.cookies.set(cookie['name'], cookie['value'], domain=cookie['domain'], path=cookie['path'], expires=cookie['expires'], secure=cookie['secure'])
+  session.restored = True
+  _countMetric('sessionsRestored')
+  return session
+
+def saveSession(username: str, session: requests.Session):
+  '''
+  Writes the session's cookies to the store so the next run can skip logging in
+  '''
+  if username is None:
+    return
+  stored = {
+    'savedAt': time(),
+    'cookies': [{
+      'name': cookie.name,
+      'value': cookie.value,
+      'domain': cookie.domain,
+      'path': cookie.path,
+      'expires': cookie.expires,
+      'secure': cookie.secure,
+    } for cookie in session.cookies],
+  }
+  try:
+    _replaceFile(_sessionPath(username), json.dumps(stored))
+  except OSError as e:
+    logging.info(f"Couldn't save the session: {e}")
+
+def loadNextCheckout(account) -> float:
+  '''
+  When the account is allowed to check out again (unix time), so the spacing between checkouts holds across runs
+
+  Returns: The time saved by the account's last checkout, 0 if there isn't one
+  '''
+  try:
+    with open(_nextCheckoutPath(account)) as file:
+      return float(file.read())
+  except (OSError, ValueError):
+    return 0
+
+def saveNextCheckout(account, nextAt: float):
+  try:
+    _replaceFile(_nextCheckoutPath(account), repr(nextAt))
+  except OSError as e:
+    logging.info(f"Couldn't save when {account} can check out next: {e}")
+
+def recordAuthCheck(session: requests.Session, authRan: bool):
+  '''
+  Keeps track of how often we had to log in and how many login requests the stored cookies saved us
+  '''
+  if authRan:
+    session.restored = False # the stored cookies didn't work, so later checkouts didn't avoid anything either
+    _countMetric('authRuns')
+    _countMetric('authRoundTrips', AUTH_ROUND_TRIPS)
+  elif getattr(session, 'restored', False):
+    _countMetric('authRoundTripsAvoided', AUTH_ROUND_TRIPS)
+
+def logMetrics():
+  with _metricsLock:
+    logging.info(f"Sessions: {METRICS['sessionsRestored']} restored, {METRICS['sessionsStale']} stale, {METRICS['authRuns']} logins ({METRICS['authRoundTrips']} round trips), {METRICS['authRoundTripsAvoided']} login round trips avoided")
@@ -0,0 +1,161 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from time import monotonic, sleep
+
+from Reserve import assignment, availability, history, metrics, reserve, scheduler, sessions
+from Types import AvailabilityIndex, Room, RoomAvailability
+
+# when libcal opens the next day on the rolling two week window (local time) and how far out that day is
+SNIPER_RELEASE_TIME = os.environ.get('SNIPER_RELEASE_TIME', '00:00:00')
+SNIPER_HORIZON_DAYS = int(os.environ.get('SNIPER_HORIZON_DAYS', 14))
+# how often the new day's grid is downloaded, how early before the release we start and how long we keep trying after it
+SNIPER_POLL_INTERVAL = float(os.environ.get('SNIPER_POLL_INTERVAL', 0.5))
+SNIPER_LEAD_SECONDS = float(os.environ.get('SNIPER_LEAD_SECONDS', 5))
+SNIPER_WINDOW_SECONDS = float(os.environ.get('SNIPER_WINDOW_SECONDS', 120))
+# a function started longer than this before the release would time out waiting, SNIPER_SCHEDULE doesn't match the release
+SNIPER_MAX_EARLY_SECONDS = 5 * 60
+
+def nextRelease(now: datetime = None) -> datetime:
+  '''
+  The next time a day opens up, today's release if we're still inside its window, tomorrow's otherwise
+  '''
+  now = datetime.now() if now is None else now
+  release = datetime.combine(now.date(), datetime.strptime(SNIPER_RELEASE_TIME, "%H:%M:%S").time())
+  if release + timedelta(seconds=SNIPER_WINDOW_SECONDS) < now:
+    release += timedelta(days=1)
+  return release
+
+def warmUp(users, userSessions: dict, targetDate: datetime):
+  '''
+  Logs in every user whose stored session isn't good anymore, so nobody has to go through getAuth after the release
+  Any slot that's free tomorrow is put in a throwaway cart to get to the login page, the real createcart blows that cart away
+  '''
+  coldUsers = [user for user in users if not userSessions[user.id].restored]
+  if len(coldUsers) == 0:
+    return
+  warmDate = reserve.createDateStringsForRequest(min(targetDate, datetime.now() + timedelta(days=1)))
+  warmSlots = availability.getAvailabilityMap([warmDate], reserve.LID)[warmDate][:1]
+  if len(warmSlots) == 0:
+    logging.info('No free slot to log in with, users will log in when they check out')
+    return
+
+  def logIn(user):
+    with metrics.span('sniper warm up'):
+      reserve.createCart(userSessions[user.id], warmSlots, user.username, user.password)
+
+  with ThreadPoolExecutor(max_workers=scheduler.CHECKOUT_MAX_CONCURRENCY) as executor:
+    for future in [executor.submit(logIn, user) for user in coldUsers]:
+      if future.exception() is not None:
+        logging.info(f"Couldn't log in ahead of time: {future.exception()}")
+
+def snipe(users, releaseAt: datetime, targetDate: datetime, rooms: list[Room.Room] = Room.LIB_ALL):
+  '''
+  Polls the target date's availability every SNIPER_POLL_INTERVAL seconds from just before releaseAt and books the
+  users' requests for that date the moment their slots show up, until every request is booked or the window is over.
+  Everything that can be done before the release (logging in, the form, the keep alive connection) is done first.
+
+  Returns: The PlannedReservations that got booked
+  '''
+  from Reserve import batch # only needed once there's something to snipe
+
+  pending = [(user, request) for user in users for request in user.reservationRequests
+             if request.iso_weekday == targetDate.isoweekday() and not user.isBooked(request, targetDate)]
+  if len(pending) == 0:
+    logging.info(f"Nobody wants {datetime.ctime(targetDate)}, nothing to snipe")
+    return []
+
+  targetStr = reserve.createDateStringsForRequest(targetDate)
+  logging.info(f"Sniping {len(pending)} requests for {targetStr}, released at {releaseAt}")
+  pendingUsers = {user.id: user for user, _ in pending}.values()
+  userSessions = {user.id: sessions.loadSession(user.username) for user in pendingUsers}
+  warmUp(pendingUsers, userSessions, targetDate)
+  formBase = reserve.createFormBase()
+  # rooms that were usually still free this far out are the ones least likely to be taken before we check out,
+  # the whole table is worked out now so the history isn't read between the release and the checkout
+  successCost = history.HISTORY.successCost(targetDate.toordinal() - datetime.now().toordinal(), rooms=rooms, requests=[request for _, request in pending])
+  pollSession = availability.createPooledSession(1)
+
+  startAt = releaseAt - timedelta(seconds=SNIPER_LEAD_SECONDS)
+  if datetime.now() < startAt:
+    sleep((startAt - datetime.now()).total_seconds())
+  deadline = monotonic() + max(0, (releaseAt - datetime.now()).total_seconds()) + SNIPER_WINDOW_SECONDS
+
+  def reservePlan(plan):
+    confirmationRes = reserve.checkoutReservation(userSessions[plan.user.id], plan.slots, plan.user.username, plan.user.password, formBase)
+    if reserve.isAlreadyReserved(confirmationRes): # somebody beat us to it, keep polling
+      raise RuntimeError(f"{plan.room.name} was taken before we could check out")
+    secondsAfterRelease = max(0, (datetime.now() - releaseAt).total_seconds())
+    metrics.addSpan('sniper release to confirmation', secondsAfterRelease)
+    logging.info(f"## Sniped {plan} {secondsAfterRelease:.2f}s after the release")
+    return confirmationRes
+
+  booked = []
+  polls = 0
+  while len(pending) > 0 and monotonic() < deadline:
+    pollStart = monotonic()
+    polls += 1
+    try:
+      with metrics.span('sniper poll'):
+        availabilityArray = RoomAvailability.getAvailabilityArray(targetStr, reserve.LID, pollSession)
+      history.record(reserve.LID, targetStr, availabilityArray)
+      availabilityIndex = AvailabilityIndex.AvailabilityIndex(availabilityArray)
+    except Exception as e:
+      logging.info(f"Poll failed: {e}")
+      availabilityIndex = None
+
+    if availabilityIndex is not None and len(availabilityIndex) > 0:
+      candidates = assignment.assignRooms([request for _, request in pending], availabilityIndex, rooms, successCost)
+      plans = [batch.PlannedReservation(user, request, targetDate, candidate.room, availabilityIndex.slots(candidate.room.eid)[candidate.index:candidate.index+request.slots30mins])
+               for (user, request), candidate in zip(pending, candidates) if candidate is not None]
+      if len(plans) > 0:
+        # no spacing and no saved turns here: a user's second plan can't wait CHECKOUT_SPACING (or for the next run) while
+        # the slots are up for grabs, and the poll loop can't stop for it either
+        with scheduler.CheckoutScheduler(spacing=0, persist=False) as checkouts:
+          futures = [(plan, checkouts.submit(plan.user.username, lambda plan=plan: reservePlan(plan))) for plan in plans]
+        bookedNow = [plan for plan, future in futures if future.exception() is None]
+        for plan, future in futures:
+          if future.exception() is None:
+            plan.bookingId = reserve.bookingIdFromConfirmation(future.result())
+        booked += bookedNow
+        pending = [(user, request) for user, request in pending if not any(plan.user is user and plan.request is request for plan in bookedNow)]
+
+    sleep(max(0, SNIPER_POLL_INTERVAL - (monotonic() - pollStart)))
+
+  metrics.count('sniperPolls', polls)
+  logging.info(f"Sniper done after {polls} polls, booked {len(booked)}, {len(pending)} requests left")
+  for user in pendingUsers:
+    sessions.saveSession(user.username, userSessions[user.id])
+  return booked
+
+def main():
+  '''
+  Snipes the day that opens at the next release for the single CONCORDIA_USERNAME account, or for every user in the database with MULTI_USER_MODE
+  '''
+  from Reserve import batch
+  releaseAt = nextRelease()
+  if (releaseAt - datetime.now()).total_seconds() > SNIPER_MAX_EARLY_SECONDS:
+    logging.info(f"The next release is at {releaseAt}, too far off to wait for. SNIPER_SCHEDULE should start the function a minute before SNIPER_RELEASE_TIME")
+    return
+  targetDate = releaseAt + timedelta(days=SNIPER_HORIZON_DAYS)
+
+  if os.environ.get('MULTI_USER_MODE', 'false').lower() == 'true':
+    import db
+    from sqlalchemy.orm import Session
+    with Session(db.createEngine()) as dbSession:
+      users = batch.usersFromDatabase(dbSession)
+      batch.recordReservations(dbSession, snipe(users, releaseAt, targetDate))
+    return
+
+  from Reserve import database
+  conn = database.createDBConnection()
+  try:
+    if reserve.daysSinceEpoch(targetDate) in database.findDays([reserve.daysSinceEpoch(targetDate)], conn):
+      logging.info(f"{datetime.ctime(targetDate)} is already reserved")
+      return
+    user = batch.BatchUser(0, reserve.CONCORDIA_USERNAME, reserve.CONCORDIA_PASSWORD, reserve.RESERVATION_TIMES)
+    booked = snipe([user], releaseAt, targetDate, Room.LIB_FLOOR_3)
+    database.addDays([reserve.daysSinceEpoch(targetDate) for _ in booked[:1]], conn)
+  finally:
+    database.destroyDBConnection(conn)
@@ -0,0 +1,24 @@
+import datetime
+import logging
+from Reserve import metrics
+
+import azure.functions as func
+
+
+def main(mytimer: func.TimerRequest) -> None:
+    utc_timestamp = datetime.datetime.utcnow().replace(
+        tzinfo=datetime.timezone.utc).isoformat()
+
+    if mytimer.past_due:
+        logging.info('The timer is past due!')
+
+    logging.info('Python sniper function ran at %s', utc_timestamp)
+    metrics.startRun('sniper')
+    try:
+        from Reserve import sniper # loaded once the timer fires, not when the function is
+        sniper.main() # waits for the release, polls and books the new day
+    finally:
+        metrics.finishRun()
+    utc_timestamp = datetime.datetime.utcnow().replace(
+        tzinfo=datetime.timezone.utc).isoformat()
+    logging.info('Python sniper function done at %s' % utc_timestamp)
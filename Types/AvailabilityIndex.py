@@ -0,0 +1,76 @@
+from array import array
+
+from Types.RoomAvailability import RoomAvailability
+
+SLOT_MINUTES = 30 # libcal hands out rooms in 30 minute slots
+
+def timeStringToMinutes(timeStr: str) -> int:
+  '''
+  Turns a 'hh:mm:ss' (or 'hh:mm') string into minutes since midnight
+  '''
+  parts = timeStr.split(':')
+  return int(parts[0]) * 60 + int(parts[1])
+
+def slotStartMinutes(slot: RoomAvailability) -> int:
+  # parsed from the 'YYYY-MM-DD hh:mm:ss' start when the slot was made
+  return slot.startMinutes
+
+def findAvailableWindows(startMinutes, fromMinutes: int, toMinutes: int, slotCount: int) -> list[int]:
+  '''
+  Slides over the sorted slot start times of a room and finds every run of slotCount back to back slots
+  that starts at or after fromMinutes and finishes by toMinutes
+
+  Returns: The index of the first slot of every window that fits, in order
+  '''
+  windows: list[int] = []
+  if slotCount <= 0:
+    return windows
+  runStart = -1 # first index of the current run of contiguous slots that are inside the time range
+  for index, start in enumerate(startMinutes):
+    if start < fromMinutes or start + SLOT_MINUTES > toMinutes:
+      runStart = -1
+      continue
+    if runStart == -1 or start - startMinutes[index - 1] != SLOT_MINUTES: # there's a gap, so the run starts over here
+      runStart = index
+    if index - runStart + 1 >= slotCount:
+      windows.append(index - slotCount + 1)
+  return windows
+
+class AvailabilityIndex:
+  '''
+  All the availability for one day grouped by room eid, built in one pass over the day's slots
+  Each room's slots are sorted by start time and the start times are stored once as minutes since midnight
+  '''
+
+  def __init__(self, availabilityArray: list[RoomAvailability]):
+    grouped: dict[int, list[tuple[int, RoomAvailability]]] = {}
+    for slot in availabilityArray:
+      grouped.setdefault(slot.eid, []).append((slot.startMinutes, slot))
+
+    self.slotsByEid: dict[int, list[RoomAvailability]] = {}
+    self.startMinutesByEid: dict[int, array] = {}
+    for eid, entries in grouped.items():
+      entries.sort(key=lambda entry: entry[0])
+      self.startMinutesByEid[eid] = array('H', (start for start, _ in entries))
+      self.slotsByEid[eid] = [slot for _, slot in entries]
+
+  def slots(self, eid: int) -> list[RoomAvailability]:
+    return self.slotsByEid.get(eid, [])
+
+  def startMinutes(self, eid: int) -> array:
+    return self.startMinutesByEid.get(eid, array('H'))
+
+  def windows(self, eid: int, fromMinutes: int, toMinutes: int, slotCount: int) -> list[int]:
+    '''
+    Every window of slotCount back to back slots for the room between fromMinutes and toMinutes, see findAvailableWindows
+    '''
+    return findAvailableWindows(self.startMinutes(eid), fromMinutes, toMinutes, slotCount)
+
+  def eids(self):
+    return self.slotsByEid.keys()
+
+  def __len__(self):
+    return sum(len(slots) for slots in self.slotsByEid.values())
+
+  def __repr__(self):
+    return f"AvailabilityIndex(rooms={len(self.slotsByEid)}, slots={len(self)})"
@@ -0,0 +1,94 @@
+from Types.AvailabilityIndex import AvailabilityIndex, SLOT_MINUTES
+from Types.Room import Room
+
+SLOT_COUNT = 48 * 60 // SLOT_MINUTES # slots can end at midnight of the next day, so the grid covers two
+
+class AvailabilityMatrix:
+  '''
+  The availability of every room on every day as one numpy boolean matrix of shape (date, room, 30 minute slot)
+  A window of n back to back free slots is a difference of the running count of free slots along the slot axis,
+  so one search answers every date and every room for a request's times at once
+  numpy is only imported when a matrix is made, the loop search (AvailabilityIndex.windows) doesn't need it
+  '''
+
+  def __init__(self, indexMap: dict[str, AvailabilityIndex], rooms: list[Room]):
+    import numpy
+    self.indexMap = indexMap
+    self.dates = list(indexMap)
+    self.rooms = rooms
+    self.dateRows = {date: row for row, date in enumerate(self.dates)}
+    self.free = numpy.zeros((len(self.dates), len(rooms), SLOT_COUNT), dtype=bool)
+    self.slotIndex = numpy.full((len(self.dates), len(rooms), SLOT_COUNT), -1, dtype=numpy.int32) # index of the cell's slot in AvailabilityIndex.slots
+    for row, date in enumerate(self.dates):
+      availabilityIndex = indexMap[date]
+      for column, room in enumerate(rooms):
+        cells = numpy.frombuffer(availabilityIndex.startMinutes(room.eid), dtype=numpy.uint16) // SLOT_MINUTES
+        inside = cells < SLOT_COUNT
+        self.free[row, column, cells[inside]] = True
+        self.slotIndex[row, column, cells[inside]] = numpy.flatnonzero(inside)
+    # running count of free slots, counts[..., c] is how many of the cells before c are free
+    self.counts = numpy.zeros((len(self.dates), len(rooms), SLOT_COUNT + 1), dtype=numpy.int16)
+    numpy.cumsum(self.free, axis=2, out=self.counts[:, :, 1:])
+    self._windows = {} # (from minutes, to minutes, slots) -> (first cell, matrix of window starts)
+    self._first = {} # same key -> (has a window, first room, first cell) for every date
+
+  def windowStarts(self, fromMinutes: int, toMinutes: int, slotCount: int):
+    '''
+    Finds every window of slotCount back to back free slots that starts at or after fromMinutes and finishes by toMinutes
+    (the same windows as AvailabilityIndex.windows) for every date and room
+
+    Returns: (cell of the first possible start, boolean matrix of (date, room, start cell - first cell))
+    '''
+    key = (fromMinutes, toMinutes, slotCount)
+    if key not in self._windows:
+      import numpy
+      firstCell = -(-fromMinutes // SLOT_MINUTES)
+      lastCell = min(toMinutes // SLOT_MINUTES, SLOT_COUNT) - slotCount # last cell a window can start in
+      if slotCount <= 0 or lastCell < firstCell:
+        starts = numpy.zeros((len(self.dates), len(self.rooms), 0), dtype=bool)
+      else:
+        starts = self.counts[:, :, firstCell+slotCount:lastCell+slotCount+1] - self.counts[:, :, firstCell:lastCell+1] == slotCount
+      self._windows[key] = (firstCell, starts)
+    return self._windows[key]
+
+  def windows(self, date: str, fromMinutes: int, toMinutes: int, slotCount: int) -> list[tuple[Room, int]]:
+    '''
+    Every window on the date, in room order and then by start time
+
+    Returns: (room, index of the window's first slot in AvailabilityIndex.slots) for every window
+    '''
+    import numpy
+    firstCell, starts = self.windowStarts(fromMinutes, toMinutes, slotCount)
+    row = self.dateRows[date]
+    columns, cells = numpy.nonzero(starts[row])
+    indexes = self.slotIndex[row, columns, cells + firstCell]
+    return [(self.rooms[column], int(index)) for column, index in zip(columns.tolist(), indexes.tolist())]
+
+  def firstWindow(self, date: str, fromMinutes: int, toMinutes: int, slotCount: int):
+    '''
+    The earliest window in the first room (in room order) that has one on the date, what looping over the rooms would find first
+    The first window of every date is worked out together the first time the times are asked for
+
+    Returns: (room, index of the window's first slot in AvailabilityIndex.slots), or None when no room has a window
+    '''
+    if len(self.rooms) == 0:
+      return None
+    key = (fromMinutes, toMinutes, slotCount)
+    if key not in self._first:
+      import numpy
+      firstCell, starts = self.windowStarts(fromMinutes, toMinutes, slotCount)
+      if starts.shape[2] == 0: # the times can't fit a single window
+        starts = numpy.zeros(starts.shape[:2] + (1,), dtype=bool)
+      roomHasWindow = starts.any(axis=2)
+      firstRoom = roomHasWindow.argmax(axis=1)
+      dateRows = range(len(self.dates))
+      firstStart = starts[dateRows, firstRoom].argmax(axis=1)
+      self._first[key] = (roomHasWindow.any(axis=1), firstRoom, firstStart + firstCell)
+    hasWindow, firstRoom, firstStart = self._first[key]
+    row = self.dateRows[date]
+    if not hasWindow[row]:
+      return None
+    return self.rooms[firstRoom[row]], int(self.slotIndex[row, firstRoom[row], firstStart[row]])
+
+  def __repr__(self):
+    return f"AvailabilityMatrix(dates={len(self.dates)}, rooms={len(self.rooms)}, free={int(self.free.sum())})"
@@ -0,0 +1,21 @@
+class Library:
+  __slots__ = ('lid', 'gid')
+
+  def __init__(self, lid: int, gid: int):
+    self.lid = lid # library id
+    self.gid = gid # space group id, the kind of rooms we want in the library
+
+  def __repr__(self) -> str:
+    return f"Library({self.lid}, {self.gid})"
+
+def parseLibraries(value: str) -> list[Library]:
+  '''
+  Reads a list of libraries written like '2161:5032,2162:5040' (lid:gid pairs separated by commas)
+  '''
+  libraries: list[Library] = []
+  for entry in value.split(','):
+    if entry.strip() == '':
+      continue
+    lid, gid = entry.strip().split(':')
+    libraries.append(Library(int(lid), int(gid)))
+  return libraries
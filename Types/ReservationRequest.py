@@ -1,11 +1,23 @@
+from functools import lru_cache
+
+@lru_cache(maxsize=1024)
+def _timeToMinutes(timeStr: str) -> int:
+  hours, minutes = timeStr.split(':')[:2]
+  return int(hours) * 60 + int(minutes)
+
 class ReservationRequest:
-  
-  def __init__(self, dow, iso_weekday, startTime, endTime, slots30mins):
+  __slots__ = ('dow', 'iso_weekday', 'startTime', 'endTime', 'slots30mins', 'startMinutes', 'endMinutes', 'id')
+
+  def __init__(self, dow, iso_weekday, startTime, endTime, slots30mins, id = None):
+    self.id = id # the reservation_requests row it came from, None for the hard coded ones
     self.dow = dow
     self.iso_weekday = iso_weekday
     self.startTime = startTime
     self.endTime = endTime
     self.slots30mins = slots30mins
+    # minutes since midnight, so the matcher doesn't parse the times for every room it looks at
+    self.startMinutes = _timeToMinutes(startTime)
+    self.endMinutes = _timeToMinutes(endTime)
     
   def __repr__(self):
     return f"ReservationRequest(dow='{self.dow}', iso_weekday={self.iso_weekday}, startTime='{self.startTime}', endTime='{self.endTime}', slots30mins={self.slots30mins})"
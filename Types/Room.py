@@ -1,16 +1,22 @@
+LID = 2161 # webster library
+GID = 5032 # its group study rooms
+
 class Room:
-  
-  def __init__(self, name: str, eid: int, tech: bool, priority: int):
+  __slots__ = ('name', 'eid', 'tech', 'priority', 'lid', 'gid')
+
+  def __init__(self, name: str, eid: int, tech: bool, priority: int, lid: int = LID, gid: int = GID):
     self.name = name
     self.eid = eid
     self.tech = tech
     self.priority = priority
+    self.lid = lid # the library and space group the room is booked through
+    self.gid = gid
     
   def __str__(self) -> str:
-    return f"Room: {self.name}, eid: {self.eid}, Tech: {self.tech}, Priority: {self.priority}"
+    return f"Room: {self.name}, eid: {self.eid}, Tech: {self.tech}, Priority: {self.priority}, Library: {self.lid}/{self.gid}"
   
   def __repr__(self) -> str:
-    return f"Room('{self.name}', {self.eid}, {self.tech}, {self.priority})"
+    return f"Room('{self.name}', {self.eid}, {self.tech}, {self.priority}, {self.lid}, {self.gid})"
     
 LIB_FLOOR_2 = [
   Room('LB 257 - Croatia', 18520, True, 1),
@@ -40,125 +46,13 @@ LIB_FLOOR_5 = [
 
 LIB_ALL = LIB_FLOOR_2 + LIB_FLOOR_3 + LIB_FLOOR_4 + LIB_FLOOR_5
 
-ROOMS = [ # first index is highest priority, as it goes down the list, the less favorable the spot is
-  [
-    {
-      'eid': 18520,
-      'tech': True,
-      'name': 'LB 257 - Croatia',
-      'priority': 1
-    },
-  ],
-  [
-    {
-      'eid': 18518,
-      'tech': False,
-      'name': 'LB 251 - Luxembourg',
-      'priority': 2
-    },
-    {
-      'eid': 18522,
-      'tech': False,
-      'name': 'LB 259 - New Zealand',
-      'priority': 2
-    },
-  ],
-  [
-    {
-      'eid': 18508,
-      'tech': True,
-      'name': 'LB 351 - Netherlands',
-      'priority': 3
-    },
-    {
-      'eid': 18535,
-      'tech': True,
-      'name': 'LB 353 - Kenya',
-      'priority': 3
-    },
-    {
-      'eid': 18536,
-      'tech': True,
-      'name': 'LB 359 - Vietnam',
-      'priority': 3
-    },
-  ],
-  # [ # some presentation rooms don't have tables, so we wont look at those
-  #   {
-  #     'eid': 18529,
-  #     'tech': True,
-  #     'name': 'LB 311 - Haiti',
-  #     'priority': 4
-  #   },
-  #   {
-  #     'eid': 18530,
-  #     'tech': True,
-  #     'name': 'LB 316 - Australia',
-  #     'priority': 4
-  #   },
-  #   {
-  #     'eid': 18532,
-  #     'tech': True,
-  #     'name': 'LB 327 - Syria',
-  #     'priority': 4
-  #   },
-  #   {
-  #     'eid': 18533,
-  #     'tech': True,
-  #     'name': 'LB 328 - Zimbabwae',
-  #     'priority': 4
-  #   },
-  # ],
-  [
-    {
-      'eid': 18510,
-      'tech': True,
-      'name': 'LB 451 - Brazil',
-      'priority': 4
-    },
-    {
-      'eid': 18512,
-      'tech': True,
-      'name': 'LB 453 - Japan',
-      'priority': 4
-    },
-    {
-      'eid': 18523,
-      'tech': True,
-      'name': 'LB 459 - Italy',
-      'priority': 4
-    },
-  ],
-  [
-    {
-      'eid': 18524,
-      'tech': True,
-      'name': 'LB 518 - Ukraine',
-      'priority': 5
-    },
-    {
-      'eid': 18525,
-      'tech': True,
-      'name': 'LB 520 - South Africa',
-      'priority': 5
-    },
-    {
-      'eid': 18526,
-      'tech': True,
-      'name': 'LB 522 - Peru',
-      'priority': 5
-    },
-    {
-      'eid': 18511,
-      'tech': True,
-      'name': 'LB 547 - Lithuania',
-      'priority': 5
-    },
-    {
-      'eid': 18528,
-      'tech': True,
-      'name': 'LB 583 - Poland',
-      'priority': 5
-    },
-  ]
+# some presentation rooms on the 3rd floor don't have tables, like LB 311 - Haiti, LB 316 - Australia,
+# LB 327 - Syria and LB 328 - Zimbabwae, so we wont look at those even when they show up in the catalogue
+EXCLUDED_EIDS = {18529, 18530, 18532, 18533}
+
+# first index is highest priority, as it goes down the list, the less favorable the spot is
+# built from the lists above so a room only has to be added in one place
+ROOMS = [
+  [{'eid': room.eid, 'tech': room.tech, 'name': room.name, 'priority': room.priority} for room in LIB_ALL if room.priority == priority]
+  for priority in sorted({room.priority for room in LIB_ALL})
 ]
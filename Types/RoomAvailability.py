@@ -1,34 +1,135 @@
+import os
+from datetime import date
+from functools import lru_cache
+from html.parser import HTMLParser
+
 import requests
-from bs4 import BeautifulSoup
+
+# can be pointed somewhere else, like the simulator in benchmarks/libcal_sim.py
+LIBCAL_URL = os.environ.get('LIBCAL_URL', 'https://concordiauniversity.libcal.com')
+
+@lru_cache(maxsize=4096)
+def _parseDateTime(dateTimeStr: str) -> tuple[int, int]:
+  # libcal times look like 'YYYY-MM-DD hh:mm:ss', turn them into (date ordinal, minutes since midnight)
+  # every room on a day has the same times, so they're only parsed once and all the slots share the same int objects
+  dateStr, timeStr = dateTimeStr.split(' ')
+  year, month, day = dateStr.split('-')
+  hours, minutes = timeStr.split(':')[:2]
+  return date(int(year), int(month), int(day)).toordinal(), int(hours) * 60 + int(minutes)
+
+# same for the room eids, there's only a handful of rooms
+_eid = lru_cache(maxsize=1024)(int)
 
 class RoomAvailability:
-  
+  '''
+  One 30 minute slot of a room, the times are parsed once when the slot is made so nothing has to split strings later
+  startMinutes/endMinutes are minutes since midnight of the slot's date (endMinutes goes past 1440 when the slot ends at midnight)
+  '''
+  __slots__ = ('start', 'end', 'seat_id', 'lid', 'eid', 'checksum', 'dateOrdinal', 'startMinutes', 'endMinutes')
+
+  # the fields libcal wants for every booking in the createcart form, in the order it wants them
+  FORM_FIELDS = ('start', 'end', 'seat_id', 'lid', 'eid', 'checksum')
+
   def __init__(self, start, end, seat_id, lid, eid, checksum):
     self.start = start
     self.end = end
     self.seat_id = seat_id
     self.lid = lid
-    self.eid = eid
+    self.eid = _eid(eid)
     self.checksum = checksum
-    
+    self.dateOrdinal, self.startMinutes = _parseDateTime(start)
+    endOrdinal, endMinutes = _parseDateTime(end)
+    self.endMinutes = (endOrdinal - self.dateOrdinal) * 24 * 60 + endMinutes
+
+  def formFields(self):
+    '''
+    The (field, value) pairs that go in the createcart form for this slot
+    '''
+    return ((field, getattr(self, field)) for field in RoomAvailability.FORM_FIELDS)
+
   def __repr__(self):
     return f"RoomAvailability({self.start}, {self.end}, {self.seat_id}, {self.lid}, {self.eid}, {self.checksum})"
-  
-def getAvailabilityArray(startStr: str, LID = 2161):
+
+class AvailabilityParser(HTMLParser):
+  '''
+  Incremental parser for the accessible availability page, it only looks at the checkbox inputs inside the room panels
+  and turns each one into a RoomAvailability as soon as the tag shows up instead of building the whole document tree
+  Pass in a roomNames dictionary to also collect every room's name (eid -> the panel's title) for the room catalogue
+  '''
+
+  def __init__(self, LID = 2161, roomNames: dict[int, str] = None):
+    super().__init__(convert_charrefs=True)
+    self.LID = LID
+    self.roomNames = roomNames
+    self.found: list[RoomAvailability] = []
+    self._divIsPanel: list[bool] = [] # one entry for every div we are currently inside of
+    self._openPanels = 0
+    self._panelTitle: str = None # title of the panel we're in
+    self._titleTag: str = None # set while we're reading the title's text
+    self._titleParts: list[str] = []
+
+  def handle_starttag(self, tag, attrs):
+    if tag == 'div':
+      classes = next((value for name, value in attrs if name == 'class'), None) or ''
+      isPanel = 'panel' in classes.split() and 'panel-default' in classes.split()
+      self._divIsPanel.append(isPanel)
+      if isPanel:
+        self._openPanels += 1
+        self._panelTitle = None
+    elif self.roomNames is not None and self._openPanels > 0 and self._titleTag is None and 'panel-title' in (dict(attrs).get('class') or '').split():
+      self._titleTag = tag
+      self._titleParts = []
+    elif tag == 'input' and self._openPanels > 0:
+      data = dict(attrs)
+      if 'data-eid' not in data: # not one of the slot checkboxes
+        return
+      if self.roomNames is not None and self._panelTitle:
+        self.roomNames.setdefault(_eid(data['data-eid']), self._panelTitle)
+      self.found.append(RoomAvailability(
+        start = data['data-start'],
+        end = data['data-end'],
+        seat_id = data['data-seat'],
+        lid = self.LID,
+        eid = data['data-eid'],
+        checksum = data['data-crc']
+        ))
+
+  def handle_data(self, data):
+    if self._titleTag is not None:
+      self._titleParts.append(data)
+
+  def handle_endtag(self, tag):
+    if tag == self._titleTag:
+      self._panelTitle = ' '.join(''.join(self._titleParts).split())
+      self._titleTag = None
+    if tag == 'div' and len(self._divIsPanel) > 0:
+      if self._divIsPanel.pop():
+        self._openPanels -= 1
+
+def iterAvailability(chunks, LID = 2161, roomNames: dict[int, str] = None):
+  '''
+  Feeds the html chunks to an AvailabilityParser and yields every RoomAvailability as soon as its input tag has been read
+  '''
+  parser = AvailabilityParser(LID, roomNames)
+  for chunk in chunks:
+    parser.feed(chunk)
+    found, parser.found = parser.found, []
+    yield from found
+  parser.close()
+  yield from parser.found
+
+def getAvailabilityArray(startStr: str, LID = 2161, session: requests.Session = None, roomNames: dict[int, str] = None):
   '''
   Queries the availablilty grid in libcal with the time string created in createDateStringsForRequest and returns a list of all the availablilities for that day
+  Pass in a session to reuse its open connections instead of making a new one for every day
+  and a roomNames dictionary to get the name of every room on the page (see AvailabilityParser)
   '''
-  url = f"https://concordiauniversity.libcal.com/r/accessible/availability?lid={LID}&date={startStr}"
-  soup = BeautifulSoup(requests.get(url).text, features="html.parser")                       # use the information contained in the html, the checkboxes on the accessibility website 
-  divs = soup.find_all('div', {'class': 'panel panel-default'}) # have hidden properties that we can take advantage of
-  inputs = [div.find_all('input') for div in divs] # using array generator notation to compile all the input tags that contain the availability information
-  inputs = [inputTag for sublist in inputs for inputTag in sublist] #flatten array
-  return [RoomAvailability(
-    start = input['data-start'], 
-    end = input['data-end'], 
-    seat_id = input['data-seat'],
-    lid = LID,
-    eid = int(input['data-eid']),
-    checksum = input['data-crc']
-    ) for input in inputs]
-    
\ No newline at end of file
+  url = f"{LIBCAL_URL}/r/accessible/availability?lid={LID}&date={startStr}"
+  client = session if session is not None else requests
+  # use the information contained in the html, the checkboxes on the accessibility website have hidden properties that we can take advantage of
+  # the page is parsed while it downloads so we never hold the whole document tree in memory
+  with client.get(url, stream=True) as res:
+    res.raise_for_status() # an error page has no checkboxes, don't let it pass for a day with nothing free
+    if res.encoding is None:
+      res.encoding = 'utf-8'
+    return list(iterAvailability(res.iter_content(chunk_size=16384, decode_unicode=True), LID, roomNames))
@@ -0,0 +1,123 @@
+'''
+Times assignment.assignRooms for the whole LIB_ALL x two week horizon and compares it to first fit, then checks it against
+the optimum found by trying every assignment on small random days (a few rooms, overlapping request times)
+"proven" is how many days the solver proved it got the most requests a room
+
+Run from the repo root: python -m benchmarks.assignment_bench
+'''
+import random
+from datetime import datetime, timedelta
+from time import perf_counter
+
+from benchmarks import fixtures
+from Reserve import assignment
+from Types import AvailabilityIndex, Room, RoomAvailability, ReservationRequest
+
+REQUEST_SHAPES = [ # (start, end, slots) people usually ask for
+  ('10:30:00', '13:30:00', 6),
+  ('13:00:00', '15:00:00', 4),
+  ('09:00:00', '17:00:00', 4),
+  ('12:00:00', '14:00:00', 2),
+  ('08:00:00', '12:00:00', 8),
+]
+
+def horizonIndexes(days = 14):
+  start = datetime(2023, 1, 9)
+  indexes = []
+  for offset in range(days):
+    html = fixtures.availabilityHtml((start + timedelta(days=offset)).strftime("%Y-%m-%d"), Room.LIB_ALL, seed=offset)
+    indexes.append(AvailabilityIndex.AvailabilityIndex(list(RoomAvailability.iterAvailability([html]))))
+  return indexes
+
+def randomRequests(count: int, rng: random.Random):
+  requests = []
+  for _ in range(count):
+    startTime, endTime, slots = rng.choice(REQUEST_SHAPES)
+    requests.append(ReservationRequest.ReservationRequest('Monday', 1, startTime, endTime, slots))
+  return requests
+
+def firstFit(requests, availabilityIndex, rooms = Room.LIB_ALL):
+  # what planning did before the solver, the first free window in room order
+  taken = set()
+  satisfied = 0
+  priority = 0
+  for request in requests:
+    fromMinutes = request.startMinutes
+    toMinutes = request.endMinutes
+    placed = False
+    for room in rooms:
+      startMinutes = availabilityIndex.startMinutes(room.eid)
+      for index in availabilityIndex.windows(room.eid, fromMinutes, toMinutes, request.slots30mins):
+        cells = {(room.eid, minutes) for minutes in startMinutes[index:index+request.slots30mins]}
+        if taken.isdisjoint(cells):
+          taken.update(cells)
+          satisfied += 1
+          priority += room.priority
+          placed = True
+          break
+      if placed:
+        break
+  return satisfied, priority
+
+SMALL_SHAPES = [ # overlapping times so requests block each other
+  ('09:00:00', '12:00:00', 2),
+  ('10:00:00', '11:30:00', 3),
+  ('11:00:00', '13:00:00', 2),
+  ('09:30:00', '11:00:00', 3),
+  ('10:00:00', '12:00:00', 4),
+  ('10:00:00', '11:00:00', 2),
+]
+
+def mostSatisfied(assigner: assignment.RoomAssigner):
+  # tries every window (or none) for every request
+  best = 0
+  def search(requestIndex: int, taken: set, satisfied: int):
+    nonlocal best
+    if requestIndex == len(assigner.requests):
+      best = max(best, satisfied)
+      return
+    if satisfied + len(assigner.requests) - requestIndex <= best:
+      return
+    for candidate in assigner.candidates[requestIndex]:
+      if taken.isdisjoint(candidate.cells):
+        search(requestIndex + 1, taken | set(candidate.cells), satisfied + 1)
+    search(requestIndex + 1, taken, satisfied)
+  search(0, set(), 0)
+  return best
+
+def compareOptimum(cases: int, rng: random.Random):
+  worse = 0
+  better = 0 # than first fit
+  for case in range(cases):
+    rooms = rng.sample(Room.LIB_ALL, rng.randint(1, 3))
+    html = fixtures.availabilityHtml('2023-01-09', rooms, seed=case)
+    availabilityIndex = AvailabilityIndex.AvailabilityIndex(list(RoomAvailability.iterAvailability([html])))
+    requests = [ReservationRequest.ReservationRequest('Monday', 1, *rng.choice(SMALL_SHAPES)) for _ in range(rng.randint(2, 7))]
+    assigner = assignment.RoomAssigner(requests, availabilityIndex, rooms)
+    solved = sum(candidate is not None for candidate in assigner.solve())
+    optimum = mostSatisfied(assigner)
+    worse += solved < optimum
+    better += solved > firstFit(requests, availabilityIndex, rooms)[0]
+  return worse, better
+
+def main():
+  rng = random.Random(0)
+  indexes = horizonIndexes()
+  print(f"{'requests/day':>13}{'solver ms':>11}{'solver ok':>11}{'proven':>8}{'first fit ok':>14}{'solver prio':>13}{'first fit prio':>16}")
+  for perDay in (5, 20, 50, 100, 200):
+    dayRequests = [randomRequests(perDay, rng) for _ in indexes]
+    start = perf_counter()
+    assigners = [assignment.RoomAssigner(requests, index) for requests, index in zip(dayRequests, indexes)]
+    results = [assigner.solve() for assigner in assigners]
+    elapsed = perf_counter() - start
+    proven = sum(assigner.proven for assigner in assigners)
+    solved = sum(candidate is not None for result in results for candidate in result)
+    solvedPriority = sum(candidate.room.priority for result in results for candidate in result if candidate is not None)
+    greedy = [firstFit(requests, index) for requests, index in zip(dayRequests, indexes)]
+    print(f"{perDay:>13}{elapsed*1000:>11.1f}{solved:>11}{proven:>8}{sum(ok for ok, _ in greedy):>14}{solvedPriority:>13}{sum(prio for _, prio in greedy):>16}")
+  cases = 2000
+  worse, better = compareOptimum(cases, random.Random(1))
+  print(f"{cases} small days: {worse} below the optimum, {better} above first fit")
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,37 @@
+import hashlib
+import random
+from datetime import datetime, timedelta
+
+from Types import Room
+
+def availabilityHtml(date: str, rooms = Room.LIB_ALL, LID = 2161, openTime = '08:00:00', slots = 32, takenRatio = 0.3, seed = 0, booked: set = frozenset()):
+  '''
+  Builds a page shaped like libcal's /r/accessible/availability response for the date (YYYY-MM-DD)
+  Every room gets a panel with one checkbox for every free 30 minute slot, takenRatio of the slots are left out at random
+  and so are the (eid, 'YYYY-MM-DD hh:mm:ss' start) slots in booked
+  '''
+  rng = random.Random(f"{seed}-{date}")
+  dayStart = datetime.strptime(f"{date} {openTime}", "%Y-%m-%d %H:%M:%S")
+  parts = [
+    '<!DOCTYPE html><html lang="en"><head><meta charset="utf-8"><title>Space Availability</title></head><body>',
+    '<div id="s-lc-public-main" class="container"><h1>Accessible Room Availability</h1>',
+  ]
+  for room in rooms:
+    parts.append(f'<div class="panel panel-default"><div class="panel-heading"><h2 class="panel-title">{room.name}</h2></div><div class="panel-body"><fieldset><legend class="sr-only">{room.name}</legend>')
+    for index in range(slots):
+      if rng.random() < takenRatio:
+        continue
+      start = dayStart + timedelta(minutes=30*index)
+      end = start + timedelta(minutes=30)
+      if (room.eid, f"{start:%Y-%m-%d %H:%M:%S}") in booked:
+        continue
+      crc = hashlib.md5(f"{room.eid}{start}{seed}".encode()).hexdigest()
+      parts.append(
+        f'<div class="checkbox"><label for="slot_{room.eid}_{index}">'
+        f'<input type="checkbox" id="slot_{room.eid}_{index}" name="slot" value="{room.eid}-{index}" '
+        f'data-eid="{room.eid}" data-seat="0" data-start="{start:%Y-%m-%d %H:%M:%S}" data-end="{end:%Y-%m-%d %H:%M:%S}" data-crc="{crc}"> '
+        f'{start:%I:%M%p} - {end:%I:%M%p}</label></div>'
+      )
+    parts.append('</fieldset></div></div>')
+  parts.append('<form><input type="hidden" name="lid" value="' + str(LID) + '"><button type="submit">Continue</button></form></div></body></html>')
+  return ''.join(parts)
@@ -0,0 +1,98 @@
+'''
+How long the function entry points take to import, from python -X importtime
+
+Every scenario runs in a fresh interpreter a few times and the median is reported, along with the modules that took the
+longest on their own. azure.functions is imported before the clock starts because the functions worker already has it loaded.
+
+Run from the repo root: python -m benchmarks.importtime [--repeat 5] [--top 8] [--baseline <git revision>]
+--baseline also measures the tree at that revision (from git archive) so the two can be compared
+'''
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+PRELUDE = 'import azure.functions'
+MARKER = '--importtime start--'
+
+SCENARIOS = [
+  ('timer trigger loaded', 'import Reserve'),
+  ('timer run ready', 'import Reserve; from Reserve import reserve'),
+  ('batch run ready', 'import Reserve; from Reserve import batch'),
+  ('sniper trigger loaded', 'import Sniper'),
+  ('http trigger loaded', 'import RequestHandler'),
+  ('http first request ready', 'import RequestHandler; from FlaskApp import app'),
+]
+
+def parseImportTimes(stderr: str):
+  '''
+  Reads the -X importtime lines that come after the marker
+
+  Returns: (total microseconds, [(self microseconds, module)])
+  '''
+  total = 0
+  modules = []
+  started = False
+  for line in stderr.splitlines():
+    if line == MARKER:
+      started = True
+      continue
+    if not started or not line.startswith('import time:') or 'self [us]' in line:
+      continue
+    selfTime, cumulative, name = line[len('import time:'):].split('|')
+    modules.append((int(selfTime), name.strip()))
+    if len(name) - len(name.lstrip()) == 1: # top level import, its cumulative time covers everything under it
+      total += int(cumulative)
+  return total, modules
+
+def measure(root: str, statement: str, repeat: int):
+  env = dict(os.environ)
+  # older trees read these at import, set them so they can be measured too
+  for name in ('DB_HOSTNAME', 'DB_DATABASE', 'DB_USER', 'DB_PASSWORD'):
+    env.setdefault(name, 'unused')
+  code = f"{PRELUDE}; import sys; sys.stderr.write({MARKER!r} + '\\n'); sys.stderr.flush(); {statement}"
+  totals = []
+  slowest: dict[str, list[int]] = {}
+  for _ in range(repeat + 1):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=root, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+      raise RuntimeError(f"'{statement}' failed in {root}: {result.stderr.strip().splitlines()[-1]}")
+    totals.append(parseImportTimes(result.stderr)[0])
+    for selfTime, module in parseImportTimes(result.stderr)[1]:
+      slowest.setdefault(module, []).append(selfTime)
+  totals = totals[1:] # the first run also writes the .pyc files
+  return statistics.median(totals), sorted(((statistics.median(times), module) for module, times in slowest.items()), reverse=True)
+
+def exportRevision(revision: str) -> str:
+  directory = tempfile.mkdtemp(prefix='importtime-')
+  archive = os.path.join(directory, 'tree.tar')
+  subprocess.run(['git', 'archive', '--format=tar', '-o', archive, revision], check=True)
+  with tarfile.open(archive) as tar:
+    tar.extractall(directory)
+  return directory
+
+def main(argv: list[str]):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--repeat', type=int, default=5)
+  parser.add_argument('--top', type=int, default=8, help='how many of the slowest modules to list for every scenario')
+  parser.add_argument('--baseline', default=None, help='git revision to compare against')
+  args = parser.parse_args(argv)
+
+  baseline = exportRevision(args.baseline) if args.baseline is not None else None
+  print(f"{'scenario':<28}{'ms':>9}" + (f"{args.baseline[:10] + ' ms':>16}" if baseline is not None else ''))
+  for name, statement in SCENARIOS:
+    total, slowest = measure(os.getcwd(), statement, args.repeat)
+    line = f"{name:<28}{total/1000:>9.1f}"
+    if baseline is not None:
+      try:
+        line += f"{measure(baseline, statement, args.repeat)[0]/1000:>16.1f}"
+      except RuntimeError:
+        line += f"{'-':>16}"
+    print(line)
+    print('    ' + ', '.join(f"{module} {selfTime/1000:.1f}" for selfTime, module in slowest[:args.top]))
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
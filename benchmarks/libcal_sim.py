@@ -0,0 +1,231 @@
+'''
+A small local stand-in for concordiauniversity.libcal.com and fas.concordia.ca so the bot can run without touching the real sites
+
+It serves generated availability pages (or recorded ones from a folder), the createcart, checkout and cancel json, and the
+saml/adfs login pages getAuth walks through. Every response can be slowed down with latency + jitter and a share of
+them can fail with a 503 to see how the bot copes. Booked slots disappear from later availability pages until they're cancelled.
+
+Run from the repo root to keep one up: python -m benchmarks.libcal_sim [port]
+Then point the bot at it with LIBCAL_URL=http://127.0.0.1:<port> and CONCORDIA_AUTH_URL=http://127.0.0.1:<port>
+'''
+import json
+import os
+import random
+import sys
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+from urllib.parse import parse_qs, urlparse
+
+from benchmarks import fixtures
+from Types import Room
+
+AUTH_COOKIE = 'libcal_sim_auth'
+CART_COOKIE = 'libcal_sim_cart'
+
+class LibCalSimulator:
+
+  def __init__(self, port = 0, latency = 0.0, jitter = 0.0, errorRate = 0.0, recordedDir: str = None, seed = 0):
+    self.latency = latency
+    self.jitter = jitter
+    self.errorRate = errorRate
+    self.recordedDir = recordedDir # folder with <date>.html pages to serve instead of generated ones
+    self.seed = seed
+    self.random = random.Random(seed)
+    self.lock = threading.Lock()
+    self.counts = Counter() # route -> requests served
+    self.booked: set[tuple[int, str]] = set() # (eid, start) of every slot that was checked out
+    self.carts: dict[str, list[tuple[int, str]]] = {}
+    self.cartIds = 0 # carts are popped when they're checked out, so their ids can't come from len(carts)
+    self.bookingIds = 0
+    self.bookings: dict[str, list[tuple[int, str]]] = {} # booking id -> its slots, for cancelling
+    self.server = ThreadingHTTPServer(('127.0.0.1', port), self._handlerClass())
+    self.server.daemon_threads = True
+    self.thread = None
+
+  @property
+  def url(self):
+    return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+  def start(self):
+    self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+    self.thread.start()
+    return self
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def resetCounts(self):
+    with self.lock:
+      self.counts.clear()
+
+  def reset(self):
+    '''
+    Forgets every booking and cart so the next run sees the same grids as the first one
+    '''
+    with self.lock:
+      self.counts.clear()
+      self.booked.clear()
+      self.carts.clear()
+      self.bookings.clear()
+
+  def totalRequests(self):
+    with self.lock:
+      return sum(self.counts.values())
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, *exc):
+    self.stop()
+
+  def rooms(self, LID: int):
+    # the webster library has the real rooms, any other library gets its own made up ones so the eids don't clash
+    if LID == Room.LID:
+      return Room.LIB_ALL
+    return [Room.Room(f"Library {LID} - Room {index + 1}", LID * 100 + index, True, 6, LID) for index in range(len(Room.LIB_ALL))]
+
+  def availabilityPage(self, date: str, LID: int):
+    if self.recordedDir is not None:
+      path = os.path.join(self.recordedDir, f"{date}.html")
+      if os.path.exists(path):
+        with open(path, encoding='utf-8') as file:
+          return file.read()
+    with self.lock:
+      booked = frozenset(self.booked)
+    return fixtures.availabilityHtml(date, self.rooms(LID), LID=LID, seed=self.seed, booked=booked)
+
+  def _handlerClass(simulator):
+    class Handler(BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1' # keep alive, like the real site
+
+      def log_message(self, format, *args):
+        pass
+
+      def _cookies(self):
+        cookies = {}
+        for part in self.headers.get('Cookie', '').split(';'):
+          if '=' in part:
+            name, value = part.strip().split('=', 1)
+            cookies[name] = value
+        return cookies
+
+      def _form(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return parse_qs(self.rfile.read(length).decode()) if length > 0 else {}
+
+      def _send(self, status: int, body: str, contentType = 'text/html; charset=utf-8', cookies: dict = None):
+        data = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (cookies or {}).items():
+          self.send_header('Set-Cookie', f"{name}={value}; Path=/")
+        self.end_headers()
+        self.wfile.write(data)
+
+      def _begin(self, route: str):
+        with simulator.lock:
+          simulator.counts[route] += 1
+          delay = simulator.latency + simulator.random.uniform(0, simulator.jitter)
+          fail = simulator.random.random() < simulator.errorRate
+        if delay > 0:
+          sleep(delay)
+        if fail:
+          self._send(503, '<h1>Service Unavailable</h1>')
+          return False
+        return True
+
+      def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == '/r/accessible/availability':
+          if self._begin('availability'):
+            self._send(200, simulator.availabilityPage(query['date'][0], int(query.get('lid', ['2161'])[0])))
+        elif url.path in ('/checkout', '/equipment/cancel'):
+          if not self._begin('authcheck' if url.path == '/checkout' else 'cancelpage'):
+            return
+          if AUTH_COOKIE in self._cookies() and url.path == '/equipment/cancel':
+            self._send(200, f'<h1>Cancel Booking</h1><p>{query.get("id", [""])[0]}</p>')
+          elif AUTH_COOKIE in self._cookies():
+            self._send(200, '<h1>Complete Booking</h1>')
+          else: # the same thing libcal shows when it wants you to log in
+            self._send(200, f'<h2>Redirecting ...</h2><form method="get" action="{simulator.url}/saml/login"><input type="hidden" name="SAMLRequest" value="sim"><input type="hidden" name="RelayState" value="{url.query}"></form>')
+        elif url.path == '/saml/login':
+          if self._begin('auth'):
+            self._send(200, '<form method="post" action="/adfs/ls/?SAMLRequest=sim"><input name="UserName"><input name="Password" type="password"></form>')
+        else:
+          self._begin('unknown')
+          self._send(404, 'not found')
+
+      def do_POST(self):
+        url = urlparse(self.path)
+        form = self._form()
+        cookies = self._cookies()
+        if url.path == '/ajax/space/createcart':
+          if not self._begin('createcart'):
+            return
+          slots = []
+          index = 0
+          while f'bookings[{index}][eid]' in form:
+            slots.append((int(form[f'bookings[{index}][eid]'][0]), form[f'bookings[{index}][start]'][0]))
+            index += 1
+          with simulator.lock:
+            simulator.cartIds += 1
+            cartId = str(simulator.cartIds)
+            simulator.carts[cartId] = slots
+          self._send(200, json.dumps({'redirect': f'/checkout?cart={cartId}'}), 'application/json', {CART_COOKIE: cartId})
+        elif url.path == '/adfs/ls/':
+          if self._begin('auth'):
+            self._send(200, f'<form method="post" action="{simulator.url}/saml/acs"><input type="hidden" name="SAMLResponse" value="sim-{form.get("UserName", [""])[0]}"><input type="submit" value="Continue"></form>')
+        elif url.path == '/saml/acs':
+          if self._begin('auth'):
+            self._send(200, '<h1>Logged in</h1>', cookies={AUTH_COOKIE: 'yes'})
+        elif url.path == '/ajax/equipment/checkout':
+          if not self._begin('checkout'):
+            return
+          if AUTH_COOKIE not in cookies:
+            self._send(403, '<h1>Forbidden</h1>')
+            return
+          with simulator.lock:
+            slots = simulator.carts.pop(cookies.get(CART_COOKIE, ''), [])
+            taken = [f"{eid} {start}" for eid, start in slots if (eid, start) in simulator.booked]
+            if len(slots) == 0 or len(taken) > 0:
+              failed = True
+            else:
+              failed = False
+              simulator.booked.update(slots)
+              simulator.bookingIds += 1
+              bookingId = f"cs_SIM{simulator.bookingIds:06d}"
+              simulator.bookings[bookingId] = slots
+          if failed:
+            self._send(500, f'<p>Sorry, this time slot is no longer available. {" ".join(taken[:1])}</p>')
+          else:
+            self._send(200, json.dumps({'bookId': bookingId, 'html': f'<p>Booking confirmed, your booking ID is {bookingId}</p>'}), 'application/json')
+        elif url.path == '/ajax/equipment/cancel':
+          if not self._begin('cancel'):
+            return
+          if AUTH_COOKIE not in cookies:
+            self._send(403, '<h1>Forbidden</h1>')
+            return
+          with simulator.lock:
+            slots = simulator.bookings.pop(form.get('id', [''])[0], None)
+            if slots is not None:
+              simulator.booked.difference_update(slots)
+          if slots is None:
+            self._send(400, json.dumps({'error': 'Booking not found'}), 'application/json')
+          else:
+            self._send(200, json.dumps({'cancelled': form['id'][0]}), 'application/json')
+        else:
+          self._begin('unknown')
+          self._send(404, 'not found')
+
+    return Handler
+
+if __name__ == "__main__":
+  port = int(sys.argv[1]) if len(sys.argv) > 1 else 8765
+  simulator = LibCalSimulator(port=port, latency=float(os.environ.get('SIM_LATENCY', 0)), errorRate=float(os.environ.get('SIM_ERROR_RATE', 0)))
+  print(f"LibCal simulator listening on {simulator.url}")
+  simulator.server.serve_forever()
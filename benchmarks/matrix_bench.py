@@ -0,0 +1,81 @@
+'''
+Compares the numpy AvailabilityMatrix search against the loop over every room of every day, for a whole two week horizon
+
+Run from the repo root: python -m benchmarks.matrix_bench [--users 10,100,1000,10000] [--repeat 3]
+Every user has two requests, each landing on the two dates of its weekday in the horizon, like plannedReservationDates.
+"first room" is what reserve.main does (the first room with a window for every request and date) and
+"windows" is what the batch planner hands to the solver (every window of every room for every request and date).
+The matrix columns include building the matrix and the best of the repeats is shown, so importing numpy only counts with --repeat 1.
+Both searches are checked to give the same answers.
+'''
+import argparse
+import random
+import sys
+from datetime import datetime, timedelta
+from time import perf_counter
+
+from benchmarks import assignment_bench, fixtures
+from Reserve import reserve
+from Types import AvailabilityIndex, AvailabilityMatrix, Room, RoomAvailability
+
+def horizon(days = 14):
+  start = datetime(2023, 1, 9)
+  indexMap = {}
+  for offset in range(days):
+    date = start + timedelta(days=offset)
+    html = fixtures.availabilityHtml(date.strftime("%Y-%m-%d"), Room.LIB_ALL, seed=offset)
+    indexMap[date.strftime("%Y-%m-%d")] = AvailabilityIndex.AvailabilityIndex(list(RoomAvailability.iterAvailability([html])))
+  return indexMap
+
+def requestDates(userCount: int, dates: list[str], rng: random.Random):
+  requestDates = []
+  for request in assignment_bench.randomRequests(userCount * 2, rng):
+    weekday = rng.randrange(7)
+    requestDates += [(request, date) for date in dates[weekday::7]]
+  return requestDates
+
+def loopFirstRooms(indexMap, requestDates):
+  return [reserve.findRoom(indexMap[date], request, Room.LIB_ALL) for request, date in requestDates]
+
+def matrixFirstRooms(indexMap, requestDates):
+  matrix = AvailabilityMatrix.AvailabilityMatrix(indexMap, Room.LIB_ALL)
+  return [reserve.findRoom(indexMap[date], request, Room.LIB_ALL, matrix, date) for request, date in requestDates]
+
+def loopWindows(indexMap, requestDates):
+  return [[(room, index) for room in Room.LIB_ALL for index in indexMap[date].windows(room.eid, request.startMinutes, request.endMinutes, request.slots30mins)] for request, date in requestDates]
+
+def matrixWindows(indexMap, requestDates):
+  matrix = AvailabilityMatrix.AvailabilityMatrix(indexMap, Room.LIB_ALL)
+  return [matrix.windows(date, request.startMinutes, request.endMinutes, request.slots30mins) for request, date in requestDates]
+
+def timed(search, indexMap, requestDates, repeat: int):
+  best = None
+  for _ in range(repeat):
+    start = perf_counter()
+    result = search(indexMap, requestDates)
+    elapsed = perf_counter() - start
+    best = elapsed if best is None else min(best, elapsed)
+  return best, result
+
+def main(argv: list[str]):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--users', default='10,100,1000,10000')
+  parser.add_argument('--repeat', type=int, default=3)
+  args = parser.parse_args(argv)
+
+  indexMap = horizon()
+  dates = list(indexMap)
+  print(f"{'users':>7}{'searches':>10}{'first loop ms':>15}{'first matrix ms':>17}{'windows loop ms':>17}{'windows matrix ms':>19}")
+  for userCount in [int(count) for count in args.users.split(',')]:
+    searches = requestDates(userCount, dates, random.Random(userCount))
+    firstLoop, loopFound = timed(loopFirstRooms, indexMap, searches, args.repeat)
+    firstMatrix, matrixFound = timed(matrixFirstRooms, indexMap, searches, args.repeat)
+    assert [(room.eid, slots) if room else None for room, slots in (found or (None, None) for found in loopFound)] == \
+           [(room.eid, slots) if room else None for room, slots in (found or (None, None) for found in matrixFound)]
+    windowsLoop, loopFound = timed(loopWindows, indexMap, searches, args.repeat)
+    windowsMatrix, matrixFound = timed(matrixWindows, indexMap, searches, args.repeat)
+    assert [[(room.eid, index) for room, index in found] for found in loopFound] == [[(room.eid, index) for room, index in found] for found in matrixFound]
+    print(f"{userCount:>7}{len(searches):>10}{firstLoop*1000:>15.1f}{firstMatrix*1000:>17.1f}{windowsLoop*1000:>17.1f}{windowsMatrix*1000:>19.1f}")
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
@@ -0,0 +1,78 @@
+'''
+Compares the memory and build time of the slotted record types against the dict backed classes they replaced
+
+Run from the repo root: python -m benchmarks.memory_bench [slots_per_day] [days]
+It parses generated availability pages for every room (like a multi user run over two weeks would) and
+builds the same slots, rooms and reservation requests with the old classes and the new ones
+'''
+import sys
+import tracemalloc
+from time import perf_counter
+
+from benchmarks import fixtures
+from Types import ReservationRequest, Room, RoomAvailability
+
+class DictRoomAvailability:
+  # the way RoomAvailability used to be, the times stayed strings and were split every time they were needed
+
+  def __init__(self, start, end, seat_id, lid, eid, checksum):
+    self.start = start
+    self.end = end
+    self.seat_id = seat_id
+    self.lid = lid
+    self.eid = eid
+    self.checksum = checksum
+
+class DictRoom:
+
+  def __init__(self, name: str, eid: int, tech: bool, priority: int):
+    self.name = name
+    self.eid = eid
+    self.tech = tech
+    self.priority = priority
+
+class DictReservationRequest:
+
+  def __init__(self, dow, iso_weekday, startTime, endTime, slots30mins):
+    self.dow = dow
+    self.iso_weekday = iso_weekday
+    self.startTime = startTime
+    self.endTime = endTime
+    self.slots30mins = slots30mins
+
+def measure(build, repeat: int = 3):
+  start = perf_counter()
+  for _ in range(repeat):
+    build()
+  elapsed = (perf_counter() - start) / repeat
+
+  tracemalloc.start()
+  kept = build() # hold on to it so the snapshot counts what a run keeps around, not what the build threw away
+  current, _ = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return len(kept), elapsed, current
+
+def main(argv: list[str]):
+  slotsPerDay = int(argv[0]) if len(argv) > 0 else 32
+  days = int(argv[1]) if len(argv) > 1 else 14
+  # every attribute of the parsed slots, so both types are built from exactly the same strings
+  fields = []
+  for day in range(days):
+    html = fixtures.availabilityHtml(f"2023-01-{day + 1:02d}", Room.LIB_ALL * 4, slots=slotsPerDay, seed=day)
+    fields += [(slot.start, slot.end, slot.seat_id, slot.lid, str(slot.eid), slot.checksum) for slot in RoomAvailability.iterAvailability([html])]
+  rooms = [(room.name, room.eid, room.tech, room.priority) for room in Room.LIB_ALL] * 100
+  requests = [('Monday', 1, '10:30:00', '13:30:00', 6), ('Wednesday', 3, '13:00:00', '15:00:00', 4)] * 5000
+
+  cases = [
+    ('slots', lambda: [DictRoomAvailability(*slot[:4], int(slot[4]), slot[5]) for slot in fields], lambda: [RoomAvailability.RoomAvailability(*slot) for slot in fields]),
+    ('rooms', lambda: [DictRoom(*room) for room in rooms], lambda: [Room.Room(*room) for room in rooms]),
+    ('requests', lambda: [DictReservationRequest(*request) for request in requests], lambda: [ReservationRequest.ReservationRequest(*request) for request in requests]),
+  ]
+  print(f"{'records':<10}{'count':>9}{'dict ms':>10}{'slots ms':>10}{'dict KiB':>11}{'slots KiB':>11}{'bytes/record':>18}")
+  for name, buildOld, buildNew in cases:
+    count, oldTime, oldMemory = measure(buildOld)
+    _, newTime, newMemory = measure(buildNew)
+    print(f"{name:<10}{count:>9}{oldTime*1000:>10.1f}{newTime*1000:>10.1f}{oldMemory/1024:>11.0f}{newMemory/1024:>11.0f}{oldMemory/count:>9.0f} -> {newMemory/count:<6.0f}")
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
@@ -0,0 +1,65 @@
+'''
+Compares the old BeautifulSoup scraping of the availability page against the streaming AvailabilityParser
+
+Run from the repo root: python -m benchmarks.parse_bench [recorded_page.html ...]
+Without arguments it uses generated pages for every room in the library
+'''
+import sys
+import tracemalloc
+from time import perf_counter
+
+from bs4 import BeautifulSoup
+
+from benchmarks import fixtures
+from Types import Room, RoomAvailability
+
+def soupParse(html: str, LID = 2161):
+  # the way getAvailabilityArray used to do it
+  soup = BeautifulSoup(html, features="html.parser")
+  divs = soup.find_all('div', {'class': 'panel panel-default'})
+  inputs = [div.find_all('input') for div in divs]
+  inputs = [inputTag for sublist in inputs for inputTag in sublist]
+  return [RoomAvailability.RoomAvailability(
+    start = input['data-start'],
+    end = input['data-end'],
+    seat_id = input['data-seat'],
+    lid = LID,
+    eid = int(input['data-eid']),
+    checksum = input['data-crc']
+    ) for input in inputs]
+
+def streamParse(html: str, LID = 2161, chunkSize = 16384):
+  chunks = (html[index:index+chunkSize] for index in range(0, len(html), chunkSize))
+  return list(RoomAvailability.iterAvailability(chunks, LID))
+
+def measure(parse, html: str, repeat: int):
+  start = perf_counter()
+  for _ in range(repeat):
+    result = parse(html)
+  elapsed = (perf_counter() - start) / repeat
+
+  tracemalloc.start()
+  parse(html)
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return result, elapsed, peak
+
+def main(paths: list[str], repeat = 20):
+  if len(paths) > 0:
+    pages = [(path, open(path, encoding='utf-8').read()) for path in paths]
+  else:
+    pages = [
+      ('LIB_FLOOR_3 day', fixtures.availabilityHtml('2023-01-09', Room.LIB_FLOOR_3)),
+      ('LIB_ALL day', fixtures.availabilityHtml('2023-01-09', Room.LIB_ALL)),
+      ('LIB_ALL x4 rooms', fixtures.availabilityHtml('2023-01-09', Room.LIB_ALL * 4)),
+    ]
+
+  print(f"{'page':<20}{'size':>10}{'slots':>8}{'soup ms':>10}{'stream ms':>11}{'soup peak KiB':>15}{'stream peak KiB':>17}")
+  for name, html in pages:
+    soupSlots, soupTime, soupPeak = measure(soupParse, html, repeat)
+    streamSlots, streamTime, streamPeak = measure(streamParse, html, repeat)
+    assert [repr(slot) for slot in soupSlots] == [repr(slot) for slot in streamSlots], f"parsers disagree on {name}"
+    print(f"{name:<20}{len(html):>10}{len(streamSlots):>8}{soupTime*1000:>10.2f}{streamTime*1000:>11.2f}{soupPeak/1024:>15.0f}{streamPeak/1024:>17.0f}")
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
@@ -0,0 +1,233 @@
+'''
+Runs the reservation pipeline end to end against the local libcal simulator and reports how long every stage takes
+
+For 1, 10, 100 and 1000 users it drives the batch engine's stages (plan, fetch, index, match, checkout) with made up users,
+and it also runs reserve.main() (with an in memory days table instead of postgres) and reserve.test().
+Every scenario is repeated and the report has the wall time, requests made per run and p50/p99 of every stage.
+
+Run from the repo root: python -m benchmarks.pipeline_bench [--latency 0.02] [--jitter 0.01] [--errors 0] [--repeat 3] [--users 1,10,100,1000] [--libraries 2161:5032] [--cart-batching] [--rate-limit 10] [--async] [--spacing 2 --max-wait 5 --async-timeout 5]
+With --spacing every account waits that many seconds between checkouts, like CHECKOUT_SPACING_SECONDS in production (0 by default),
+and once an account waited --max-wait in total its other checkouts are left for the next run and reported as deferred. Every repeat starts
+with no saved spacing, like the first run of the day.
+'''
+import argparse
+import contextlib
+import glob
+import io
+import os
+import random
+import sys
+import tempfile
+from collections import defaultdict
+from time import perf_counter
+
+from benchmarks.libcal_sim import LibCalSimulator
+
+class StageTimer:
+
+  def __init__(self):
+    self.samples: dict[str, list[float]] = defaultdict(list)
+
+  @contextlib.contextmanager
+  def stage(self, name: str):
+    start = perf_counter()
+    try:
+      yield
+    finally:
+      self.samples[name].append(perf_counter() - start)
+
+def percentile(values: list[float], percent: float):
+  ordered = sorted(values)
+  if len(ordered) == 0:
+    return 0.0
+  rank = max(0, min(len(ordered) - 1, int(round(percent / 100 * len(ordered) + 0.5)) - 1))
+  return ordered[rank]
+
+class MemoryDatabase:
+  '''
+  Enough of Reserve.database for reserve.main() to run without postgres
+  '''
+
+  def __init__(self):
+    self.days: set[int] = set()
+    self.fingerprints: dict[tuple[int, str], str] = {}
+
+  def createDBConnection(self):
+    return self
+
+  def destroyDBConnection(self, conn):
+    pass
+
+  def findDays(self, days, conn):
+    return self.days & set(days)
+
+  def addDays(self, days, conn):
+    self.days.update(days)
+    return True
+
+  def findFingerprints(self, lid, dates, conn):
+    return {date: self.fingerprints[(lid, date)] for date in dates if (lid, date) in self.fingerprints}
+
+  def saveFingerprints(self, lid, fingerprints, conn):
+    self.fingerprints.update({(lid, date): fingerprint for date, fingerprint in fingerprints.items()})
+    return True
+
+class MemoryAsyncDatabase:
+  '''
+  The same for asyncreserve.mainAsync
+  '''
+
+  def __init__(self, database: MemoryDatabase):
+    self.database = database
+
+  async def createPool(self):
+    return self
+
+  async def close(self):
+    pass
+
+  async def findDays(self, days, pool):
+    return self.database.findDays(days, pool)
+
+  async def addDays(self, days, pool):
+    return self.database.addDays(days, pool)
+
+  async def findFingerprints(self, lid, dates, pool):
+    return self.database.findFingerprints(lid, dates, pool)
+
+  async def saveFingerprints(self, lid, fingerprints, pool):
+    return self.database.saveFingerprints(lid, fingerprints, pool)
+
+SHAPES = [
+  ('10:30:00', '13:30:00', 6),
+  ('13:00:00', '15:00:00', 4),
+  ('09:00:00', '12:00:00', 4),
+  ('14:00:00', '18:00:00', 2),
+]
+DAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+def makeUsers(count: int, rng: random.Random):
+  from Reserve import batch
+  from Types import ReservationRequest
+  users = []
+  for userId in range(1, count + 1):
+    requests = []
+    for weekday in rng.sample(range(1, 8), 2):
+      startTime, endTime, slots = rng.choice(SHAPES)
+      requests.append(ReservationRequest.ReservationRequest(DAYS[weekday - 1], weekday, startTime, endTime, slots))
+    users.append(batch.BatchUser(userId, f"user{userId}@concordia.ca", 'password', requests))
+  return users
+
+def runBatch(userCount: int, timer: StageTimer, rng: random.Random):
+  from Reserve import availability, batch, cache, catalogue, reserve
+  cache.SHARED_AVAILABILITY_CACHE.clear() # every run should hit the simulator, not last run's grids
+  users = makeUsers(userCount, rng)
+  with timer.stage('plan dates'):
+    userDates = batch.plannedUserDates(users)
+  with timer.stage('catalogue'): # what loadRooms does when the rooms table is stale, without the database
+    rooms = sorted((room for library in availability.LIBRARIES for room in catalogue.discoverRooms(library, reserve.createDateStringsForRequest(userDates[0][2]))), key=lambda room: (room.priority, room.eid))
+  with timer.stage('fetch+parse'):
+    dateStrings = list(dict.fromkeys(reserve.createDateStringsForRequest(date) for _, _, date in userDates))
+    availabilityMap = availability.getLibraryAvailabilityMap([(library.lid, date) for date in dateStrings for library in availability.LIBRARIES], runCache={})
+  with timer.stage('index'):
+    indexMap = reserve.indexAvailabilityMap(availability.mergeLibraries(availabilityMap))
+  with timer.stage('match'):
+    plans = batch.planReservations(userDates, indexMap, rooms)
+  with timer.stage('checkout'):
+    completed = batch.checkoutPlans(plans)
+  return len(completed)
+
+def runMain(timer: StageTimer):
+  from Reserve import cache, reserve
+  cache.SHARED_AVAILABILITY_CACHE.clear()
+  reserve.database = MemoryDatabase()
+  with timer.stage('main'):
+    if reserve.ASYNC_PIPELINE:
+      from Reserve import asyncreserve
+      asyncreserve.asyncdatabase = MemoryAsyncDatabase(reserve.database)
+      asyncreserve.main()
+    else:
+      reserve.main()
+  return len(reserve.database.days)
+
+def runTest(timer: StageTimer):
+  from Reserve import cache, reserve
+  cache.SHARED_AVAILABILITY_CACHE.clear()
+  with timer.stage('test'), contextlib.redirect_stdout(io.StringIO()): # test() prints a lot
+    reserve.test()
+  return 0
+
+def report(name: str, simulator: LibCalSimulator, scenario, repeat: int):
+  from Reserve import client, metrics
+  timer = StageTimer()
+  wallTimes = []
+  requestCounts = []
+  reserved = 0
+  deferred = 0
+  for _ in range(repeat):
+    simulator.reset()
+    client.resetHosts() # a circuit opened by the last run shouldn't carry over
+    for path in glob.glob(os.path.join(os.environ['SESSION_STORE_DIR'], '*.next')): # the last repeat's spacing
+      os.remove(path)
+    metrics.startRun(name, enabled=True)
+    start = perf_counter()
+    reserved = scenario(timer)
+    wallTimes.append(perf_counter() - start)
+    requestCounts.append(simulator.totalRequests())
+    summary = metrics.finishRun()
+    deferred = summary['counters'].get('checkoutsDeferred', 0)
+    # the bot's own spans (createcart, auth, checkout wait, ...) go in the report next to the ones timed here
+    for stage, values in summary['stages'].items():
+      timer.samples[f"  {stage}"].append(values['seconds'])
+  print(f"\n== {name}: wall p50 {percentile(wallTimes, 50):.3f}s, {sum(requestCounts) / len(requestCounts):.0f} requests per run ({dict(simulator.counts)}), {reserved} reserved, {deferred} deferred")
+  print(f"  {'stage':<16}{'p50 ms':>10}{'p99 ms':>10}   (indented stages add up every time the stage ran, across threads)")
+  for stage, samples in timer.samples.items():
+    print(f"  {stage:<16}{percentile(samples, 50)*1000:>10.1f}{percentile(samples, 99)*1000:>10.1f}")
+
+def main(argv: list[str]):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--latency', type=float, default=0.02, help='seconds added to every simulator response')
+  parser.add_argument('--jitter', type=float, default=0.01)
+  parser.add_argument('--errors', type=float, default=0.0, help='share of simulator responses that are a 503')
+  parser.add_argument('--repeat', type=int, default=3)
+  parser.add_argument('--users', default='1,10,100,1000')
+  parser.add_argument('--recorded', default=None, help='folder of recorded <date>.html availability pages to replay')
+  parser.add_argument('--libraries', default='2161:5032', help='lid:gid pairs of the libraries to look in, separated by commas')
+  parser.add_argument('--cart-batching', action='store_true', help='check out every user\'s reservations in as few carts as possible')
+  parser.add_argument('--async', dest='asyncPipeline', action='store_true', help='run reserve.main() and the batch checkouts on asyncio')
+  parser.add_argument('--spacing', type=float, default=0, help='CHECKOUT_SPACING_SECONDS, off by default so the runs measure the bot and not the waits')
+  parser.add_argument('--max-wait', type=float, default=None, help='CHECKOUT_MAX_WAIT_SECONDS, how long an account can wait for its turns in a run before its checkouts are left for the next run (--spacing by default, like production)')
+  parser.add_argument('--async-timeout', type=float, default=240, help='ASYNC_RUN_TIMEOUT for --async')
+  parser.add_argument('--rate-limit', type=float, default=0, help='requests per second the bot sends the simulator, off by default so the runs measure the bot and not the limit')
+  args = parser.parse_args(argv)
+
+  simulator = LibCalSimulator(latency=args.latency, jitter=args.jitter, errorRate=args.errors, recordedDir=args.recorded).start()
+  # everything the bot reads at import time has to be set before it's imported
+  os.environ['LIBCAL_URL'] = simulator.url
+  os.environ['CONCORDIA_AUTH_URL'] = simulator.url
+  os.environ.setdefault('CONCORDIA_USERNAME', 'bench@concordia.ca')
+  os.environ.setdefault('CONCORDIA_PASSWORD', 'password')
+  os.environ['CHECKOUT_SPACING_SECONDS'] = str(args.spacing)
+  os.environ['CHECKOUT_MAX_WAIT_SECONDS'] = str(args.spacing if args.max_wait is None else args.max_wait)
+  os.environ['ASYNC_RUN_TIMEOUT'] = str(args.async_timeout)
+  os.environ['CART_BATCHING'] = 'true' if args.cart_batching else 'false'
+  os.environ['LIBCAL_LIBRARIES'] = args.libraries
+  os.environ['ASYNC_PIPELINE'] = 'true' if args.asyncPipeline else 'false'
+  os.environ['HTTP_RATE_LIMIT'] = str(args.rate_limit)
+  os.environ['HTTP_BACKOFF'] = '0.05' # the simulator's errors are random, there's nothing to wait out
+  os.environ['SESSION_STORE_DIR'] = tempfile.mkdtemp(prefix='libcal-bench-')
+  for name in ('DB_HOSTNAME', 'DB_DATABASE', 'DB_USER', 'DB_PASSWORD'):
+    os.environ.setdefault(name, 'unused')
+
+  print(f"LibCal simulator at {simulator.url}, latency {args.latency}s +{args.jitter}s, error rate {args.errors}")
+  try:
+    report('reserve.test()', simulator, runTest, args.repeat)
+    report('reserve.main()', simulator, runMain, args.repeat)
+    for userCount in [int(count) for count in args.users.split(',')]:
+      rng = random.Random(userCount)
+      report(f"batch, {userCount} users", simulator, lambda timer: runBatch(userCount, timer, rng), args.repeat)
+  finally:
+    simulator.stop()
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
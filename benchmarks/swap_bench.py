@@ -0,0 +1,126 @@
+'''
+Times how long a room is held by nobody when bookings.swapBooking moves a reservation into a better room, against the simulator
+
+Every user gets a booking in a low priority room at a time a better room is also free, then every booking is swapped.
+"prepared" is bookings.swapBooking: the new room is already in a logged in cart when the old one is cancelled, so the gap
+is one checkout. "cold" cancels first and then goes through createcart, the auth check and the checkout like a new reservation.
+The gap is measured from the cancel's response to the new booking's confirmation. The cold swaps run one after the other,
+so only the gaps can be compared, not the wall times.
+
+Run from the repo root: python -m benchmarks.swap_bench [--latency 0.02] [--jitter 0.01] [--users 1,10,50]
+'''
+import argparse
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from time import perf_counter
+
+from benchmarks.libcal_sim import LibCalSimulator
+from benchmarks.pipeline_bench import percentile
+
+SLOTS = 2
+
+def bookLowRooms(userCount: int):
+  '''
+  Books every user a room of the worst priority at a time a better room is free too
+
+  Returns: The transient Reservation rows with their booking ids
+  '''
+  import db
+  from Reserve import bookings, client, reserve, sessions
+  from Types import AvailabilityIndex, Room, RoomAvailability
+  date = datetime.now() + timedelta(days=3)
+  dateString = reserve.createDateStringsForRequest(date)
+  availabilityIndex = AvailabilityIndex.AvailabilityIndex(RoomAvailability.getAvailabilityArray(dateString, Room.LID, client.createSession()))
+  worst = max(room.priority for room in Room.LIB_ALL)
+  lowRooms = [room for room in Room.LIB_ALL if room.priority == worst]
+  betterRooms = [room for room in Room.LIB_ALL if room.priority < worst]
+  used = set()
+  reservations = []
+  for startMinutes in range(8 * 60, 22 * 60, 30):
+    endMinutes = startMinutes + SLOTS * AvailabilityIndex.SLOT_MINUTES
+    free = [room for room in betterRooms if (room.eid, startMinutes) not in used and bookings.windowSlots(availabilityIndex, room.eid, startMinutes, endMinutes) is not None]
+    for lowRoom in lowRooms:
+      if len(reservations) == userCount or len(free) == 0:
+        break
+      slots = bookings.windowSlots(availabilityIndex, lowRoom.eid, startMinutes, endMinutes)
+      if slots is None or any((lowRoom.eid, minutes) in used for minutes in range(startMinutes - 30, endMinutes, 30)):
+        continue
+      betterRoom = free.pop(0)
+      used.update((room.eid, minutes) for room in (lowRoom, betterRoom) for minutes in range(startMinutes - 30, endMinutes, 30))
+      userId = len(reservations) + 1
+      username = f"user{userId}@concordia.ca"
+      session = sessions.loadSession(username)
+      confirmationRes = reserve.checkoutReservation(session, slots, username, 'password')
+      sessions.saveSession(username, session)
+      reservations.append(db.Reservation(
+        id = userId,
+        day_since_epoch = reserve.daysSinceEpoch(date),
+        actual_date = datetime.fromordinal(slots[0].dateOrdinal),
+        startTime = slots[0].start.split(' ')[1],
+        endTime = slots[-1].end.split(' ')[1],
+        users_id = userId,
+        booking_id = reserve.bookingIdFromConfirmation(confirmationRes),
+        eid = lowRoom.eid
+        ))
+  return reservations, dateString
+
+def coldSwap(session, upgrade, username: str, password: str):
+  # what swapping would cost without getting the cart ready first
+  from Reserve import bookings, reserve
+  reserve.cancelBooking(session, upgrade.bookingId, username, password)
+  cancelledAt = perf_counter()
+  confirmationRes = reserve.checkoutReservation(session, upgrade.slots, username, password)
+  return bookings.Swap(upgrade, reserve.bookingIdFromConfirmation(confirmationRes), gapSeconds=perf_counter() - cancelledAt)
+
+def run(simulator: LibCalSimulator, userCount: int, prepared: bool):
+  from Reserve import availability, bookings, client, reserve, sessions
+  from Types import Room
+  simulator.reset()
+  client.resetHosts()
+  reservations, dateString = bookLowRooms(userCount)
+  indexMap = reserve.indexAvailabilityMap(availability.mergeLibraries(availability.getLibraryAvailabilityMap([(Room.LID, dateString)], runCache={}, sharedCache=None)))
+  upgrades = bookings.findUpgrades(reservations, indexMap, Room.LIB_ALL)
+  credentials = {reservation.users_id: (f"user{reservation.users_id}@concordia.ca", 'password') for reservation in reservations}
+  simulator.resetCounts()
+  start = perf_counter()
+  if prepared:
+    swaps = bookings.swapAll(upgrades, credentials)
+  else:
+    swaps = []
+    for upgrade in upgrades:
+      username, password = credentials[upgrade.usersId]
+      session = sessions.loadSession(username)
+      swaps.append(coldSwap(session, upgrade, username, password))
+  wall = perf_counter() - start
+  swapped = sum(swap.bookingId is not None for swap in swaps)
+  return len(upgrades), swapped, [swap.gapSeconds for swap in swaps], wall, simulator.totalRequests()
+
+def main(argv: list[str]):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--latency', type=float, default=0.02, help='seconds added to every simulator response')
+  parser.add_argument('--jitter', type=float, default=0.01)
+  parser.add_argument('--users', default='1,10,50')
+  args = parser.parse_args(argv)
+
+  simulator = LibCalSimulator(latency=args.latency, jitter=args.jitter).start()
+  os.environ['LIBCAL_URL'] = simulator.url
+  os.environ['CONCORDIA_AUTH_URL'] = simulator.url
+  os.environ['CHECKOUT_SPACING_SECONDS'] = '0'
+  os.environ['HTTP_RATE_LIMIT'] = '0'
+  os.environ['AVAILABILITY_HISTORY'] = 'false'
+  os.environ['SESSION_STORE_DIR'] = tempfile.mkdtemp(prefix='libcal-bench-')
+
+  print(f"LibCal simulator at {simulator.url}, latency {args.latency}s +{args.jitter}s")
+  print(f"{'users':>7}{'swaps':>7}{'mode':>10}{'swapped':>9}{'gap p50 ms':>12}{'gap p99 ms':>12}{'wall s':>8}{'requests':>10}")
+  try:
+    for userCount in [int(count) for count in args.users.split(',')]:
+      for prepared in (False, True):
+        upgrades, swapped, gaps, wall, requests = run(simulator, userCount, prepared)
+        print(f"{userCount:>7}{upgrades:>7}{'prepared' if prepared else 'cold':>10}{swapped:>9}{percentile(gaps, 50)*1000:>12.1f}{percentile(gaps, 99)*1000:>12.1f}{wall:>8.2f}{requests:>10}")
+  finally:
+    simulator.stop()
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
@@ -1,13 +1,10 @@
-from sqlalchemy import Column, ForeignKey, Integer, String, Boolean, DateTime, create_engine
-from sqlalchemy.orm import declarative_base, relationship, Session
+from sqlalchemy import Column, ForeignKey, Integer, String, Boolean, DateTime, UniqueConstraint, create_engine, func, text
+from sqlalchemy.orm import declarative_base, joinedload, relationship, Session
 import os
 
-DB_HOSTNAME = os.environ['DB_HOSTNAME']
-DB_DATABASE = os.environ['DB_DATABASE']
-DB_USER = os.environ['DB_USER']
-DB_PASSWORD = os.environ['DB_PASSWORD']
-
-CONNECTION_STRING = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOSTNAME}/{DB_DATABASE}?sslmode=require"
+def connectionString():
+  # the settings are read when an engine is made, so the models can be imported without them
+  return f"postgresql://{os.environ['DB_USER']}:{os.environ['DB_PASSWORD']}@{os.environ['DB_HOSTNAME']}/{os.environ['DB_DATABASE']}?sslmode=require"
 
 Base = declarative_base()
 
@@ -41,6 +38,13 @@ class Reservation(Base):
   
   users_id = Column(Integer, ForeignKey("users.id"), nullable=False)
   user = relationship("User", back_populates="reservations")
+  
+  # what libcal's checkout answered with (the cs_... id in the email's cancel link) and the room that was booked, see Reserve/bookings.py
+  booking_id = Column(String(64))
+  eid = Column(Integer)
+  
+  def __repr__(self):
+    return f"Reservation(id={self.id}, users_id={self.users_id}, day_since_epoch={self.day_since_epoch}, startTime='{self.startTime}', endTime='{self.endTime}', eid={self.eid}, booking_id='{self.booking_id}')"
     
 
 class Room(Base):
@@ -52,6 +56,15 @@ class Room(Base):
   priority = Column(Integer, nullable=False)
   seats = Column(Boolean, nullable=False)  
   
+  # filled in from the availability pages, see Reserve/catalogue.py
+  eid = Column(Integer, unique=True)
+  lid = Column(Integer)
+  gid = Column(Integer)
+  updated = Column(DateTime)
+  
+  def __repr__(self):
+    return f"Room(id={self.id}, name='{self.name}', eid={self.eid}, lid={self.lid}, gid={self.gid}, priority={self.priority}, updated={self.updated})"
+  
 class ReservationRequest(Base):
   __tablename__ = 'reservation_requests'
   
@@ -61,14 +74,97 @@ class ReservationRequest(Base):
   iso_weekday = Column(Integer, nullable=False)
   slots30mins = Column(Integer, nullable=False)
   startTime = Column(String(32), nullable=False)
-  startTime = Column(String(32), nullable=False)
+  endTime = Column(String(32), nullable=False)
   
   users_id = Column(Integer, ForeignKey("users.id"), nullable=False)
-  user = relationship("User", back_populates="reservations")
+  user = relationship("User", back_populates="reservationRequests")
+
+  
+  def __repr__(self):
+    return f"ReservationRequest(id={self.id}, dow='{self.dow}', iso_weekday={self.iso_weekday}, startTime='{self.startTime}', endTime='{self.endTime}', slots30mins={self.slots30mins}, users_id={self.users_id})"
 
+class ReservationJob(Base):
+  '''
+  One user's request on one date waiting to be reserved, see Reserve/jobs.py
+  '''
+  __tablename__ = 'reservation_jobs'
+  __table_args__ = (UniqueConstraint('users_id', 'request_id', 'day_since_epoch'),) # enqueueing the same job twice does nothing
+  
+  id = Column(Integer, primary_key=True, autoincrement=True)
+  users_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+  request_id = Column(Integer, ForeignKey("reservation_requests.id", ondelete="CASCADE"), nullable=False)
+  day_since_epoch = Column(Integer, nullable=False)
+  
+  status = Column(String(16), nullable=False, default='pending', server_default='pending') # pending, leased, done or failed
+  attempts = Column(Integer, nullable=False, default=0, server_default='0')
+  available_at = Column(DateTime, nullable=False, server_default=func.now()) # not handed out before this
+  lease_owner = Column(String(64))
+  lease_expires = Column(DateTime)
+  last_error = Column(String(256))
+  updated = Column(DateTime, nullable=False, server_default=func.now())
   
   def __repr__(self):
-    return f"ReservationRequest(id={self.id}, dow='{self.dow}', iso_weekday={self.iso_weekday}, startTime='{self.startTime}', endTime='{self.endTime}', slots30mins={self.slots30mins}, user_id={self.user_id})"
+    return f"ReservationJob(id={self.id}, users_id={self.users_id}, request_id={self.request_id}, day_since_epoch={self.day_since_epoch}, status='{self.status}', attempts={self.attempts})"
+
+def createEngine(echo = False):
+  return create_engine(connectionString(), echo=echo, future=True)
+
+def loadUsersWithRequests(session: Session, userIds: list[int] = None) -> list[User]:
+  '''
+  Gets every user (or only the ones in userIds) along with their reservation requests in a single query
+  '''
+  query = session.query(User).options(joinedload(User.reservationRequests))
+  if userIds is not None:
+    query = query.filter(User.id.in_(userIds))
+  return query.order_by(User.id).all()
+
+def findReservations(session: Session, daysSinceEpoch: list[int], userIds: list[int] = None) -> list[Reservation]:
+  '''
+  Gets every user's (or only the userIds users') reservations that land on one of the days in daysSinceEpoch
+  '''
+  if len(daysSinceEpoch) == 0:
+    return []
+  ensureReservationColumns(session)
+  query = session.query(Reservation).filter(Reservation.day_since_epoch.in_(daysSinceEpoch))
+  if userIds is not None:
+    query = query.filter(Reservation.users_id.in_(userIds))
+  return query.all()
+
+_roomColumnsReady = False
+
+def ensureRoomColumns(session: Session):
+  '''
+  Adds the catalogue columns to a rooms table that was made before they existed, only has to happen once per worker
+  '''
+  global _roomColumnsReady
+  if _roomColumnsReady:
+    return
+  for column in ('eid integer UNIQUE', 'lid integer', 'gid integer', 'updated timestamp'):
+    session.execute(text(f"ALTER TABLE rooms ADD COLUMN IF NOT EXISTS {column}"))
+  session.commit()
+  _roomColumnsReady = True
+
+_reservationColumnsReady = False
+
+def ensureReservationColumns(session: Session):
+  '''
+  Adds the booking columns to a reservation table that was made before they existed, only has to happen once per worker
+  '''
+  global _reservationColumnsReady
+  if _reservationColumnsReady:
+    return
+  for column in ('booking_id varchar(64)', 'eid integer'):
+    session.execute(text(f"ALTER TABLE reservation ADD COLUMN IF NOT EXISTS {column}"))
+  session.commit()
+  _reservationColumnsReady = True
+
+def findRooms(session: Session, lids: list[int]) -> list[Room]:
+  '''
+  Gets the catalogued rooms of every library in lids
+  '''
+  if len(lids) == 0:
+    return []
+  return session.query(Room).filter(Room.lid.in_(lids)).order_by(Room.priority, Room.eid).all()
 
 def createObjects(engine):
   
@@ -92,7 +188,7 @@ def createObjects(engine):
   
 
 if __name__ == "__main__":
-  engine = create_engine(CONNECTION_STRING, echo=True, future=True)
+  engine = createEngine(echo=True)
   Base.metadata.create_all(engine)
   # print(engine.table_names)
   createObjects(engine)